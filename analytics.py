@@ -0,0 +1,249 @@
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+from catalog import format_sizes
+
+# ==========================================
+# 營運分析 (不依賴 Streamlit)
+# 從歷史紀錄累積：每日消耗量 (編號/倉庫)、設計單的 FIFO 與加權平均領用成本、週轉率、補貨預測
+# 紀錄只會追加，新進的列只併入累計結果，不重算整份紀錄
+# ==========================================
+
+OUTFLOW_ACTIONS = ('出庫-', '設計單領出') # 動作開頭符合、數量為負的列算消耗
+ORDER_ACTION = '設計單領出'
+UNIT_COST = re.compile(r'單\$\s*(-?[\d,]*\.?\d+)')
+ROW_KEY = ['紀錄時間', '單號', '編號', '批號', '數量變動']
+
+# --- 成本備註裡記下的單價「(單$12.50)」，沒有的為 NaN ---
+def recorded_unit_costs(history):
+    s = history['成本備註'].astype(str).str.extract(UNIT_COST, expand=False)
+    return pd.to_numeric(s.str.replace(',', ''), errors='coerce').to_numpy(dtype=float)
+
+def consumption_mask(history):
+    action = history['動作'].astype(str)
+    return (action.str.startswith(OUTFLOW_ACTIONS) & (history['數量變動'] < 0)).to_numpy()
+
+class Analytics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.rows_seen = 0
+        self._last_row = None
+        self._usage_cache = {} # 每日用量矩陣，紀錄有新的列就作廢
+        # 每日彙總：用量 (消耗，正數) 與淨變動 (全部動作)
+        self.daily = pd.DataFrame({'編號': pd.Series(dtype=str), '倉庫': pd.Series(dtype=str),
+                                   '日期': pd.Series(dtype='datetime64[ns]'),
+                                   '用量': pd.Series(dtype='int64'), '淨變動': pd.Series(dtype='int64')})
+        # 進貨層：每個編號依先後排列，累計數量/累計成本為這一層結束時的累計值
+        self.layers = pd.DataFrame({'編號': pd.Series(dtype=str), '序號': pd.Series(dtype='int64'),
+                                    '累計數量': pd.Series(dtype=float), '累計成本': pd.Series(dtype=float),
+                                    '單價': pd.Series(dtype=float)})
+        self.totals = pd.DataFrame({'累計數量': pd.Series(dtype=float), '累計成本': pd.Series(dtype=float)})
+        self.used = pd.Series(dtype=float) # 各編號累計消耗 (FIFO 位置)
+        self.orders = pd.DataFrame({'時間': pd.Series(dtype='datetime64[ns]'), '品項': pd.Series(dtype='int64'),
+                                    '數量': pd.Series(dtype='int64'), 'FIFO成本': pd.Series(dtype=float),
+                                    '加權平均成本': pd.Series(dtype=float), '記錄成本': pd.Series(dtype=float)},
+                                   index=pd.Index([], name='單號', dtype=str))
+
+    def _row_key(self, history, i):
+        return tuple(history[ROW_KEY].iloc[i].astype(str))
+
+    # --- 併入新的紀錄：history 與上次相比只多了後面的列就只處理新列，否則整份重建 ---
+    # inventory 只在重建時用來推算紀錄開始前的期初庫存
+    def refresh(self, history, inventory=None):
+        with self.lock:
+            n = len(history)
+            if self.rows_seen and (n < self.rows_seen or self._row_key(history, self.rows_seen - 1) != self._last_row):
+                self.reset()
+            if n == self.rows_seen: return self
+            if self.rows_seen == 0 and inventory is not None: self._add_layers(self._opening(history, inventory))
+            self._fold(history.iloc[self.rows_seen:], self.rows_seen)
+            self.rows_seen, self._last_row = n, self._row_key(history, n - 1)
+            self._usage_cache = {}
+        return self
+
+    # --- 期初層：目前庫存減去紀錄裡的淨變動，單價用目前各批的加權平均 ---
+    def _opening(self, history, inventory):
+        net = history.groupby(history['編號'].astype(str))['數量變動'].sum()
+        stock = inventory['庫存(顆)'].astype(float)
+        inv = pd.DataFrame({'編號': inventory['編號'].astype(str), '庫存': stock,
+                            '金額': stock * inventory['成本單價'].astype(float),
+                            '成本單價': inventory['成本單價'].astype(float)}).groupby('編號')
+        qty = inv['庫存'].sum() - net.reindex(inv['庫存'].sum().index).fillna(0)
+        unit = (inv['金額'].sum() / inv['庫存'].sum()).where(inv['庫存'].sum() > 0, inv['成本單價'].mean())
+        keep = qty > 0
+        return pd.DataFrame({'編號': qty.index[keep], '序號': -1, '數量': qty[keep].values,
+                             '單價': unit[keep].fillna(0).values})
+
+    def _add_layers(self, rec):
+        if rec.empty: return
+        prev = self.totals.reindex(rec['編號'])
+        rec = rec.assign(
+            累計數量=rec.groupby('編號')['數量'].cumsum().values + prev['累計數量'].fillna(0).values,
+            累計成本=(rec['數量'] * rec['單價']).groupby(rec['編號']).cumsum().values + prev['累計成本'].fillna(0).values)
+        self.layers = pd.concat([self.layers, rec[self.layers.columns]], ignore_index=True)
+        self.totals = rec.groupby('編號')[['累計數量', '累計成本']].last().combine_first(self.totals)
+
+    # --- FIFO：某編號前 x 顆進貨的總成本 (x 不超過已知進貨) ---
+    def _fifo_value(self, sku, x):
+        q = pd.DataFrame({'編號': sku, 'x': x.astype(float), '_i': np.arange(len(x))}).sort_values('x')
+        layers = self.layers[['編號', '累計數量', '累計成本', '單價']].sort_values('累計數量')
+        m = pd.merge_asof(q, layers, left_on='x', right_on='累計數量', by='編號', direction='forward')
+        value = (m['累計成本'] - (m['累計數量'] - m['x']) * m['單價']).to_numpy()
+        return np.nan_to_num(value[np.argsort(m['_i'].to_numpy())])
+
+    # --- 領用當下 (序號之前) 各編號的累計進貨數量與成本 ---
+    def _received_before(self, out):
+        q = out[['編號', '序號']].assign(_i=np.arange(len(out))).sort_values('序號')
+        layers = self.layers[['編號', '序號', '累計數量', '累計成本']].sort_values('序號')
+        m = pd.merge_asof(q, layers, on='序號', by='編號', direction='backward', allow_exact_matches=False)
+        order = np.argsort(m['_i'].to_numpy())
+        return m['累計數量'].fillna(0).to_numpy()[order], m['累計成本'].fillna(0).to_numpy()[order]
+
+    def _fold(self, chunk, offset):
+        chunk = chunk.reset_index(drop=True)
+        seq = np.arange(offset, offset + len(chunk))
+        qty = chunk['數量變動'].astype('int64').to_numpy()
+        sku = chunk['編號'].astype(str).to_numpy()
+        unit = recorded_unit_costs(chunk)
+
+        # 1. 進貨 (數量為正) 成為新的成本層
+        inn = qty > 0
+        if inn.any():
+            self._add_layers(pd.DataFrame({'編號': sku[inn], '序號': seq[inn], '數量': qty[inn].astype(float),
+                                           '單價': np.nan_to_num(unit[inn])}))
+
+        # 2. 消耗：依 FIFO 位置與當時的平均單價計算成本
+        used = consumption_mask(chunk)
+        if used.any():
+            out = pd.DataFrame({'編號': sku[used], '序號': seq[used], '數量': -qty[used],
+                                '單號': chunk.loc[used, '單號'].astype(str).values,
+                                '動作': chunk.loc[used, '動作'].astype(str).values,
+                                '時間': chunk.loc[used, '紀錄時間'].values})
+            received, received_cost = self._received_before(out)
+            # 加權平均：當時為止所有進貨的平均單價；沒有進貨可算時用記下的單價
+            avg = np.divide(received_cost, received, out=np.full(len(out), np.nan), where=received > 0)
+            fallback = np.nan_to_num(np.where(np.isnan(unit[used]), avg, unit[used]))
+            out['加權平均成本'] = out['數量'] * np.where(np.isnan(avg), fallback, avg)
+
+            # FIFO 位置：p = min(前一筆位置 + 數量, 當時已進貨量)，超過的部分 (紀錄前的存貨) 用記下的單價
+            # 遞迴展開為 p_i = S_i + min(起始位置, cummin(已進貨量 - S))，S 為該編號數量的累加
+            sku_s = out['編號']
+            s_cum = out.groupby('編號')['數量'].cumsum().to_numpy()
+            head = self.used.reindex(sku_s).fillna(0).to_numpy()
+            slack = pd.Series(received - s_cum).groupby(sku_s.values).cummin().to_numpy()
+            end = s_cum + np.minimum(head, slack)
+            start = pd.Series(end).groupby(sku_s.values).shift(1).to_numpy()
+            start = np.where(np.isnan(start), head, start)
+            covered = end - start
+            out['FIFO成本'] = (self._fifo_value(sku_s, end) - self._fifo_value(sku_s, start)
+                               + (out['數量'].to_numpy() - covered) * fallback)
+            out['記錄成本'] = out['數量'] * np.nan_to_num(unit[used])
+            self.used = pd.Series(end).groupby(sku_s.values).last().combine_first(self.used)
+
+            orders = out[out['動作'] == ORDER_ACTION]
+            if not orders.empty:
+                part = orders.groupby('單號').agg(時間=('時間', 'min'), 品項=('編號', 'size'), 數量=('數量', 'sum'),
+                                                 FIFO成本=('FIFO成本', 'sum'), 加權平均成本=('加權平均成本', 'sum'),
+                                                 記錄成本=('記錄成本', 'sum'))
+                self.orders = pd.concat([self.orders, part]).groupby(level=0).agg(
+                    {'時間': 'min', '品項': 'sum', '數量': 'sum', 'FIFO成本': 'sum', '加權平均成本': 'sum', '記錄成本': 'sum'})
+                self.orders.index.name = '單號'
+
+        # 3. 每日彙總 (時間無法解析的列不計)
+        day = pd.to_datetime(chunk['紀錄時間']).dt.normalize()
+        ok = day.notna().to_numpy()
+        if ok.any():
+            part = pd.DataFrame({'編號': sku[ok], '倉庫': chunk.loc[ok, '倉庫'].astype(str).values, '日期': day[ok].values,
+                                 '用量': np.where(used, -qty, 0)[ok], '淨變動': qty[ok]})
+            self.daily = pd.concat([self.daily, part], ignore_index=True).groupby(
+                ['編號', '倉庫', '日期'], as_index=False)[['用量', '淨變動']].sum()
+
+    # ------------------------------------------
+    # 查詢 (days：往回算的天數，含今天)
+    # ------------------------------------------
+
+    def _window(self, days, today=None):
+        today = pd.Timestamp(today if today is not None else pd.Timestamp.now()).normalize()
+        return today - pd.Timedelta(days=days - 1)
+
+    # --- 週轉：用量、日均用量、期初/期末庫存、週轉率 (用量 ÷ 平均庫存)、庫存天數 ---
+    # by 為 '編號' 或 '倉庫'
+    def turnover(self, inventory, days, by='編號', today=None):
+        d = self.daily[self.daily['日期'] >= self._window(days, today)]
+        flow = d.groupby(by)[['用量', '淨變動']].sum()
+        stock = inventory.assign(**{by: inventory[by].astype(str)}).groupby(by)['庫存(顆)'].sum()
+        out = flow.reindex(flow.index.union(stock.index)).fillna(0)
+        out['期末庫存'] = stock.reindex(out.index).fillna(0)
+        out['期初庫存'] = out['期末庫存'] - out['淨變動']
+        out['日均用量'] = out['用量'] / days
+        avg_stock = (out['期初庫存'] + out['期末庫存']) / 2
+        out['週轉率'] = (out['用量'] / avg_stock.where(avg_stock > 0)).round(2)
+        out['庫存天數'] = (days / out['週轉率'].where(out['週轉率'] > 0)).round(1)
+        cols = ['用量', '日均用量', '期初庫存', '期末庫存', '週轉率', '庫存天數']
+        return out[cols].sort_values('用量', ascending=False)
+
+    # --- 設計單領用成本 (期間內，最新在前) ---
+    def order_costs(self, days=None, today=None):
+        orders = self.orders
+        if days is not None: orders = orders[orders['時間'] >= self._window(days, today)]
+        return orders.sort_values('時間', ascending=False)
+
+    # ------------------------------------------
+    # 補貨預測
+    # ------------------------------------------
+
+    # --- 每日用量矩陣：列為編號、欄為期間內每一天 (沒有用量的日子補 0) ---
+    def usage_matrix(self, days, today=None):
+        start = self._window(days, today)
+        key = (days, start)
+        if key not in self._usage_cache:
+            d = self.daily[(self.daily['日期'] >= start) & (self.daily['用量'] > 0)]
+            m = d.pivot_table(index='編號', columns='日期', values='用量', aggfunc='sum', fill_value=0)
+            self._usage_cache = {key: m.reindex(columns=pd.date_range(start, periods=days, freq='D'), fill_value=0)}
+        return self._usage_cache[key]
+
+    # --- 補貨建議：所有品項一次算 ---
+    # 日均用量為指數平滑 (alpha 越大越偏重近期)，再訂購點 = 日均用量 × 前置天數 + 安全庫存
+    # 安全庫存 = z × 日用量標準差 × √前置天數；建議進貨量補到能再撐 cover_days 天
+    # by：'編號' 或 '品項' (名稱 + 規格，同款不同編號合併計算)
+    def reorder_plan(self, inventory, by='編號', days=90, alpha=0.1, lead_days=7, cover_days=30, z=1.65, today=None):
+        inv = inventory.assign(編號=inventory['編號'].astype(str), 規格=format_sizes(inventory),
+                               進貨廠商=inventory['進貨廠商'].astype(str))
+        inv['品項'] = inv['名稱'].astype(str) + ' ' + inv['規格']
+        # 每組的廠商取最近一次進貨的批
+        latest = inv.sort_values('進貨日期', kind='stable').drop_duplicates(by, keep='last').set_index(by)
+        stock = inv.groupby(by)['庫存(顆)'].sum()
+
+        m = self.usage_matrix(days, today)
+        if by != '編號':
+            group_of = inv.drop_duplicates('編號').set_index('編號')[by]
+            m = m.groupby(group_of.reindex(m.index).fillna(m.index.to_series())).sum()
+        weights = alpha * (1 - alpha) ** np.arange(days)[::-1] # 最後一欄為今天
+        usage = pd.Series(m.to_numpy() @ weights / weights.sum(), index=m.index)
+        spread = m.std(axis=1, ddof=0)
+
+        plan = pd.DataFrame(index=stock.index.union(m.index))
+        plan['名稱'] = latest['名稱'].reindex(plan.index)
+        plan['規格'] = latest['規格'].reindex(plan.index)
+        plan['進貨廠商'] = latest['進貨廠商'].reindex(plan.index).fillna('')
+        plan['庫存'] = stock.reindex(plan.index).fillna(0).astype(int)
+        plan['日均用量'] = usage.reindex(plan.index).fillna(0).round(2)
+        safety = z * spread.reindex(plan.index).fillna(0) * np.sqrt(lead_days)
+        plan['再訂購點'] = np.ceil(plan['日均用量'] * lead_days + safety).astype(int)
+        plan['可用天數'] = (plan['庫存'] / plan['日均用量'].where(plan['日均用量'] > 0)).round(1)
+        target = plan['日均用量'] * (lead_days + cover_days) + safety
+        plan['建議進貨量'] = np.ceil((target - plan['庫存']).clip(lower=0)).astype(int)
+        plan['低庫存'] = (plan['日均用量'] > 0) & (plan['庫存'] <= plan['再訂購點'])
+        plan.index.name = by
+        return plan.sort_values(['低庫存', '可用天數'], ascending=[False, True], na_position='last')
+
+# --- 採購建議匯出：只列要補貨的品項，依廠商排序 ---
+def purchase_suggestions(plan):
+    need = plan[plan['建議進貨量'] > 0].reset_index()
+    cols = ['進貨廠商', plan.index.name, '名稱', '規格', '庫存', '日均用量', '可用天數', '建議進貨量']
+    return need[[c for c in dict.fromkeys(cols)]].sort_values(['進貨廠商', '可用天數'], na_position='last')
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+from catalog import format_sizes
+from schema import KEY_COLUMNS, SNAPSHOT_COLUMNS, to_sheet_strings, to_numbers
+
+# ==========================================
+# 歷史紀錄封存與指定日期庫存 (不依賴 Streamlit)
+# 已結束的月份搬到各月的封存表，歷史紀錄表只留最近幾個月
+# 封存時留一份庫存快照；某一天的庫存 = 最接近的快照 ± 兩者之間的數量變動
+# ==========================================
+
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S' # 比紀錄時間多秒數：同一分鐘的紀錄算在快照之前
+
+# --- 紀錄時間 → 'YYYY-MM' (時間格式不對的為空字串) ---
+def month_of(times):
+    t = pd.Series(times).astype(str).str.strip()
+    return t.str.slice(0, 7).where(t.str.match(r'^\d{4}-\d{2}'), '')
+
+# --- start 到 end (含) 的月份 'YYYY-MM' 清單 ---
+def months_between(start, end):
+    if start > end: return []
+    return [p.strftime('%Y-%m') for p in pd.period_range(start, end, freq='M')]
+
+# --- 可封存的列數：從最前面開始連續早於 keep_from 的月份 (雲端是刪掉最上面幾列，所以只取開頭) ---
+def archivable_count(times, keep_from):
+    months = month_of(times)
+    old = ((months != '') & (months < keep_from)).to_numpy()
+    return len(old) if old.all() else int(np.argmin(old))
+
+# --- 庫存快照列：只記有庫存的批號 ---
+def snapshot_rows(inventory, taken_at):
+    stocked = inventory[inventory['庫存(顆)'] != 0]
+    strings = to_sheet_strings(stocked)
+    return strings.assign(快照時間=taken_at)[SNAPSHOT_COLUMNS].values.tolist()
+
+# --- 從快照推回某一刻的庫存 ---
+# base：快照 (編號, 批號, 倉庫, 庫存(顆), 成本單價)；changes：快照與目標時間之間的紀錄
+# forward=True 表示目標在快照之後 (加上變動)，否則在之前 (扣回變動)
+def rebuild_stock(base, changes, forward):
+    moves = pd.DataFrame({'編號': changes['編號'].astype(str).values, '批號': changes['批號'].astype(str).values,
+                          '數量變動': to_numbers(changes['數量變動']).fillna(0).values})
+    delta = moves.groupby(KEY_COLUMNS)['數量變動'].sum()
+    stock = base.assign(編號=base['編號'].astype(str), 批號=base['批號'].astype(str)).set_index(KEY_COLUMNS)
+    stock = stock[~stock.index.duplicated(keep='last')]
+    stock = stock.reindex(stock.index.union(delta.index))
+    stock['庫存(顆)'] = stock['庫存(顆)'].fillna(0) + (1 if forward else -1) * delta.reindex(stock.index).fillna(0)
+    return stock.reset_index()
+
+# --- 加上名稱/規格 (取自目前庫存) 與庫存金額，只留有庫存的批號 ---
+def stock_report(stock, inventory):
+    info = inventory.assign(編號=inventory['編號'].astype(str), 批號=inventory['批號'].astype(str))
+    info = info.drop_duplicates(KEY_COLUMNS, keep='last').set_index(KEY_COLUMNS)
+    s = stock[stock['庫存(顆)'] != 0].set_index(KEY_COLUMNS)
+    # 快照之後才建立的批號沒有快照成本，用目前庫存的成本與倉庫
+    cost = s['成本單價'].fillna(info['成本單價'].reindex(s.index).astype(float)).fillna(0)
+    wh = s['倉庫'].astype(object).fillna(info['倉庫'].reindex(s.index).astype(object)).fillna('')
+    named = info.reindex(s.index)
+    report = pd.DataFrame({'倉庫': wh.astype(str), '名稱': named['名稱'].astype(object).fillna('').astype(str),
+                           '規格': format_sizes(named), '庫存(顆)': s['庫存(顆)'].astype(int), '成本單價': cost,
+                           '庫存金額': (s['庫存(顆)'] * cost).round(2)}, index=s.index)
+    return report.reset_index()
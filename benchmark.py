@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import gspread
+import requests
+
+from schema import COLUMNS, HISTORY_COLUMNS
+from catalog import ProductPicker, SearchIndex
+from inventory_ops import resolve_cart, apply_checkout
+from storage import INVENTORY, HISTORY, GSheetAdapter, LocalStore, backoff_delay, is_quota_error
+from sheets import open_table
+
+# ==========================================
+# 效能量測：假的 Google Sheets + 合成資料，量主要路徑的耗時，結果輸出 JSON
+# 用法：python benchmark.py --inventory 1000 10000 --history 100000 --latency 0.05 --out bench.json
+# ==========================================
+
+# ------------------------------------------
+# 1. 記憶體版 gspread (只實作 app 用到的方法)，可加延遲與配額錯誤
+# ------------------------------------------
+
+def quota_error():
+    resp = requests.Response()
+    resp.status_code = 429
+    resp._content = json.dumps({'error': {'code': 429, 'message': 'Quota exceeded (RATE_LIMIT_EXCEEDED)',
+                                          'status': 'RESOURCE_EXHAUSTED'}}).encode()
+    return gspread.exceptions.APIError(resp)
+
+class FakeSheets:
+    # latency：每次呼叫的延遲秒數 (另加 ±20% 抖動)；quota_every：每 N 次呼叫丟一次 429 (0 為不丟)
+    def __init__(self, latency=0.0, quota_every=0, seed=0):
+        self.latency, self.quota_every = latency, quota_every
+        self.random = random.Random(seed)
+        self.worksheets, self.total_calls = {}, 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.calls, self.bytes_in, self.bytes_out, self.errors = {}, 0, 0, 0
+
+    def _call(self, name, sent=None, received=None):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.total_calls += 1
+        if self.latency: time.sleep(self.latency * self.random.uniform(0.8, 1.2))
+        if self.quota_every and self.total_calls % self.quota_every == 0:
+            self.errors += 1
+            raise quota_error()
+        if sent is not None: self.bytes_out += len(json.dumps(sent, ensure_ascii=False, default=str))
+        if received is not None: self.bytes_in += len(json.dumps(received, ensure_ascii=False, default=str))
+        return received
+
+    def worksheet(self, title):
+        if title not in self.worksheets: self.worksheets[title] = FakeWorksheet(self, title, len(self.worksheets))
+        return self.worksheets[title]
+
+    @property
+    def sheet1(self):
+        return self.worksheet('Sheet1')
+
+    def batch_update(self, body):
+        self._call('batch_update', sent=body)
+        by_id = {ws.id: ws for ws in self.worksheets.values()}
+        value = lambda c: next(iter(c['userEnteredValue'].values()))
+        for req in body['requests']:
+            if 'appendCells' in req:
+                a = req['appendCells']
+                by_id[a['sheetId']].rows.extend([value(c) for c in r['values']] for r in a['rows'])
+            elif 'deleteDimension' in req:
+                d = req['deleteDimension']['range']
+                del by_id[d['sheetId']].rows[d['startIndex']:d['endIndex']]
+            elif 'updateCells' in req:
+                u = req['updateCells']
+                by_id[u['start']['sheetId']].set_cells(u['start']['rowIndex'], u['start']['columnIndex'],
+                                                       [[value(c) for c in r['values']] for r in u['rows']])
+            else:
+                raise ValueError(f"FakeSheets 不支援的請求: {list(req)}")
+
+class FakeWorksheet:
+    class Cell:
+        def __init__(self, value): self.value = value
+
+    def __init__(self, spreadsheet, title, sheet_id):
+        self.spreadsheet, self.title, self.id = spreadsheet, title, sheet_id
+        self.rows = []
+
+    def set_cells(self, r0, c0, values):
+        for i, vals in enumerate(values):
+            while len(self.rows) <= r0 + i: self.rows.append([])
+            row = self.rows[r0 + i]
+            while len(row) < c0 + len(vals): row.append('')
+            row[c0:c0 + len(vals)] = vals
+
+    def get_values(self, **kwargs):
+        self.spreadsheet._call('get_values', received=self.rows)
+        return [list(r) for r in self.rows]
+
+    def row_values(self, i):
+        return self.spreadsheet._call('row_values', received=self.rows[i - 1] if len(self.rows) >= i else [])
+
+    def acell(self, label, **kwargs):
+        r, c = gspread.utils.a1_to_rowcol(label)
+        value = self.rows[r - 1][c - 1] if len(self.rows) >= r and len(self.rows[r - 1]) >= c else None
+        return self.Cell(self.spreadsheet._call('acell', received=value))
+
+    def clear(self):
+        self.spreadsheet._call('clear'); self.rows = []
+
+    def update(self, range_name='A1', values=None, **kwargs):
+        self.spreadsheet._call('update', sent=values)
+        r, c = gspread.utils.a1_to_rowcol(range_name)
+        self.set_cells(r - 1, c - 1, values)
+
+# --- 讀取遇到配額錯誤時退避重試 (間隔縮小 100 倍)；提交 (retry=False) 交給 drain 重送 ---
+def retrying_call(fn, retry=True, max_attempts=10):
+    for attempt in range(max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not retry or not is_quota_error(e) or attempt == max_attempts - 1: raise
+            time.sleep(backoff_delay(attempt, quota=True, base=0.01))
+
+def fake_adapter(sheets):
+    return GSheetAdapter(lambda table: open_table(sheets, table), call=retrying_call)
+
+# ------------------------------------------
+# 2. 合成資料 (以 UNFORMATTED_VALUE 讀到的樣子：數字為 int/float)
+# ------------------------------------------
+
+STONES = ['白水晶', '粉晶', '紫水晶', '黃水晶', '茶晶', '黑曜石', '月光石', '拉長石', '海藍寶', '綠幽靈']
+SHAPES = ['圓珠', '切角', '鑽切', '圓筒', '方體']
+ELEMENTS = ['金', '木', '水', '火', '土']
+SUPPLIERS = ['小聰頭', '廠商A', '廠商B', '蝦皮', '淘寶']
+WAREHOUSES = ['Imeng', '千畇']
+
+def synthetic_inventory(n, seed=0):
+    rng = np.random.default_rng(seed)
+    sku = rng.integers(0, max(1, n // 2), n) # 約一半的編號有兩個以上的批號
+    df = pd.DataFrame({
+        '編號': [f'ST{s:06d}' for s in sku], '批號': [f'B{i:07d}' for i in range(n)],
+        '倉庫': rng.choice(WAREHOUSES, n), '分類': rng.choice(['天然石', '配件', '耗材'], n, p=[0.8, 0.15, 0.05]),
+        '名稱': [f'{STONES[s % len(STONES)]}{s % 97}' for s in sku],
+        '寬度mm': rng.choice([4, 6, 8, 10, 12], n), '長度mm': rng.choice([0, 0, 0, 8, 10], n),
+        '形狀': rng.choice(SHAPES, n), '五行': rng.choice(ELEMENTS, n),
+        '進貨數量(顆)': rng.integers(10, 500, n), '進貨日期': '2024-01-01', '進貨廠商': rng.choice(SUPPLIERS, n),
+        '庫存(顆)': rng.integers(0, 500, n), '成本單價': rng.integers(50, 2000, n) / 100})
+    return [COLUMNS] + df[COLUMNS].values.tolist()
+
+def synthetic_history(n, inventory_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    inv = pd.DataFrame(inventory_rows[1:], columns=COLUMNS)
+    pick = inv.iloc[rng.integers(0, len(inv), n)].reset_index(drop=True)
+    start = pd.Timestamp('2024-01-01').value // 10 ** 9
+    times = pd.to_datetime(np.sort(rng.integers(start, start + 365 * 86400, n)), unit='s').strftime('%Y-%m-%d %H:%M')
+    action = rng.choice(['設計單領出', '出庫-商品', '補貨(總$100.00)', '盤點修正'], n, p=[0.6, 0.2, 0.15, 0.05])
+    qty = np.where(np.char.startswith(action.astype(str), '補貨'), rng.integers(10, 200, n), -rng.integers(1, 10, n))
+    qty = np.where(action == '盤點修正', 0, qty)
+    df = pd.DataFrame({'紀錄時間': times, '單號': [f'DES-{i // 5}' for i in range(n)], '動作': action,
+                       '倉庫': pick['倉庫'], '批號': pick['批號'], '編號': pick['編號'], '分類': pick['分類'],
+                       '名稱': pick['名稱'], '規格': pick['寬度mm'].astype(str) + 'mm', '廠商': pick['進貨廠商'],
+                       '數量變動': qty, '成本備註': '成本$10.00 (單$1.00)'})
+    return [HISTORY_COLUMNS] + df[HISTORY_COLUMNS].values.tolist()
+
+# ------------------------------------------
+# 3. 量測
+# ------------------------------------------
+
+def new_store(sheets, folder):
+    fd, path = tempfile.mkstemp(suffix='.db', dir=folder); os.close(fd)
+    return LocalStore(path, fake_adapter(sheets))
+
+# --- 推送到 outbox 清空 (遇到配額錯誤就退避重試，間隔縮小 100 倍) ---
+def drain(store, max_attempts=20):
+    for attempt in range(max_attempts):
+        if store.push(): return attempt
+        time.sleep(backoff_delay(attempt, quota=is_quota_error(store.last_exception), base=0.01))
+    raise RuntimeError(f"push 一直失敗: {store.last_error}")
+
+class Bench:
+    def __init__(self, repeat):
+        self.repeat, self.results = repeat, []
+
+    # setup 不計時，回傳值傳給 fn；sheets 給了就記錄這段的雲端呼叫
+    def run(self, name, fn, setup=None, sheets=None, **labels):
+        runs, calls = [], {}
+        for _ in range(self.repeat):
+            arg = setup() if setup else None
+            if sheets: sheets.reset_counters()
+            t = time.perf_counter()
+            fn(arg) if setup else fn()
+            runs.append(time.perf_counter() - t)
+        result = {'path': name, **labels, 'runs': runs, 'median': statistics.median(runs), 'min': min(runs)}
+        if sheets:
+            result['sheets'] = {'calls': dict(sheets.calls), 'bytes_in': sheets.bytes_in,
+                                'bytes_out': sheets.bytes_out, 'quota_errors': sheets.errors}
+        self.results.append(result)
+        print(f"{name:<18} {labels} median {result['median'] * 1000:9.1f} ms")
+        return result
+
+def bench_catalog(bench, n_inv, n_hist, args, folder):
+    sheets = FakeSheets(latency=args.latency, quota_every=args.quota_every, seed=args.seed)
+    sheets.worksheet('Sheet1').rows = synthetic_inventory(n_inv, args.seed)
+    sheets.worksheet('History').rows = synthetic_history(n_hist, sheets.worksheet('Sheet1').rows, args.seed)
+    labels = {'inventory_rows': n_inv, 'history_rows': n_hist}
+
+    bench.run('cold_load', lambda store: store.snapshot(INVENTORY), setup=lambda: new_store(sheets, folder),
+              sheets=sheets, **labels)
+    bench.run('cold_load_all', lambda store: store.ensure_loaded(INVENTORY, HISTORY),
+              setup=lambda: new_store(sheets, folder), sheets=sheets, **labels)
+
+    store = new_store(sheets, folder)
+    version, inv = store.snapshot(INVENTORY)
+    bench.run('picker_index', lambda: ProductPicker(inv, admin=True), **labels)
+    picker = ProductPicker(inv, admin=True)
+    bench.run('picker_query', lambda: picker.search('晶', {'五行': ['水']}, (6, 10), in_stock=True), **labels)
+    index = SearchIndex(inv)
+    bench.run('search_index', lambda: SearchIndex(inv), **labels)
+    bench.run('search_query', lambda: index.search('水晶 五行:水 寬度>=8 庫存<100'), **labels)
+
+    rng = np.random.default_rng(args.seed)
+    def checkout_setup():
+        version, base = store.snapshot(INVENTORY)
+        rows = base.iloc[rng.choice(len(base), min(50, len(base)), replace=False)]
+        cart = [{'編號': r['編號'], '批號': r['批號'], '名稱': r['名稱'], '數量': 1} for _, r in rows.iterrows()]
+        return version, base, cart
+    def checkout(arg):
+        version, base, cart = arg
+        inv = base.copy()
+        logs = apply_checkout(inv, resolve_cart(inv, cart), 'BENCH', '', datetime.now().strftime('%Y-%m-%d %H:%M'))
+        store.commit(inv, base, logs=logs, base_version=version)
+        drain(store)
+    bench.run('checkout_50', checkout, setup=checkout_setup, sheets=sheets, **labels)
+
+    # --- 各種存檔：本地提交 + 推送到雲端 ---
+    def edit_setup():
+        version, base = store.snapshot(INVENTORY)
+        inv = base.copy(); inv.iloc[int(rng.integers(len(inv))), COLUMNS.index('庫存(顆)')] += 1
+        return version, base, inv
+    bench.run('save_inventory', lambda a: (store.save_inventory(a[2], a[1], a[0]), drain(store)),
+              setup=edit_setup, sheets=sheets, **labels)
+    new_row = pd.DataFrame(synthetic_inventory(1, args.seed + 1)[1:], columns=COLUMNS)
+    bench.run('append_inventory', lambda: (store.append_inventory(new_row, store.snapshot(INVENTORY)[0]), drain(store)),
+              sheets=sheets, **labels)
+    log = dict(zip(HISTORY_COLUMNS, synthetic_history(1, sheets.worksheet('Sheet1').rows[:2], args.seed)[1]))
+    bench.run('append_history', lambda: (store.append_history([log]), drain(store)), sheets=sheets, **labels)
+    bench.run('rewrite_inventory', lambda: (store.rewrite_remote(INVENTORY), drain(store)), sheets=sheets, **labels)
+
+    # --- 封存前半年的紀錄：每次都從原本的紀錄表重新開始 ---
+    history_rows = [list(r) for r in sheets.worksheet('History').rows]
+    def archive_setup():
+        sheets.worksheet('History').rows = [list(r) for r in history_rows]
+        for ws in sheets.worksheets.values():
+            if ws.title.startswith('History ') or ws.title == 'Snapshots': ws.rows = []
+        archive_store = new_store(sheets, folder)
+        archive_store.ensure_loaded(INVENTORY, HISTORY)
+        return archive_store
+    bench.run('archive_history', lambda s: (s.archive_history('2024-07'), drain(s)), setup=archive_setup,
+              sheets=sheets, **labels)
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='IF Crystal 效能量測')
+    parser.add_argument('--inventory', type=int, nargs='+', default=[1000, 10000, 100000], help='庫存列數 (可多個)')
+    parser.add_argument('--history', type=int, default=100000, help='歷史紀錄列數 (最多約 1,000,000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='每次雲端呼叫的延遲秒數')
+    parser.add_argument('--quota-every', type=int, default=0, help='每 N 次雲端呼叫丟一次 429')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark.json')
+    args = parser.parse_args()
+
+    bench = Bench(args.repeat)
+    with tempfile.TemporaryDirectory() as folder:
+        for n_inv in args.inventory:
+            bench_catalog(bench, n_inv, args.history, args, folder)
+
+    report = {'version': git_version(), 'created': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'pandas': pd.__version__, 'params': vars(args),
+              'results': bench.results}
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"→ {args.out}")
+
+if __name__ == '__main__':
+    main()
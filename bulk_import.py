@@ -0,0 +1,165 @@
+import io
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from catalog import format_sizes
+from schema import COLUMNS, HISTORY_COLUMNS, to_numbers
+
+# ==========================================
+# 批次匯入 (不依賴 Streamlit)
+# 檔案欄位同庫存表 COLUMNS，另可加「總成本」；以 名稱+寬度+長度+形狀+五行 對回現有商品：
+#   對到且批號空白或相同 → 合併進該批 (庫存增加、成本單價改為這次的單價，同 🔄 補貨 的合併)
+#   對到但批號不同       → 同編號的新批號
+#   對不到               → 新商品 (新編號)
+# 單價 = 總成本 / 數量 (沒有總成本時用 成本單價 × 數量 當總成本)，四捨五入到小數兩位
+# ==========================================
+
+MATCH_COLUMNS = ['名稱', '寬度mm', '長度mm', '形狀', '五行']
+TOTAL_COST = '總成本'
+TEMPLATE_COLUMNS = COLUMNS + [TOTAL_COST]
+TEXT_COLUMNS = ['倉庫', '分類', '形狀', '五行', '進貨廠商', '批號', '編號']
+INHERIT_COLUMNS = ['倉庫', '分類', '進貨廠商'] # 現有品項的新批號沒填時沿用最後一批
+TEXT_DEFAULTS = {'倉庫': 'Imeng', '分類': '天然石'}
+
+# --- 讀取上傳檔 (全部當字串讀，數字之後統一轉換)；Excel 需要 openpyxl ---
+def read_upload(name, data):
+    if str(name).lower().endswith(('.xlsx', '.xls')):
+        try:
+            return pd.read_excel(io.BytesIO(data), dtype=str)
+        except ImportError:
+            raise ValueError("讀取 Excel 需要安裝 openpyxl，或改存成 CSV")
+    return pd.read_csv(io.BytesIO(data), dtype=str, encoding='utf-8-sig')
+
+def template_csv():
+    return pd.DataFrame(columns=TEMPLATE_COLUMNS).to_csv(index=False).encode('utf-8-sig')
+
+def _match_keys(df):
+    keys = pd.DataFrame(index=df.index)
+    for col in MATCH_COLUMNS:
+        keys[col] = (to_numbers(df[col]).fillna(0).astype(float) if col in ('寬度mm', '長度mm')
+                     else df[col].fillna('').astype(str).str.strip())
+    return keys
+
+# --- 整理上傳表：補欄位、轉數字、算單價；同品項同批號的多列先加總 ---
+# 回傳 (整理後的表, 問題列表)
+def normalize_upload(raw):
+    raw = raw.rename(columns=lambda c: str(c).strip())
+    issues = []
+    if '名稱' not in raw.columns: return pd.DataFrame(), ["缺少「名稱」欄"]
+    if '進貨數量(顆)' not in raw.columns and '庫存(顆)' not in raw.columns:
+        return pd.DataFrame(), ["缺少「進貨數量(顆)」欄"]
+    df = raw.copy()
+    for col in TEXT_COLUMNS:
+        df[col] = df[col].fillna('').astype(str).str.strip() if col in df.columns else ''
+    for col in ['寬度mm', '長度mm', '成本單價', TOTAL_COST]:
+        df[col] = to_numbers(df[col]) if col in df.columns else np.nan
+    qty_col = '進貨數量(顆)' if '進貨數量(顆)' in df.columns else '庫存(顆)'
+    df['數量'] = to_numbers(df[qty_col])
+    df['進貨日期'] = df['進貨日期'].fillna('').astype(str).str.strip() if '進貨日期' in df.columns else ''
+    df[MATCH_COLUMNS] = _match_keys(df)
+
+    bad = (df['名稱'] == '') | ~(df['數量'] > 0)
+    for i in df.index[bad]: issues.append(f"第 {i + 2} 列沒有名稱或數量不是正數，已略過")
+    df = df[~bad].copy()
+    df['數量'] = df['數量'].round().astype(int)
+    df[TOTAL_COST] = df[TOTAL_COST].fillna(df['成本單價'] * df['數量']).fillna(0)
+
+    # 同品項同批號 (含同倉庫/廠商) 合成一筆：數量與總成本相加
+    group = MATCH_COLUMNS + ['批號', '編號', '倉庫', '分類', '進貨廠商']
+    df = df.groupby(group, sort=False, as_index=False).agg(
+        數量=('數量', 'sum'), 總成本=(TOTAL_COST, 'sum'), 進貨日期=('進貨日期', 'last'))
+    df['單價'] = (df[TOTAL_COST] / df['數量']).round(2)
+    return df, issues
+
+# ==========================================
+# 匯入計畫：合併 (庫存列) / 新增列 / 紀錄，全部算好再一次提交
+# ==========================================
+
+def plan_import(inventory, raw, timestamp, today, id_prefix):
+    df, issues = normalize_upload(raw)
+    empty = {'merges': pd.DataFrame(columns=['_row', '名稱', '規格', '批號', '原庫存', '新庫存', '原單價', '新單價']),
+             'new_rows': pd.DataFrame(columns=COLUMNS), 'logs': [], 'issues': issues}
+    if df.empty: return empty
+
+    inv = inventory.assign(_row=inventory.index)
+    inv[MATCH_COLUMNS] = _match_keys(inventory)
+    inv['批號'] = inv['批號'].astype(str).str.strip()
+    inv['編號'] = inv['編號'].astype(str)
+
+    # 1) 指定了現有批號 → 合併到該批
+    same_batch = inv.drop_duplicates(MATCH_COLUMNS + ['批號'], keep='last')[MATCH_COLUMNS + ['批號', '_row']]
+    df = df.merge(same_batch, on=MATCH_COLUMNS + ['批號'], how='left')
+    # 2) 沒填批號 → 合併到同品項最後一批；填了新批號 → 同品項的新批
+    latest = inv.drop_duplicates(MATCH_COLUMNS, keep='last')[MATCH_COLUMNS + ['_row', '編號'] + INHERIT_COLUMNS]
+    latest = latest.rename(columns={'_row': '_latest', '編號': '_sku', **{c: '_' + c for c in INHERIT_COLUMNS}})
+    df = df.merge(latest.astype({'_' + c: str for c in INHERIT_COLUMNS}), on=MATCH_COLUMNS, how='left')
+    blank = df['批號'] == ''
+    df['_row'] = df['_row'].where(~blank, df['_latest'])
+    merge = df['_row'].notna()
+
+    # --- 合併：同一庫存列可能被多列對到 (數量相加，單價取最後一列) ---
+    m = df[merge].astype({'_row': inventory.index.dtype})
+    add = m.groupby('_row')['數量'].sum()
+    unit = m.groupby('_row')['單價'].last()
+    before = inventory.loc[add.index]
+    merges = pd.DataFrame({'_row': add.index, '名稱': before['名稱'].astype(str).values,
+                           '規格': format_sizes(before).values, '批號': before['批號'].astype(str).values,
+                           '原庫存': before['庫存(顆)'].astype(int).values,
+                           '新庫存': (before['庫存(顆)'].astype(int) + add).values,
+                           '原單價': before['成本單價'].astype(float).values, '新單價': unit.values})
+
+    # --- 新增列：對到品項的沿用編號，新品項每個品項配一個新編號 ---
+    n = df[~merge].copy()
+    new_item = n['_sku'].isna()
+    n['編號'] = n['編號'].where(n['編號'] != '', n['_sku'].fillna(''))
+    need = n['編號'] == ''
+    n.loc[need, '編號'] = [f"{id_prefix}{i:03d}" for i in n[need].groupby(MATCH_COLUMNS, sort=False).ngroup()]
+    for col in INHERIT_COLUMNS: n[col] = n[col].where(n[col] != '', n['_' + col].fillna(''))
+    for col, default in TEXT_DEFAULTS.items(): n[col] = n[col].where(n[col] != '', default)
+    # 批號空白的依序編 YYYYMMDD-01、-02…；與現有或前面的列重複 (編號, 批號) 的列略過
+    taken, batches, keep = set(zip(inv['編號'], inv['批號'])), [], []
+    for sku, batch in zip(n['編號'], n['批號']):
+        if batch == '':
+            batch = next(b for b in (f"{today.replace('-', '')}-{i:02d}" for i in itertools.count(1)) if (sku, b) not in taken)
+        elif (sku, batch) in taken:
+            issues.append(f"{sku}/{batch} 已存在，已略過")
+        keep.append((sku, batch) not in taken)
+        taken.add((sku, batch)); batches.append(batch)
+    n['批號'] = batches
+    n, new_item = n[keep].copy(), new_item[keep]
+    n['進貨日期'] = n['進貨日期'].where(n['進貨日期'] != '', today)
+    new_rows = n.assign(**{'進貨數量(顆)': n['數量'], '庫存(顆)': n['數量'], '成本單價': n['單價']})[COLUMNS]
+
+    # --- 紀錄：格式同 🔄 補貨 / ✨ 建檔 表單 ---
+    src = inventory.loc[m['_row']]
+    merged_logs = pd.DataFrame({
+        '紀錄時間': timestamp, '單號': 'IN', '動作': '補貨(總$' + np.char.mod('%.2f', m[TOTAL_COST].values) + ')',
+        '倉庫': src['倉庫'].astype(str).values, '批號': src['批號'].astype(str).values,
+        '編號': src['編號'].astype(str).values, '分類': src['分類'].astype(str).values,
+        '名稱': src['名稱'].astype(str).values, '規格': format_sizes(src).values,
+        '廠商': src['進貨廠商'].astype(str).values, '數量變動': m['數量'].values})
+    merged_logs['成本備註'] = _cost_note(m)
+    new_logs = pd.DataFrame({
+        '紀錄時間': timestamp, '單號': np.where(new_item, 'NEW', 'IN'),
+        '動作': np.where(new_item, '新商品', '補貨新批(總$' + np.char.mod('%.2f', n[TOTAL_COST].values) + ')'),
+        '倉庫': n['倉庫'].values, '批號': n['批號'].values, '編號': n['編號'].values, '分類': n['分類'].values,
+        '名稱': n['名稱'].values, '規格': format_sizes(n).values, '廠商': n['進貨廠商'].values,
+        '數量變動': n['數量'].values})
+    new_logs['成本備註'] = _cost_note(n)
+    logs = pd.concat([merged_logs, new_logs], ignore_index=True)[HISTORY_COLUMNS]
+    return {'merges': merges, 'new_rows': new_rows.reset_index(drop=True), 'logs': logs.to_dict('records'),
+            'issues': issues}
+
+def _cost_note(df):
+    return ('總$' + np.char.mod('%.2f', df[TOTAL_COST].values.astype(float)) + ' (單$'
+            + np.char.mod('%.2f', df['單價'].values.astype(float)) + ')')
+
+# --- 合併部分寫回庫存 (inventory 直接修改) ---
+def apply_merges(inventory, merges):
+    if merges.empty: return
+    rows = merges['_row'].values
+    stock = inventory['庫存(顆)']
+    inventory.loc[rows, '庫存(顆)'] = merges['新庫存'].astype(stock.dtype).values
+    inventory.loc[rows, '成本單價'] = merges['新單價'].astype(float).values
@@ -0,0 +1,156 @@
+import re
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 商品索引 (選單標籤)
+# 整份庫存一次向量化產生標籤，(編號, 批號) → 列索引 / 標籤用 dict 查詢
+# ==========================================
+
+SORT_COLUMNS = ['名稱', '寬度mm', '五行']
+
+# --- 規格字串 (與 format_size 相同：6.0mm / 6.0x8.0mm / 0mm) ---
+def format_sizes(df):
+    w = pd.to_numeric(df['寬度mm'], errors='coerce').fillna(0).astype(float)
+    l = pd.to_numeric(df['長度mm'], errors='coerce').fillna(0).astype(float)
+    w_s, l_s = w.astype(str), l.astype(str)
+    return pd.Series(np.where(l > 0, w_s + 'x' + l_s + 'mm', np.where(w > 0, w_s + 'mm', '0mm')), index=df.index)
+
+# --- 選單標籤：[倉庫] (五行) 名稱 規格 (形狀) 💰成本 【批號】 | 存:數量 ---
+def make_labels(df, admin=False):
+    if df.empty: return pd.Series([], dtype=str, index=df.index)
+    text = lambda col: df[col].fillna('').astype(str)
+    elem = text('五行').str.strip()
+    elem_display = np.where(elem != '', '(' + elem + ') ', '')
+    stock = pd.to_numeric(df['庫存(顆)'], errors='coerce').fillna(0).astype(int).astype(str)
+
+    cost_str = ''
+    if admin:
+        cost = pd.to_numeric(df['成本單價'], errors='coerce').fillna(0).astype(float).values
+        cost_str = np.where(cost > 0, np.char.add(' 💰$', np.char.mod('%.2f', cost)), '')
+
+    wh = df['倉庫'].fillna('Imeng').astype(str) if '倉庫' in df.columns else 'Imeng'
+    return ('[' + wh + '] ' + elem_display + text('名稱') + ' ' + format_sizes(df) + ' (' + text('形狀') + ') '
+            + cost_str + ' 【' + text('批號').str.strip() + '】 | 存:' + stock)
+
+# ==========================================
+# 商品挑選器
+# 先用篩選條件 (倉庫/分類/五行/形狀、寬度區間、只看有庫存) 縮小範圍，再比對名稱，只回傳前幾筆
+# 名稱比對 (每個關鍵字都要對到，分數相加，越小越前面)：
+#   0 完全相同  1 開頭相同 (或 編號/批號 開頭相同)  2 包含  3 字依序出現 (模糊，例如 粉晶 → 粉紅水晶)
+# 同分維持選單原本的排序；選到的項目直接對回 (編號, 批號)
+# ==========================================
+
+PICKER_LIMIT = 50 # 選單最多送出幾筆
+FACET_COLUMNS = ['倉庫', '分類', '五行', '形狀']
+
+class ProductPicker:
+    def __init__(self, df, admin=False):
+        # category 欄依文字排序 (類別本身的順序不一定是字母序)
+        ordered = df.assign(名稱=df['名稱'].astype(str).str.strip()).sort_values(
+            by=SORT_COLUMNS, key=lambda s: s.astype(str) if isinstance(s.dtype, pd.CategoricalDtype) else s)
+        self.index = ordered.index
+        self.labels = make_labels(ordered, admin).to_numpy()
+        self.keys = list(zip(ordered['編號'].astype(str), ordered['批號'].astype(str)))
+        # 同一個 (編號, 批號) 出現多次時取排序後的第一筆
+        self.index_of = dict(zip(reversed(self.keys), reversed(self.index.tolist())))
+        self.label_of = dict(zip(reversed(self.keys), reversed(self.labels.tolist())))
+        text = lambda col: ordered[col].fillna('').astype(str).str.strip()
+        self.names = text('名稱').str.lower().reset_index(drop=True)
+        self.codes = (text('編號').str.lower() + '\x1f' + text('批號').str.lower()).reset_index(drop=True)
+        self.facets = {col: text(col).to_numpy() for col in FACET_COLUMNS}
+        self.width = pd.to_numeric(ordered['寬度mm'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        self.stock = pd.to_numeric(ordered['庫存(顆)'], errors='coerce').fillna(0).to_numpy(dtype=float)
+
+    # 篩選欄的選項 (不含空白)
+    def options(self, col):
+        return sorted(set(self.facets[col]) - {''})
+
+    def width_range(self):
+        return (float(self.width.min()), float(self.width.max())) if len(self.width) else (0.0, 0.0)
+
+    # --- 回傳 (前 limit 筆的 (編號, 批號), 符合筆數) ---
+    # facets：{欄位: 允許的值}，空的不篩；width：(最小, 最大) 或 None
+    def search(self, query='', facets=None, width=None, in_stock=False, limit=PICKER_LIMIT):
+        mask = np.ones(len(self.keys), dtype=bool)
+        for col, values in (facets or {}).items():
+            if values: mask &= np.isin(self.facets[col], list(values))
+        if width is not None: mask &= (self.width >= width[0]) & (self.width <= width[1])
+        if in_stock: mask &= self.stock > 0
+        pos = np.flatnonzero(mask)
+        score = np.zeros(len(pos), dtype=int)
+        for token in str(query).lower().split():
+            names, codes = self.names.iloc[pos], self.codes.iloc[pos]
+            fuzzy = '.*'.join(re.escape(ch) for ch in token)
+            level = np.select([(names == token).to_numpy(),
+                               (names.str.startswith(token) | codes.str.startswith(token)
+                                | codes.str.contains('\x1f' + token, regex=False)).to_numpy(),
+                               names.str.contains(token, regex=False).to_numpy(),
+                               names.str.contains(fuzzy, regex=True).to_numpy()], [0, 1, 2, 3], 4)
+            keep = level < 4
+            pos, score = pos[keep], score[keep] + level[keep]
+        top = pos[np.lexsort((pos, score))[:limit]]
+        return [self.keys[p] for p in top], len(pos)
+
+# ==========================================
+# 庫存搜尋索引
+# 查詢以空白分隔，全部條件都要符合：
+#   水晶          → 名稱/編號/批號/五行/形狀/廠商 任一欄包含
+#   五行:水       → 指定欄位包含
+#   寬度>8 庫存<=10 → 數字欄位比較 (> >= < <= =)
+# ==========================================
+
+SEARCH_FIELDS = ['名稱', '編號', '批號', '五行', '形狀', '進貨廠商']
+TEXT_FIELDS = {'名稱': '名稱', '編號': '編號', '批號': '批號', '五行': '五行', '形狀': '形狀',
+               '廠商': '進貨廠商', '進貨廠商': '進貨廠商', '倉庫': '倉庫', '分類': '分類'}
+NUMBER_FIELDS = {'寬度': '寬度mm', '寬度mm': '寬度mm', '長度': '長度mm', '長度mm': '長度mm',
+                 '庫存': '庫存(顆)', '庫存(顆)': '庫存(顆)', '成本': '成本單價', '成本單價': '成本單價'}
+QUERY_TOKEN = re.compile(r'^(?P<field>[^:<>=]+?)(?P<op>:|>=|<=|>|<|=)(?P<value>.+)$')
+COMPARE = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+           '=': np.equal, ':': np.equal}
+
+# --- 解析查詢字串 → [(欄位或 None, 運算子, 值)] ---
+def parse_query(query):
+    terms = []
+    for token in str(query).split():
+        m = QUERY_TOKEN.match(token)
+        if m:
+            field, op, value = m.group('field'), m.group('op'), m.group('value')
+            if field in NUMBER_FIELDS:
+                try:
+                    terms.append((NUMBER_FIELDS[field], op, float(value))); continue
+                except ValueError:
+                    pass
+            elif field in TEXT_FIELDS and op == ':':
+                terms.append((TEXT_FIELDS[field], ':', value.lower())); continue
+        terms.append((None, ':', token.lower()))
+    return terms
+
+class SearchIndex:
+    def __init__(self, df):
+        self.index = df.index
+        self.text = {col: df[col].fillna('').astype(str).str.strip().str.lower().reset_index(drop=True)
+                     for col in set(TEXT_FIELDS.values())}
+        # 預先串好的全文欄位，一般關鍵字只掃這一欄
+        self.all_text = self.text[SEARCH_FIELDS[0]]
+        for col in SEARCH_FIELDS[1:]: self.all_text = self.all_text + '\x1f' + self.text[col]
+        self.numbers = {col: pd.to_numeric(df[col], errors='coerce').fillna(0).to_numpy(dtype=float)
+                        for col in set(NUMBER_FIELDS.values())}
+
+    # 回傳符合條件的庫存索引 (維持庫存原順序)
+    def search(self, query):
+        mask = np.ones(len(self.index), dtype=bool)
+        for field, op, value in parse_query(query):
+            if field is None:
+                mask &= self.all_text.str.contains(value, regex=False).to_numpy()
+            elif field in self.numbers:
+                mask &= COMPARE[op](self.numbers[field], value)
+            else:
+                mask &= self.text[field].str.contains(value, regex=False).to_numpy()
+        return self.index[mask]
+
+# --- 分頁：回傳該頁的索引與總頁數 ---
+def page_of(index, page, page_size):
+    pages = max(1, -(-len(index) // page_size))
+    page = min(max(1, page), pages)
+    return index[(page - 1) * page_size: page * page_size], pages
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+from archive import stock_report
+from schema import COLUMNS, HISTORY_COLUMNS, KEY_COLUMNS, type_inventory, type_history, concat_history
+from storage import INVENTORY, HISTORY
+
+# ==========================================
+# 欄式快照 (Arrow IPC / Parquet，不依賴 Streamlit)
+# 月底報表與營運分析改讀本機檔案：不跟同事搶 Sheets 讀取配額，也不必每次重新解析整份紀錄
+# 目錄結構 (root 底下)：
+#   inventory/2025-10/20251031-230000.arrow   每次匯出時庫存有變動就留一份 (依月份分資料夾)
+#   history/2025-10.arrow                     歷史紀錄依紀錄時間的月份分檔 (含已封存的月份)，內容沒變的月份不重寫
+#   latest.json                               最新一次匯出的清單 (最後才寫入，讀取端只認這個檔)
+# Arrow IPC (預設) 不壓縮，讀取時 memory-map，只有用到的欄與列會真的讀進記憶體；Parquet 給其他工具用
+# pyarrow 為選用套件：沒安裝時匯出與讀取回報錯誤，不影響其他功能
+# ==========================================
+
+SNAPSHOT_DIR = "columnar"
+EXPORT_INTERVAL = 3600 # 背景匯出間隔 (秒)；資料版本沒變時不做事
+FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
+MANIFEST = 'latest.json'
+KEEP_RECENT = 24 # 本月的庫存快照保留最近幾份；已結束的月份只留月底最後一份
+UNDATED = 'undated' # 紀錄時間看不懂的紀錄
+
+def has_pyarrow():
+    try:
+        import pyarrow # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("欄式快照需要安裝 pyarrow")
+    return pa, pq
+
+def _fingerprint(df):
+    return str(int(pd.util.hash_pandas_object(df, index=False).sum())) if len(df) else '0'
+
+# --- 寫到暫存檔再改名，讀取端不會讀到寫一半的檔案 ---
+def _write(df, path, fmt):
+    pa, pq = _pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    if fmt == 'parquet':
+        pq.write_table(table, tmp)
+    else:
+        with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+def _read(path, columns=None):
+    pa, pq = _pyarrow()
+    if path.endswith(FORMATS['parquet']): return pq.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return table.select(columns) if columns else table
+
+def read_manifest(root=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(root, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'inventory': [], 'history': {}}
+
+def _month_keys(history):
+    return history['紀錄時間'].dt.strftime('%Y-%m').fillna(UNDATED).values
+
+# ==========================================
+# 匯出：庫存與歷史紀錄都從本地資料庫拿 (store 的共用快照與封存表副本)
+# 已封存、又不在目前紀錄表裡的月份內容不會再變，匯出過就不再讀取
+# 本地還沒載入歷史紀錄時只匯出庫存、沿用上次匯出的月份 (不替匯出載入整張紀錄表，載入後同步程式每次都會重新拉取它)
+# ==========================================
+
+def export_snapshot(store, root=SNAPSHOT_DIR, fmt='arrow', now=None):
+    _pyarrow()
+    now = now or datetime.now()
+    ext = FORMATS[fmt]
+    manifest = read_manifest(root)
+    old_months = manifest['history'] if manifest.get('format') == fmt else {}
+    snapshots = [s for s in manifest['inventory'] if s['file'].endswith(ext)]
+
+    _, inv = store.snapshot(INVENTORY)
+    inv = inv[COLUMNS]
+    digest = _fingerprint(inv)
+    if not snapshots or snapshots[-1]['hash'] != digest:
+        file = f"inventory/{now:%Y-%m}/{now:%Y%m%d-%H%M%S}{ext}"
+        _write(inv, os.path.join(root, file), fmt)
+        snapshots.append({'time': now.strftime('%Y-%m-%d %H:%M:%S'), 'file': file, 'rows': len(inv), 'hash': digest})
+
+    months, written = _export_history(store, root, fmt, old_months) if store.is_loaded(HISTORY) else (old_months, 0)
+
+    manifest = {'exported_at': now.strftime('%Y-%m-%d %H:%M:%S'), 'format': fmt,
+                'inventory': _prune(root, snapshots, now), 'history': months}
+    tmp = os.path.join(root, MANIFEST + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, os.path.join(root, MANIFEST))
+    for m in set(old_months) - set(months):
+        _remove(os.path.join(root, old_months[m]['file']))
+    return {'inventory': snapshots[-1]['file'], 'months': len(months), 'written': written}
+
+def _export_history(store, root, fmt, old_months):
+    _, hot = store.snapshot(HISTORY)
+    hot = hot[HISTORY_COLUMNS]
+    hot_parts = dict(tuple(hot.groupby(_month_keys(hot), sort=False))) if len(hot) else {}
+    months, written = {}, 0
+    for m in sorted(set(store.archived_months) | set(hot_parts)):
+        frozen = m in store.archived_months and m not in hot_parts
+        entry = old_months.get(m)
+        if frozen and entry and entry['frozen']:
+            months[m] = entry; continue
+        parts = ([store.archived_history(m)] if m in store.archived_months else []) + ([hot_parts[m]] if m in hot_parts else [])
+        part = parts[0] if len(parts) == 1 else concat_history(parts)
+        digest = _fingerprint(part)
+        file = f"history/{m}{FORMATS[fmt]}"
+        if not entry or entry['hash'] != digest:
+            _write(part, os.path.join(root, file), fmt); written += 1
+        months[m] = {'file': file, 'rows': len(part), 'hash': digest, 'frozen': frozen}
+    return months, written
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# --- 已結束的月份只留最後一份庫存快照，本月留最近 KEEP_RECENT 份 ---
+def _prune(root, snapshots, now):
+    current = now.strftime('%Y-%m')
+    last_of = {s['time'][:7]: s for s in snapshots}
+    recent = [s for s in snapshots if s['time'][:7] == current][-KEEP_RECENT:]
+    keep = [s for s in snapshots if (s['time'][:7] != current and last_of[s['time'][:7]] is s) or s in recent]
+    for s in snapshots:
+        if s not in keep: _remove(os.path.join(root, s['file']))
+    return keep
+
+# --- 背景匯出：store 的資料版本或封存月份有變才匯出 ---
+class SnapshotExporter(threading.Thread):
+    def __init__(self, store, root=SNAPSHOT_DIR, interval=EXPORT_INTERVAL, fmt='arrow'):
+        super().__init__(daemon=True, name='columnar-export')
+        self.store, self.root, self.interval, self.fmt = store, root, interval, fmt
+        self.last_export = None
+        self.last_error = None
+        self._seen = None
+        self.lock = threading.Lock() # 背景與手動匯出不同時寫檔
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    # 回傳 export_snapshot 的結果，資料沒變時為 None
+    def export(self):
+        with self.lock:
+            seen = (self.store.versions[INVENTORY], self.store.versions[HISTORY], tuple(self.store.archived_months))
+            if seen == self._seen: return None
+            result = export_snapshot(self.store, self.root, self.fmt)
+            self._seen, self.last_export, self.last_error = seen, datetime.now(), None
+            return result
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:
+                self.last_error = str(e)
+
+# ==========================================
+# 讀取：只開需要的月份，Arrow IPC 直接 memory-map
+# ==========================================
+
+class SnapshotReader:
+    def __init__(self, root=SNAPSHOT_DIR):
+        _pyarrow()
+        self.root = root
+        self.manifest = read_manifest(root)
+        if not self.manifest['inventory']: raise ValueError(f"{root} 還沒有匯出過欄式快照")
+
+    @property
+    def exported_at(self):
+        return self.manifest['exported_at']
+
+    def months(self):
+        return sorted(m for m in self.manifest['history'] if m != UNDATED)
+
+    # --- at ('YYYY-MM-DD HH:MM:SS') 以前最後一份庫存快照，省略時為最新一份；回傳 (快照時間, DataFrame) ---
+    def inventory(self, at=None, columns=None):
+        snaps = [s for s in self.manifest['inventory'] if at is None or s['time'] <= at]
+        if not snaps: raise ValueError(f"{at} 以前沒有庫存快照")
+        df = _read(os.path.join(self.root, snaps[-1]['file']), columns).to_pandas()
+        return snaps[-1]['time'], type_inventory(df) if columns is None else df
+
+    # --- start <= 紀錄時間 < end 的紀錄 (pyarrow Table)；start/end 為 datetime 或 None ---
+    # 只開範圍內的月份，時間條件在 Arrow 上篩選，轉成 pandas 前不複製整個月
+    def history_table(self, start=None, end=None, columns=None):
+        pa, _ = _pyarrow()
+        import pyarrow.compute as pc
+        lo = start.strftime('%Y-%m') if start else None
+        hi = end.strftime('%Y-%m') if end else None
+        months = [m for m in self.months() if (lo is None or m >= lo) and (hi is None or m <= hi)]
+        if start is None and end is None and UNDATED in self.manifest['history']: months.append(UNDATED)
+        need = None if columns is None else list(dict.fromkeys(list(columns) + ['紀錄時間']))
+        tables = []
+        for m in months:
+            table = _read(os.path.join(self.root, self.manifest['history'][m]['file']), need)
+            t = table['紀錄時間']
+            mask = None
+            if start is not None: mask = pc.greater_equal(t, pa.scalar(start, t.type))
+            if end is not None:
+                below = pc.less(t, pa.scalar(end, t.type))
+                mask = below if mask is None else pc.and_(mask, below)
+            tables.append(table if mask is None else table.filter(mask))
+        if not tables: return None
+        table = pa.concat_tables(tables, promote_options='permissive')
+        return table.select(columns) if columns else table
+
+    def history(self, start=None, end=None, columns=None):
+        table = self.history_table(start, end, columns)
+        if table is None: return type_history(pd.DataFrame(columns=HISTORY_COLUMNS))
+        df = table.to_pandas()
+        return type_history(df) if columns is None else df
+
+    # --- 給 LocalStore.history_since：已封存、匯出時也不在紀錄表裡的月份 (內容不會再變) ---
+    def frozen_history(self, months):
+        parts = {}
+        for m in months:
+            entry = self.manifest['history'].get(m)
+            if entry and entry['frozen']:
+                parts[m] = type_history(_read(os.path.join(self.root, entry['file'])).to_pandas())
+        return parts
+
+# ==========================================
+# 月底報表 (命令列)：月底最後一份庫存快照的庫存金額，加上當月進出數量
+# python columnar.py report 2025-10 [--root columnar] [--out report.csv]
+# ==========================================
+
+def month_report(reader, month):
+    period = pd.Period(month, freq='M')
+    taken_at, inv = reader.inventory(period.end_time.strftime('%Y-%m-%d %H:%M:%S'))
+    report = stock_report(inv[['編號', '批號', '倉庫', '庫存(顆)', '成本單價']].astype({'編號': str, '批號': str}), inv)
+    moves = reader.history(period.start_time.to_pydatetime(), (period + 1).start_time.to_pydatetime(),
+                           columns=['編號', '批號', '數量變動'])
+    qty = pd.to_numeric(moves['數量變動'], errors='coerce').fillna(0)
+    flow = pd.DataFrame({'編號': moves['編號'].astype(str).values, '批號': moves['批號'].astype(str).values,
+                         '當月進貨': qty.clip(lower=0).values, '當月領出': (-qty.clip(upper=0)).values})
+    flow = flow.groupby(KEY_COLUMNS, as_index=False)[['當月進貨', '當月領出']].sum()
+    report = report.merge(flow, on=KEY_COLUMNS, how='left').fillna({'當月進貨': 0, '當月領出': 0})
+    return taken_at, report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="欄式快照報表")
+    parser.add_argument('--root', default=SNAPSHOT_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('report', help="月底庫存報表 (CSV)")
+    p.add_argument('month', help="YYYY-MM")
+    p.add_argument('--out', default='-')
+    sub.add_parser('info', help="最新一次匯出的內容")
+    args = parser.parse_args(argv)
+
+    reader = SnapshotReader(args.root)
+    if args.command == 'info':
+        m = reader.manifest
+        print(json.dumps({'exported_at': m['exported_at'], 'format': m['format'],
+                          'inventory': [s['time'] for s in m['inventory']],
+                          'history': {k: v['rows'] for k, v in m['history'].items()}}, ensure_ascii=False, indent=2))
+        return 0
+    taken_at, report = month_report(reader, args.month)
+    print(f"庫存快照時間: {taken_at}", file=sys.stderr)
+    report.to_csv(sys.stdout if args.out == '-' else args.out, index=False, encoding='utf-8-sig')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from catalog import format_sizes
+from schema import HISTORY_COLUMNS, KEY_COLUMNS, set_cells
+
+# ==========================================
+# 庫存異動運算 (不依賴 Streamlit)
+# ==========================================
+
+# --- 設計單：所有品項一次用 (編號, 批號) 對回庫存列 ---
+# 回傳與 cart 同順序的表，_row 為庫存索引 (找不到為 NaN)
+def resolve_cart(inventory, cart):
+    cart_df = pd.DataFrame(cart)
+    if cart_df.empty: return cart_df.assign(_row=pd.Series(dtype=float))
+    for col in ['倉庫', '分類', '規格', '廠商']:
+        if col not in cart_df.columns: cart_df[col] = ''
+    cart_df[KEY_COLUMNS] = cart_df[KEY_COLUMNS].astype(str)
+
+    inv = inventory[KEY_COLUMNS].astype(str).assign(_row=inventory.index)
+    # 重複的 (編號, 批號) 取第一筆
+    inv = inv.drop_duplicates(subset=KEY_COLUMNS, keep='first')
+    resolved = cart_df.merge(inv, on=KEY_COLUMNS, how='left')
+
+    found = resolved['_row'].notna()
+    rows = resolved.loc[found, '_row'].astype(inventory.index.dtype)
+    resolved['成本單價'] = np.nan
+    resolved.loc[found, '成本單價'] = pd.to_numeric(inventory.loc[rows, '成本單價'], errors='coerce').fillna(0).values
+    return resolved
+
+# --- 預估成本 (只算找得到的品項) ---
+def cart_cost(resolved):
+    if resolved.empty: return 0.0
+    return float((resolved['成本單價'].fillna(0) * resolved['數量']).sum())
+
+# --- 設計單領出：一次扣庫存並產生全部紀錄 (inventory 直接修改) ---
+def apply_checkout(inventory, resolved, order_id, note, timestamp):
+    lines = resolved[resolved['_row'].notna()].copy() if not resolved.empty else resolved
+    if lines.empty: return []
+    rows = lines['_row'].astype(inventory.index.dtype)
+    qty = lines['數量'].astype(int)
+
+    dec = qty.groupby(rows.values).sum()
+    stock = inventory['庫存(顆)']
+    inventory.loc[dec.index, '庫存(顆)'] = (stock.loc[dec.index] - dec.values).astype(stock.dtype)
+
+    # 清單上沒帶的倉庫/分類/規格/廠商，從庫存補上
+    src = inventory.loc[rows]
+    fill = {'倉庫': src['倉庫'], '分類': src['分類'], '規格': format_sizes(src), '廠商': src['進貨廠商']}
+    for col, fallback in fill.items():
+        own = lines[col].fillna('').astype(str)
+        lines[col] = np.where(own != '', own, fallback.astype(str).values)
+
+    unit = lines['成本單價'].astype(float).values
+    cost_log = ('成本$' + pd.Series(np.char.mod('%.2f', unit * qty.values), index=lines.index)
+                + ' (單$' + np.char.mod('%.2f', unit) + ')')
+    note = note.strip() if note else ''
+    lines['成本備註'] = (note + ' | ' + cost_log) if note else cost_log
+
+    lines['紀錄時間'] = timestamp
+    lines['單號'] = order_id
+    lines['動作'] = '設計單領出'
+    lines['數量變動'] = -qty
+    return lines[HISTORY_COLUMNS].to_dict('records')
+
+# ==========================================
+# 單品異動 (🔄 補貨 / 📦 新批號 / 📤 領用)：回傳要寫入的歷史紀錄
+# ==========================================
+
+# --- 單列的規格字串 ---
+def _spec(row):
+    return format_sizes(pd.DataFrame([row])).iloc[0]
+
+def _log(row, timestamp, order_id, action, batch, qty, note):
+    return {'紀錄時間': timestamp, '單號': order_id, '動作': action, '倉庫': row['倉庫'], '批號': batch,
+            '編號': row['編號'], '分類': row['分類'], '名稱': row['名稱'], '規格': _spec(row),
+            '廠商': row['進貨廠商'], '數量變動': qty, '成本備註': note}
+
+# --- 補貨合併：庫存增加，成本單價改為這次的單價 (總成本 / 數量，四捨五入到小數兩位) ---
+def apply_restock(inventory, idx, qty, total_cost, timestamp):
+    unit = total_cost / qty if qty > 0 else 0
+    inventory.at[idx, '庫存(顆)'] += qty
+    inventory.at[idx, '成本單價'] = round(unit, 2)
+    row = inventory.loc[idx]
+    return _log(row, timestamp, 'IN', f"補貨(總${total_cost:.2f})", row['批號'], qty,
+                f"總${total_cost:.2f} (單${unit:.2f})")
+
+# --- 同編號已經用掉的批號 ---
+def batches_of(inventory, sku):
+    return set(inventory.loc[inventory['編號'].astype(str) == str(sku), '批號'].astype(str))
+
+# --- 新批號的預設值：YYYYMMDD-A、-B…，跳過同編號已經有的 ---
+def next_batch(inventory, sku, day):
+    taken, prefix = batches_of(inventory, sku), day.strftime('%Y%m%d')
+    for n in itertools.count():
+        batch = f"{prefix}-{chr(ord('A') + n) if n < 26 else n + 1}"
+        if batch not in taken: return batch
+
+# --- 補貨新批號：複製 idx 那一列成新的一列；批號已存在時丟出 ValueError；回傳 (新庫存列, 紀錄) ---
+def new_batch_row(inventory, idx, batch, qty, total_cost, timestamp, today):
+    row = inventory.loc[idx]
+    if str(batch) in batches_of(inventory, row['編號']): raise ValueError(f"{row['編號']}/{batch} 已存在")
+    unit = total_cost / qty if qty > 0 else 0
+    new_row = row.copy()
+    new_row['庫存(顆)'] = int(qty)
+    new_row['進貨數量(顆)'] = int(qty)
+    new_row['進貨日期'] = today
+    new_row['批號'] = batch
+    new_row['成本單價'] = round(unit, 2)
+    return new_row, _log(row, timestamp, 'IN', f"補貨新批(總${total_cost:.2f})", batch, qty,
+                         f"總${total_cost:.2f} (單${unit:.2f})")
+
+# --- 單品出庫 ---
+def apply_withdraw(inventory, idx, qty, reason, note, timestamp):
+    inventory.at[idx, '庫存(顆)'] -= qty
+    row = inventory.loc[idx]
+    return _log(row, timestamp, 'OUT', f"出庫-{reason}", row['批號'], -qty, note)
+
+# ==========================================
+# 維護：(編號, 批號) 重複的列 (舊資料或早期版本留下的)，第一列以外的批號改成 批號-2、批號-3…
+# inventory 直接修改；回傳紀錄 (數量變動 0，成本備註寫原批號)
+# ==========================================
+
+def rename_duplicate_batches(inventory, timestamp):
+    keys = inventory[KEY_COLUMNS].astype(str)
+    logs = []
+    for idx in inventory.index[keys.duplicated(keep='first').values]:
+        sku, batch = keys.at[idx, '編號'], keys.at[idx, '批號']
+        taken = batches_of(inventory, sku)
+        new_batch = next(f"{batch}-{n}" for n in itertools.count(2) if f"{batch}-{n}" not in taken)
+        set_cells(inventory, idx, {'批號': new_batch})
+        logs.append(_log(inventory.loc[idx], timestamp, 'FIX', '修正重複批號', new_batch, 0, f"原批號 {batch}"))
+    return logs
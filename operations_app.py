@@ -1,31 +1,34 @@
 import streamlit as st
 import pandas as pd
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import time
-import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import numpy as np # 引入 numpy 處理 nan
+import uuid
+import functools
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from schema import COLUMNS, KEY_COLUMNS, type_inventory, set_cells
+from catalog import ProductPicker, SearchIndex, FACET_COLUMNS, page_of, format_sizes
+from inventory_ops import (resolve_cart, cart_cost, apply_checkout, apply_restock, new_batch_row, next_batch, apply_withdraw,
+                           rename_duplicate_batches)
+from analytics import Analytics, purchase_suggestions
+from bulk_import import read_upload, template_csv, plan_import, apply_merges
+from archive import stock_report
+from storage import INVENTORY, HISTORY, LocalStore, StaleDataError, SyncWorker
+from sheets import SHEET_ID, KEY_FILE, SCOPE, SheetConnection, key_file_credentials
+from columnar import SNAPSHOT_DIR, SnapshotExporter, SnapshotReader, has_pyarrow
+from profiling import Profiler, QUOTA_PER_MINUTE
 
 # ==========================================
 # 1. 核心設定
 # ==========================================
 
-SHEET_ID = "1gf-pn034w0oZx8jWDUJvmIyHX_O7eHbiBb9diVSBX0Q"
-KEY_FILE = "google_key.json"
-
-# 庫存表欄位 (順序必須與 Google Sheet 完全一致)
-COLUMNS = [
-    '編號', '批號', '倉庫', '分類', '名稱', 
-    '寬度mm', '長度mm', '形狀', '五行', 
-    '進貨數量(顆)', '進貨日期', '進貨廠商', 
-    '庫存(顆)', '成本單價'
-]
-
-# 歷史紀錄欄位
-HISTORY_COLUMNS = [
-    '紀錄時間', '單號', '動作', '倉庫', '批號', '編號', '分類', '名稱', '規格', 
-    '廠商', '數量變動', '成本備註'
-]
+LOCAL_DB = "if_local.db"
+PROFILE_LOG = "profile.jsonl" # 效能紀錄匯出檔
+TABLE_PAGE_SIZE = 50 # 庫存總表每頁筆數
+HISTORY_PAGE_SIZE = 100 # 紀錄查詢每頁筆數
+ARCHIVE_KEEP_MONTHS = 3 # 歷史紀錄表預設保留最近幾個月 (含本月)，更早的封存
+RETIRE_AFTER_DAYS = 180 # 庫存為 0 且進貨超過幾天的批號預設可歸檔
 
 DEFAULT_WAREHOUSES = ["Imeng", "千畇"]
 DEFAULT_SUPPLIERS = ["小聰頭", "廠商A", "廠商B", "自用", "蝦皮", "淘寶", "TB-東吳天然石坊", "永安", "Rich"]
@@ -36,113 +39,124 @@ DEFAULT_ELEMENTS = ["金", "木", "水", "火", "土", "綜合", "銀", "銅", "
 # 2. Google Sheets 連線與資料處理
 # ==========================================
 
-def get_google_sheet_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# --- 效能紀錄 (整個程序共用；側欄管理員面板顯示) ---
+@st.cache_resource(show_spinner=False)
+def get_profiler():
+    return Profiler()
+
+# 雲端憑證：部署時放在 st.secrets，本機開發用 google_key.json
+def _credentials():
     try:
         if "gcp_service_account" in st.secrets:
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        else:
-            creds = ServiceAccountCredentials.from_json_keyfile_name(KEY_FILE, scope)
+            return ServiceAccountCredentials.from_json_keyfile_dict(dict(st.secrets["gcp_service_account"]), SCOPE)
     except:
-        creds = ServiceAccountCredentials.from_json_keyfile_name(KEY_FILE, scope)
-    client = gspread.authorize(creds)
-    return client
-
-# --- 讀取庫存 (Sheet1) ---
-def load_inventory_from_gsheet():
+        pass
+    return key_file_credentials(KEY_FILE)
+
+# 整個程序共用一組連線；每個 HTTP 請求都記流量與配額
+@st.cache_resource(show_spinner=False)
+def get_sheet_connection():
+    return SheetConnection(_credentials, SHEET_ID,
+                           on_client=lambda client: get_profiler().watch_session(client.http_client.session))
+
+# --- 本地資料庫 + 背景同步 (整個程序共用一份) ---
+@st.cache_resource(show_spinner=False)
+def get_store():
+    store = LocalStore(LOCAL_DB, get_sheet_connection().adapter(profiler=get_profiler()))
+    SyncWorker(store).start()
+    return store
+
+# --- 欄式快照 (需要 pyarrow)：背景定期把庫存與歷史紀錄匯出成本機檔案，沒安裝時為 None ---
+@st.cache_resource(show_spinner=False)
+def get_exporter():
+    if not has_pyarrow(): return None
+    exporter = SnapshotExporter(get_store(), SNAPSHOT_DIR)
+    exporter.start()
+    return exporter
+
+# 營運分析讀已封存月份時先用匯出過的檔案，不必從雲端讀封存表
+def frozen_history():
+    if not has_pyarrow(): return None
     try:
-        client = get_google_sheet_client()
-        sheet = client.open_by_key(SHEET_ID).sheet1
-        data = sheet.get_all_records()
-        if not data: return pd.DataFrame(columns=COLUMNS)
-        
-        df = pd.DataFrame(data)
-        df.columns = df.columns.astype(str).str.strip().str.replace('\ufeff', '')
-        
-        if 'label' in df.columns: df = df.drop(columns=['label'])
-        if '批號' not in df.columns: df['批號'] = '初始存貨'
-        if '倉庫' not in df.columns: df.insert(1, '倉庫', 'Imeng')
-        for col in COLUMNS:
-            if col not in df.columns: df[col] = ""
-            
-        df = df[COLUMNS].copy().fillna("")
-        # 讀取時清理名稱空白
-        df['名稱'] = df['名稱'].astype(str).str.strip()
-        
-        for col in ['寬度mm', '長度mm', '進貨數量(顆)', '庫存(顆)', '成本單價']:
-            df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-            
-        return df
-    except Exception as e:
-        st.error(f"❌ 無法讀取庫存表: {e}"); return pd.DataFrame(columns=COLUMNS)
+        return SnapshotReader(SNAPSHOT_DIR).frozen_history
+    except ValueError:
+        return None
 
-# --- 讀取歷史紀錄 (History) ---
-def load_history_from_gsheet():
+# --- 讀取庫存：所有 session 共用同一份快照，不各自複製 (第一次啟動時從 Sheet1 拉取) ---
+# session 只存參考；st.session_state['inventory_synced'] 是存檔時比對差異的基準
+def load_inventory_from_gsheet():
     try:
-        client = get_google_sheet_client()
-        try:
-            sheet = client.open_by_key(SHEET_ID).worksheet("History")
-        except:
-            return pd.DataFrame(columns=HISTORY_COLUMNS)
-        data = sheet.get_all_records()
-        if not data: return pd.DataFrame(columns=HISTORY_COLUMNS)
-        df = pd.DataFrame(data)
-        for col in HISTORY_COLUMNS:
-            if col not in df.columns: df[col] = ""
-        return df[HISTORY_COLUMNS].copy()
+        with get_profiler().span("載入庫存快照"): version, df = get_store().snapshot(INVENTORY)
     except Exception as e:
-        st.error(f"❌ 無法讀取歷史紀錄: {e}"); return pd.DataFrame(columns=HISTORY_COLUMNS)
-
-# --- v9.12 強化: 安全追加單行資料 (處理 nan 與 小數點) ---
-def append_inventory_row(new_row_dict):
+        st.error(f"❌ 無法讀取庫存表: {e}"); version, df = None, type_inventory(pd.DataFrame(columns=COLUMNS))
+    st.session_state['inventory_version'] = version
+    st.session_state['inventory'] = st.session_state['inventory_synced'] = df
+
+# --- 要修改庫存前先取得自己的副本 (copy-on-write，共用快照不可直接改) ---
+def edit_inventory():
+    if st.session_state['inventory'] is st.session_state['inventory_synced']:
+        st.session_state['inventory'] = st.session_state['inventory'].copy()
+    return st.session_state['inventory']
+
+# --- 記下本 session 送出的寫入，側欄顯示同步狀態 ---
+def _track_write(what, ticket):
+    if ticket: st.session_state.setdefault('write_tickets', []).append((what, ticket))
+
+# --- 提交：庫存修改 (df)、新增列 (new_rows) 與歷史紀錄 (logs) 排成同一筆雲端寫入 ---
+# 雲端一個 batch_update 全部生效或全部不生效；雲端版本比本地新時整筆退回 (側欄會顯示)
+# 庫存只送出與上次同步之間有變動的儲存格；新增列 v9.12：nan 轉空字串、整數不帶小數點
+def commit_changes(df=None, new_rows=None, logs=None, what="庫存更新"):
     try:
-        client = get_google_sheet_client()
-        sheet = client.open_by_key(SHEET_ID).sheet1
-        
-        # 準備要寫入的資料列表
-        row_values = []
-        for col in COLUMNS:
-            val = new_row_dict.get(col, "")
-            
-            # 特殊處理：如果是 nan 或 None，轉為 0 或空字串
-            if pd.isna(val) or str(val).lower() == 'nan':
-                if col in ['進貨數量(顆)', '庫存(顆)', '成本單價', '寬度mm', '長度mm']:
-                    val = 0
-                else:
-                    val = ""
-            
-            row_values.append(str(val))
-
-        # 直接追加到最後一行
-        sheet.append_row(row_values)
-        st.toast("✅ 新資料已安全寫入雲端 (精準修正版)")
+        new_df = pd.DataFrame(new_rows)[COLUMNS] if new_rows else None
+        with get_profiler().span("本地提交"):
+            _, ticket = get_store().commit(df, st.session_state['inventory_synced'] if df is not None else None,
+                                           new_df, logs, st.session_state['inventory_version'])
+        _track_write(what, ticket)
+        load_inventory_from_gsheet()
+        st.toast("☁️ 已儲存 (背景同步雲端)")
         return True
+    except StaleDataError as e:
+        # 畫面上的庫存已過時：這次的修改不寫入，換成本地最新內容讓使用者重做
+        st.error(f"❌ 存檔失敗: {e}")
+        load_inventory_from_gsheet()
+        return False
     except Exception as e:
-        st.error(f"❌ 新增資料失敗: {e}")
+        st.error(f"❌ 存檔失敗: {e}")
         return False
 
-# --- 存檔：庫存 (整頁更新) ---
-def save_inventory_to_gsheet(df):
-    try:
-        client = get_google_sheet_client()
-        sheet = client.open_by_key(SHEET_ID).sheet1
-        sheet.clear()
-        update_data = [df.columns.values.tolist()] + df.astype(str).values.tolist()
-        sheet.update(range_name='A1', values=update_data)
-        st.toast("☁️ 庫存更新成功！")
-    except Exception as e: 
-        st.error(f"❌ 庫存存檔失敗: {e}"); st.stop()
-
-# --- 存檔：歷史紀錄 ---
-def save_history_to_gsheet(df):
+# --- 維護：(編號, 批號) 重複的列改成不重複的批號 (一般的儲存格修改，送出方式同其他存檔) ---
+def fix_duplicate_batches():
+    inv = edit_inventory()
+    logs = rename_duplicate_batches(inv, datetime.now().strftime("%Y-%m-%d %H:%M"))
+    if logs and commit_changes(inv, logs=logs, what="修正重複批號"): st.toast(f"🔧 已修正 {len(logs)} 列重複批號")
+
+# --- 維護：用本地資料整頁重寫雲端 (僅供管理員手動執行) ---
+def rewrite_sheet(table):
+    _track_write("整頁重寫", get_store().rewrite_remote(table))
+    st.toast("☁️ 已排入整頁重寫")
+
+# --- 維護：最近 keep_months 個月以前的紀錄搬到各月封存表 (同時留一份庫存快照) ---
+def archive_old_history(keep_months):
+    keep_from = (pd.Timestamp(date.today()).to_period('M') - (keep_months - 1)).strftime('%Y-%m')
+    n, ticket = get_store().archive_history(keep_from)
+    _track_write(f"封存 {keep_from} 以前的紀錄", ticket)
+    st.toast(f"🗄️ 已封存 {n} 筆紀錄" if n else "沒有可封存的紀錄")
+
+# --- 維護：立刻匯出一次欄式快照 (平常由背景定期匯出) ---
+def export_columnar():
     try:
-        client = get_google_sheet_client()
-        sheet = client.open_by_key(SHEET_ID).worksheet("History")
-        sheet.clear()
-        update_data = [df.columns.values.tolist()] + df.astype(str).values.tolist()
-        sheet.update(range_name='A1', values=update_data)
-    except Exception as e: st.error(f"❌ 歷史紀錄存檔失敗: {e}")
+        result = get_exporter().export()
+    except Exception as e:
+        st.error(f"❌ 匯出失敗: {e}"); return
+    st.toast(f"📤 已匯出 {result['months']} 個月的紀錄 (重寫 {result['written']} 個月)" if result else "資料沒有變動，不必匯出")
+
+# --- 維護：庫存為 0 且進貨超過 days 天的批號搬到已歸檔批號表 (成本單價一起保留) ---
+def retire_empty_batches(days):
+    today = date.today()
+    n, ticket = get_store().archive_batches(today - timedelta(days=days), today.isoformat())
+    _track_write(f"歸檔 {n} 個空批號", ticket)
+    load_inventory_from_gsheet()
+    st.toast(f"📦 已歸檔 {n} 個空批號" if n else "沒有可歸檔的批號")
 
 # ==========================================
 # 3. 顯示與輔助函式
@@ -156,26 +170,63 @@ def format_size(row):
         return "0mm"
     except: return "0mm"
 
-def make_inventory_label(row):
-    sz = format_size(row)
-    stock_val = int(float(row.get('庫存(顆)', 0)))
-    elem = str(row.get('五行', '')).strip()
-    elem_display = f"({elem}) " if elem else ""
-    batch = str(row.get('批號', '')).strip()
-    
-    cost_str = ""
-    if st.session_state.get('admin_mode', False):
-        cost = float(row.get('成本單價', 0))
-        if cost > 0: cost_str = f" 💰${cost:.2f}"
-
-    return f"[{row.get('倉庫','Imeng')}] {elem_display}{row.get('名稱','')} {sz} ({row.get('形狀','')}) {cost_str} 【{batch}】 | 存:{stock_val}"
+# --- 依共用快照版本快取的索引：所有 session 共用，variant 區分不同版本 (例如管理員/訪客) ---
+@st.cache_resource(show_spinner=False)
+def _shared_index_cache():
+    return {}
+
+def _inventory_cached(name, variant, build):
+    cache = _shared_index_cache()
+    key = (name, st.session_state['inventory_version'], variant)
+    if key not in cache:
+        for k in [k for k in list(cache) if k[0] == name and k[2] == variant]: cache.pop(k, None)
+        with get_profiler().span(name): cache[key] = build()
+    return cache[key]
+
+# --- 商品挑選器索引 (管理員/訪客各一份，成本字樣不同) ---
+def get_picker():
+    admin = st.session_state.get('admin_mode', False)
+    return _inventory_cached('picker', admin, lambda: ProductPicker(st.session_state['inventory'], admin))
+
+# --- 商品挑選：名稱搜尋 + 篩選，選單只送出前幾筆符合的商品 ---
+# 選項是 (編號, 批號)，回傳對應的庫存索引；沒有符合的商品時回傳 None
+def pick_product(key, label, in_stock=False):
+    picker = get_picker()
+    c_q, c_stock = st.columns([4, 1])
+    query = c_q.text_input("🔍 名稱 / 編號 / 批號", key=f"{key}_q", placeholder="名稱可只打部分字或依序的幾個字，例如 粉晶")
+    only_stock = c_stock.checkbox("只看有庫存", in_stock, key=f"{key}_stock")
+    with st.expander("篩選"):
+        cols = st.columns(len(FACET_COLUMNS))
+        facets = {col: c.multiselect(col, picker.options(col), key=f"{key}_{col}") for col, c in zip(FACET_COLUMNS, cols)}
+        lo, hi = picker.width_range()
+        # 寬度範圍隨庫存改變時換一個新的拉桿 (舊的值可能超出範圍)
+        width = st.slider("寬度 (mm)", lo, hi, (lo, hi), key=f"{key}_width_{lo}_{hi}") if hi > lo else None
+    with get_profiler().span("商品挑選"):
+        keys, total = picker.search(query, facets, width, only_stock)
+    if not keys:
+        st.info("沒有符合的商品"); return None
+    if total > len(keys): st.caption(f"符合 {total} 筆，只列出最接近的 {len(keys)} 筆，請再輸入關鍵字或篩選")
+    choice = st.selectbox(label, keys, format_func=picker.label_of.get, key=key)
+    return picker.index_of[choice]
+
+# --- 庫存總表搜尋索引 ---
+def get_search_index():
+    return _inventory_cached('search_index', None, lambda: SearchIndex(st.session_state['inventory']))
+
+# --- 營運分析的累計結果 (整個程序共用，新紀錄進來時只併入新的列) ---
+@st.cache_resource(show_spinner=False)
+def get_analytics():
+    return Analytics()
+
+# --- 選單選項 (依快照版本快取，區塊重跑時不重算) ---
+def _column_values(col):
+    def build():
+        raw = pd.Series(st.session_state['inventory'][col].astype(str).unique()).str.strip()
+        return set(raw[(raw != '') & (raw.str.lower() != 'nan')])
+    return _inventory_cached('values', col, build)
 
 def get_dynamic_options(col, defaults):
-    opts = set(defaults)
-    if not st.session_state['inventory'].empty:
-        raw = st.session_state['inventory'][col].astype(str).tolist()
-        opts.update([x.strip() for x in raw if x.strip() and x.lower() != 'nan'])
-    return ["➕ 手動輸入"] + sorted(list(opts))
+    return ["➕ 手動輸入"] + sorted(set(defaults) | _column_values(col))
 
 # ==========================================
 # 4. 初始化與 UI
@@ -183,13 +234,15 @@ def get_dynamic_options(col, defaults):
 
 st.set_page_config(page_title="IF Crystal 全雲端系統", layout="wide")
 
-if 'inventory' not in st.session_state:
-    with st.spinner('連線雲端資料庫 (Inventory)...'):
-        st.session_state['inventory'] = load_inventory_from_gsheet()
+# 這次重跑的效能紀錄從這裡開始 (頁面名稱選好後補上)
+profiler = get_profiler()
+if 'profile_session' not in st.session_state: st.session_state['profile_session'] = uuid.uuid4().hex[:8]
+profiler.begin_run(st.session_state['profile_session'])
 
-if 'history' not in st.session_state:
-    with st.spinner('連線雲端紀錄 (History)...'):
-        st.session_state['history'] = load_history_from_gsheet()
+store = get_store()
+exporter = get_exporter()
+# 每次重跑都換成最新的共用快照 (其他 session 寫入或拉到雲端修改都會產生新版本)
+with st.spinner('連線雲端資料庫...'): load_inventory_from_gsheet()
 
 if 'admin_mode' not in st.session_state: st.session_state['admin_mode'] = False
 if 'current_design' not in st.session_state: st.session_state['current_design'] = []
@@ -207,251 +260,340 @@ with st.sidebar:
         st.success("🔓 管理員模式")
         df_inv = st.session_state['inventory']
         if not df_inv.empty:
-            total_cost = (df_inv['庫存(顆)'] * df_inv['成本單價']).sum()
+            total_cost = _inventory_cached('total_cost', None, lambda: (df_inv['庫存(顆)'] * df_inv['成本單價']).sum())
             st.metric("💰 庫存總資產", f"${total_cost:,.2f}")
+        with st.expander("🧰 維護工具"):
+            st.caption("平常只送出有變動的資料，必要時才整頁重寫")
+            if st.button("♻️ 重寫庫存表"): rewrite_sheet(INVENTORY)
+            if st.button("♻️ 重寫歷史紀錄表"): rewrite_sheet(HISTORY)
+            dupes = _inventory_cached('duplicate_keys', None, lambda: int(df_inv.duplicated(KEY_COLUMNS).sum()))
+            if dupes and st.button(f"🔧 修正重複批號 ({dupes} 列)"): fix_duplicate_batches()
+            keep = st.number_input("歷史紀錄表保留最近幾個月", 1, 24, ARCHIVE_KEEP_MONTHS)
+            if st.button("🗄️ 封存舊紀錄"): archive_old_history(keep)
+            months = store.archived_months
+            st.caption(f"🗄️ 已封存 {len(months)} 個月" + (f" ({months[0]} ~ {months[-1]})" if months else ""))
+            retire_days = st.number_input("庫存為 0 且進貨超過幾天的批號歸檔", 30, 3650, RETIRE_AFTER_DAYS, step=30)
+            if st.button("📦 歸檔空批號"): retire_empty_batches(retire_days)
+            st.caption("進貨日期空白的批號不會歸檔；歸檔後可在「🛠️ 修改」查看")
+            if exporter is None:
+                st.caption("📤 安裝 pyarrow 後會定期匯出欄式快照，月底報表不必讀雲端")
+            else:
+                if st.button("📤 匯出欄式快照"): export_columnar()
+                last = exporter.last_export.strftime('%m-%d %H:%M') if exporter.last_export else "尚未匯出"
+                st.caption(f"📤 上次匯出：{last} ({SNAPSHOT_DIR}/)" + (f" ⚠️ {exporter.last_error}" if exporter.last_error else ""))
+        # 效能紀錄：上一次完整重跑、最近一分鐘配額、各項目耗時百分位數
+        with st.expander("⏱️ 效能紀錄"):
+            runs = profiler.recent_runs(st.session_state['profile_session'])
+            if not runs.empty:
+                last = runs.iloc[0]
+                p1, p2 = st.columns(2)
+                p1.metric("上次重跑", f"{last['總耗時 ms']:,.0f} ms", f"雲端 {last['雲端 ms']:,.0f} ms", delta_color="off")
+                p2.metric("雲端請求", f"{last['讀取請求'] + last['寫入請求']:.0f}",
+                          f"{last['收到 KB']:,.1f} KB 收 / {last['送出 KB']:,.1f} KB 送", delta_color="off")
+            quota = profiler.quota_last_minute()
+            st.caption(f"最近一分鐘配額：讀取 {quota['reads']}/{QUOTA_PER_MINUTE} · 寫入 {quota['writes']}/{QUOTA_PER_MINUTE} (含背景同步)")
+            st.dataframe(profiler.percentiles(), hide_index=True, use_container_width=True)
+            st.dataframe(runs, hide_index=True, use_container_width=True)
+            if st.button("💾 匯出 JSONL"): st.toast(f"已寫入 {profiler.dump(PROFILE_LOG)} 筆到 {PROFILE_LOG}")
+        # 從雲端載入時檢查到的資料問題
+        for table, title in [(INVENTORY, "庫存表"), (HISTORY, "歷史紀錄")]:
+            for issue in store.issues.get(table, []): st.caption(f"⚠️ {title} {issue}")
     else:
         st.info("🔒 訪客模式")
 
+    pending = store.pending_count()
+    if store.last_error: st.warning(f"⚠️ 雲端同步失敗，{pending} 筆待重試: {store.last_error}")
+    elif pending: st.caption(f"☁️ 背景同步中 ({pending} 筆)")
+    # 本 session 送出的寫入：已同步的就不再顯示
+    my_writes = st.session_state.get('write_tickets', [])
+    if my_writes:
+        status = store.write_status([t for _, t in my_writes])
+        my_writes = [(what, t) for what, t in my_writes if status[t][0] != 'done']
+        st.session_state['write_tickets'] = my_writes
+        for what, t in my_writes:
+            state, attempts, err = status[t]
+            if state == 'rejected': st.error(f"⛔ {what} 未寫入: {err}，請重新操作")
+            elif state == 'retrying': st.caption(f"🔁 {what} 重試中 (第 {attempts} 次): {err}")
+            else: st.caption(f"⏳ {what} 等待同步")
+        # 被退回的寫入一直顯示到使用者確認
+        if any(status[t][0] == 'rejected' for _, t in my_writes) and st.button("知道了"):
+            st.session_state['write_tickets'] = [(what, t) for what, t in my_writes if status[t][0] != 'rejected']
+            st.rerun()
+
     st.divider()
-    page = st.radio("功能前往", ["📦 庫存與進貨", "📜 紀錄查詢", "🧮 領料與設計單"])
+    pages = ["📦 庫存與進貨", "📜 紀錄查詢", "🧮 領料與設計單"]
+    if st.session_state['admin_mode']: pages.append("📈 營運分析")
+    page = st.radio("功能前往", pages)
+    profiler.name_run(page)
     st.divider()
     if st.button("🔄 強制重整"): st.session_state.clear(); st.rerun()
 
-# ------------------------------------------
-# 頁面 A: 庫存管理
-# ------------------------------------------
-if page == "📦 庫存與進貨":
-    tab1, tab2, tab4, tab3 = st.tabs(["🔄 補貨", "✨ 建檔", "📤 領用", "🛠️ 修改"])
-    
-    with tab1: # 補貨
-        if not st.session_state['inventory'].empty:
-            inv_sorted = st.session_state['inventory'].copy()
-            inv_sorted['名稱'] = inv_sorted['名稱'].astype(str).str.strip()
-            inv_sorted = inv_sorted.sort_values(by=['名稱', '寬度mm', '五行'])
-            inv_sorted['label'] = inv_sorted.apply(make_inventory_label, axis=1)
-            
-            target = st.selectbox("選擇商品", inv_sorted['label'].tolist())
-            idx = inv_sorted[inv_sorted['label'] == target].index[0]
-            row = st.session_state['inventory'].loc[idx]
-            
-            with st.form("restock"):
-                old_cost = float(row.get('成本單價', 0))
-                elem_info = f" ({row.get('五行', '')})" if row.get('五行', '') else ""
-                st.info(f"品名：{row['名稱']}{elem_info} | 目前單價成本：${old_cost:.2f}")
-                
-                c1, c2, c3 = st.columns(3)
-                qty = c1.number_input("進貨數量", 1, value=1)
-                
-                total_cost_in = c2.number_input("💰 本次進貨總成本 (總價)", min_value=0.0, step=1.0)
-                calc_unit_cost = total_cost_in / qty if qty > 0 else 0
-                c2.caption(f"換算單價: ${calc_unit_cost:.2f} /顆")
-                
-                r_type = c3.radio("方式", ["➕ 合併 (更新成本)", "📦 新批號"])
-                new_batch = st.text_input("新批號", f"{date.today().strftime('%Y%m%d')}-A") if r_type == "📦 新批號" else row['批號']
-
-                if st.form_submit_button("確認進貨"):
-                    final_unit_cost = total_cost_in / qty if qty > 0 else 0
-                    
-                    if r_type == "➕ 合併 (更新成本)":
-                        st.session_state['inventory'].at[idx, '庫存(顆)'] += qty
-                        st.session_state['inventory'].at[idx, '成本單價'] = round(final_unit_cost, 2) # v9.12 修正：四捨五入
-                        save_inventory_to_gsheet(st.session_state['inventory'])
-                        log_act = f"補貨(總${total_cost_in:.2f})"
-                    else:
-                        # v9.12 修改：新批號追加邏輯
-                        new_r = row.copy()
-                        new_r['庫存(顆)'] = int(qty)
-                        new_r['進貨數量(顆)'] = int(qty) # v9.12 修正：強制轉整數，避免 nan
-                        new_r['進貨日期'] = str(date.today())
-                        new_r['批號'] = new_batch
-                        new_r['成本單價'] = round(final_unit_cost, 2) # v9.12 修正：四捨五入
-                        
-                        # 1. 寫入雲端
-                        success = append_inventory_row(new_r)
-                        
-                        # 2. 更新本地
-                        if success:
-                            st.session_state['inventory'] = pd.concat([st.session_state['inventory'], pd.DataFrame([new_r])], ignore_index=True)
-                            log_act = f"補貨新批(總${total_cost_in:.2f})"
-                        else:
-                            st.stop()
-                    
-                    log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'IN', 
-                           '動作': log_act, '倉庫': row['倉庫'], '批號': new_batch if r_type == "📦 新批號" else row['批號'],
-                           '編號': row['編號'], '分類': row['分類'], '名稱': row['名稱'], 
-                           '規格': format_size(row), '廠商': row['進貨廠商'], '數量變動': qty, 
-                           '成本備註': f"總${total_cost_in:.2f} (單${final_unit_cost:.2f})"}
-                    st.session_state['history'] = pd.concat([st.session_state['history'], pd.DataFrame([log])], ignore_index=True)
-                    save_history_to_gsheet(st.session_state['history'])
-                    st.success(f"已更新！單價已設為: ${final_unit_cost:.2f}"); st.rerun()
-
-    with tab2: # 建檔
-        with st.form("new_item"):
+# ==========================================
+# 5. 頁面區塊 (st.fragment)
+# 區塊裡的互動只重跑該區塊；寫入成功後才整頁重跑 (st.rerun())，讓其他區塊與側欄換成新的庫存
+# ==========================================
+
+# --- 這次是不是只重跑區塊 (不是整頁) ---
+def _fragment_rerun():
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+# --- 區塊開頭換成最新的共用快照 (版本沒變時是同一份)；單獨重跑時另記一筆效能紀錄 ---
+def page_fragment(name):
+    def wrap(fn):
+        @st.fragment
+        @functools.wraps(fn)
+        def run():
+            alone = _fragment_rerun()
+            if alone: profiler.begin_run(st.session_state['profile_session'], name)
+            load_inventory_from_gsheet()
+            fn()
+            if alone: profiler.end_run()
+        return run
+    return wrap
+
+@page_fragment("補貨")
+def restock_tab(): # 補貨
+    idx = pick_product("restock_sel", "選擇商品") if not st.session_state['inventory'].empty else None
+    if idx is not None:
+        row = st.session_state['inventory'].loc[idx]
+
+        with st.form("restock"):
+            old_cost = float(row.get('成本單價', 0))
+            elem_info = f" ({row.get('五行', '')})" if row.get('五行', '') else ""
+            st.info(f"品名：{row['名稱']}{elem_info} | 目前單價成本：${old_cost:.2f}")
+
             c1, c2, c3 = st.columns(3)
-            wh = c1.selectbox("倉庫", DEFAULT_WAREHOUSES)
-            exist_names = sorted(list(set([x for x in st.session_state['inventory']['名稱'].astype(str) if x]))) if not st.session_state['inventory'].empty else []
-            name_sel = c2.selectbox("名稱", ["➕ 手動輸入"] + exist_names)
-            name = c2.text_input("輸入名稱") if name_sel == "➕ 手動輸入" else name_sel
-            cat = c3.selectbox("分類", ["天然石", "配件", "耗材"])
-            s1, s2, s3 = st.columns(3)
-            w_mm = s1.number_input("寬度", 0.0)
-            l_mm = s2.number_input("長度", 0.0)
-            shape = s3.selectbox("形狀", get_dynamic_options('形狀', DEFAULT_SHAPES))
-            if shape == "➕ 手動輸入": shape = st.text_input("形狀")
-            c4, c5, c6 = st.columns(3)
-            elem = c4.selectbox("五行", get_dynamic_options('五行', DEFAULT_ELEMENTS))
-            if elem == "➕ 手動輸入": elem = st.text_input("五行")
-            sup = c5.selectbox("廠商", get_dynamic_options('進貨廠商', DEFAULT_SUPPLIERS))
-            if sup == "➕ 手動輸入": sup = st.text_input("廠商")
-            
-            c7, c8 = st.columns(2)
-            qty_init = c7.number_input("初始數量", 1)
-            total_cost_init = c8.number_input("💰 初始總成本 (總價)", min_value=0.0, step=1.0)
-            
-            calc_init_unit = total_cost_init / qty_init if qty_init > 0 else 0
-            c8.caption(f"換算單價: ${calc_init_unit:.2f} /顆")
-            
-            batch = st.text_input("初始批號", f"{date.today().strftime('%Y%m%d')}-01")
-            
-            if st.form_submit_button("建立商品"):
-                name = str(name).strip()
-                if not name: st.error("沒填名稱")
+            qty = c1.number_input("進貨數量", 1, value=1)
+
+            total_cost_in = c2.number_input("💰 本次進貨總成本 (總價)", min_value=0.0, step=1.0)
+            calc_unit_cost = total_cost_in / qty if qty > 0 else 0
+            c2.caption(f"換算單價: ${calc_unit_cost:.2f} /顆")
+
+            r_type = c3.radio("方式", ["➕ 合併 (更新成本)", "📦 新批號"])
+            new_batch = (st.text_input("新批號", next_batch(st.session_state['inventory'], row['編號'], date.today())).strip()
+                         if r_type == "📦 新批號" else row['批號'])
+
+            if st.form_submit_button("確認進貨"):
+                final_unit_cost = total_cost_in / qty if qty > 0 else 0
+                now = datetime.now().strftime("%Y-%m-%d %H:%M")
+                if r_type == "➕ 合併 (更新成本)":
+                    inv = edit_inventory()
+                    log = apply_restock(inv, idx, qty, total_cost_in, now)
+                    success = commit_changes(inv, logs=[log], what="補貨")
                 else:
-                    final_unit_cost = total_cost_init / qty_init if qty_init > 0 else 0
-                    
-                    # v9.12 修正：建檔資料格式
-                    new_r = {
-                        '編號': f"ST{int(time.time())}", '批號': batch, '倉庫': wh, '分類': cat, '名稱': name, 
-                        '寬度mm': w_mm, '長度mm': l_mm, '形狀': shape, '五行': elem, 
-                        '進貨廠商': sup, 
-                        '庫存(顆)': int(qty_init), 
-                        '進貨數量(顆)': int(qty_init), # 強制轉整數
-                        '進貨日期': str(date.today()),
-                        '成本單價': round(final_unit_cost, 2) # 強制四捨五入
-                    }
-                    
-                    success = append_inventory_row(new_r)
-                    
-                    if success:
-                        st.session_state['inventory'] = pd.concat([st.session_state['inventory'], pd.DataFrame([new_r])], ignore_index=True)
-                        
-                        log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'NEW', '動作': '新商品', 
-                               '倉庫': wh, '批號': batch, '編號': new_r['編號'], '分類': cat, '名稱': name, 
-                               '規格': format_size(new_r), '廠商': sup, '數量變動': qty_init, 
-                               '成本備註': f"總${total_cost_init:.2f} (單${final_unit_cost:.2f})"}
-                        st.session_state['history'] = pd.concat([st.session_state['history'], pd.DataFrame([log])], ignore_index=True)
-                        save_history_to_gsheet(st.session_state['history'])
-                        st.success(f"已建檔！單價: ${final_unit_cost:.2f}"); st.rerun()
-
-    with tab4: # 領用 (單品)
-        if not st.session_state['inventory'].empty:
-            inv_sorted = st.session_state['inventory'].copy()
-            inv_sorted['名稱'] = inv_sorted['名稱'].astype(str).str.strip()
-            inv_sorted = inv_sorted.sort_values(by=['名稱', '寬度mm', '五行'])
-            inv_sorted['label'] = inv_sorted.apply(make_inventory_label, axis=1)
-            
-            target = st.selectbox("選擇商品", inv_sorted['label'].tolist(), key="out_sel")
-            idx = inv_sorted[inv_sorted['label'] == target].index[0]
-            row = st.session_state['inventory'].loc[idx]
-            
-            with st.form("out_form"):
-                qty_o = st.number_input("出庫數量", 0, int(float(row['庫存(顆)'])))
-                reason = st.selectbox("原因", ["商品", "自用", "損壞", "樣品", "調倉庫", "其它"])
-                note_o = st.text_input("備註 (選填)", placeholder="例如：調撥至B倉、樣品寄給客戶...")
-                
-                if st.form_submit_button("出庫"):
-                    st.session_state['inventory'].at[idx, '庫存(顆)'] -= qty_o
-                    save_inventory_to_gsheet(st.session_state['inventory'])
-                    
-                    log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'OUT', '動作': f"出庫-{reason}", 
-                           '倉庫': row['倉庫'], '批號': row['批號'], '編號': row['編號'], '分類': row['分類'], '名稱': row['名稱'], 
-                           '規格': format_size(row), '廠商': row['進貨廠商'], '數量變動': -qty_o,
-                           '成本備註': note_o}
-                    st.session_state['history'] = pd.concat([st.session_state['history'], pd.DataFrame([log])], ignore_index=True)
-                    save_history_to_gsheet(st.session_state['history'])
-                    st.rerun()
-
-    with tab3: # 修改
-        if not st.session_state['inventory'].empty:
-            inv_sorted = st.session_state['inventory'].copy()
-            inv_sorted['名稱'] = inv_sorted['名稱'].astype(str).str.strip()
-            inv_sorted = inv_sorted.sort_values(by=['名稱', '寬度mm', '五行'])
-            inv_sorted['label'] = inv_sorted.apply(make_inventory_label, axis=1)
-            
-            target = st.selectbox("修正商品", inv_sorted['label'].tolist(), key="edit_sel")
-            idx = inv_sorted[inv_sorted['label'] == target].index[0]
-            row = st.session_state['inventory'].loc[idx]
-            
-            c1, c2 = st.columns(2)
-            nm = c1.text_input("名稱", row['名稱'])
-            qt = c2.number_input("庫存", value=int(float(row['庫存(顆)'])))
-            
-            c3, c4 = st.columns(2)
-            w_mm = c3.number_input("寬度 (mm)", value=float(row.get('寬度mm', 0)))
-            l_mm = c4.number_input("長度 (mm)", value=float(row.get('長度mm', 0)))
-
-            st.divider()
-            edit_mode = st.radio("修改模式", ["🔢 僅修改數量/資料 (單價不變)", "🔄 重新計算單價 (依總價值)"], horizontal=True)
-            
-            curr_unit_cost = float(row.get('成本單價', 0))
-            final_unit_cost_save = curr_unit_cost 
-            log_note = "僅修改數量/資料(成本不變)"
-
-            if edit_mode == "🔄 重新計算單價 (依總價值)":
-                default_total_cost = curr_unit_cost * int(float(row.get('庫存(顆)', 0)))
-                total_val = st.number_input("💰 庫存總價值 (總價)", value=default_total_cost, step=1.0)
-                new_unit_cost_calc = total_val / qt if qt > 0 else 0
-                st.caption(f"換算新單價: ${new_unit_cost_calc:.2f} /顆")
-                final_unit_cost_save = new_unit_cost_calc
-                log_note = f"改總價重新計算(總${total_val:.2f})"
+                    # 寫入後本地會換成含新批號的共用快照
+                    try:
+                        new_r, log = new_batch_row(st.session_state['inventory'], idx, new_batch, qty, total_cost_in, now,
+                                                   str(date.today()))
+                    except ValueError as e:
+                        st.error(f"❌ {e}，請換一個批號"); st.stop()
+                    success = commit_changes(new_rows=[new_r], logs=[log], what="補貨新批")
+
+                if not success: st.stop()
+                st.success(f"已更新！單價已設為: ${final_unit_cost:.2f}"); st.rerun()
+
+@page_fragment("建檔")
+def new_item_tab(): # 建檔
+    with st.form("new_item"):
+        c1, c2, c3 = st.columns(3)
+        wh = c1.selectbox("倉庫", DEFAULT_WAREHOUSES)
+        exist_names = sorted(_column_values('名稱'))
+        name_sel = c2.selectbox("名稱", ["➕ 手動輸入"] + exist_names)
+        name = c2.text_input("輸入名稱") if name_sel == "➕ 手動輸入" else name_sel
+        cat = c3.selectbox("分類", ["天然石", "配件", "耗材"])
+        s1, s2, s3 = st.columns(3)
+        w_mm = s1.number_input("寬度", 0.0)
+        l_mm = s2.number_input("長度", 0.0)
+        shape = s3.selectbox("形狀", get_dynamic_options('形狀', DEFAULT_SHAPES))
+        if shape == "➕ 手動輸入": shape = st.text_input("形狀")
+        c4, c5, c6 = st.columns(3)
+        elem = c4.selectbox("五行", get_dynamic_options('五行', DEFAULT_ELEMENTS))
+        if elem == "➕ 手動輸入": elem = st.text_input("五行")
+        sup = c5.selectbox("廠商", get_dynamic_options('進貨廠商', DEFAULT_SUPPLIERS))
+        if sup == "➕ 手動輸入": sup = st.text_input("廠商")
+
+        c7, c8 = st.columns(2)
+        qty_init = c7.number_input("初始數量", 1)
+        total_cost_init = c8.number_input("💰 初始總成本 (總價)", min_value=0.0, step=1.0)
+
+        calc_init_unit = total_cost_init / qty_init if qty_init > 0 else 0
+        c8.caption(f"換算單價: ${calc_init_unit:.2f} /顆")
+
+        batch = st.text_input("初始批號", f"{date.today().strftime('%Y%m%d')}-01")
+
+        if st.form_submit_button("建立商品"):
+            name = str(name).strip()
+            if not name: st.error("沒填名稱")
             else:
-                st.info(f"維持目前成本單價: ${curr_unit_cost:.2f} /顆")
-
-            st.divider()
-            c6, c7 = st.columns(2)
-            curr_elem = str(row.get('五行', '')).strip()
-            elem_opts = get_dynamic_options('五行', DEFAULT_ELEMENTS)
-            if curr_elem and curr_elem not in elem_opts: elem_opts.append(curr_elem)
-            try: elem_idx = elem_opts.index(curr_elem)
-            except: elem_idx = 0
-            sel_elem = c6.selectbox("五行", elem_opts, index=elem_idx, key="edit_elem_sel")
-            final_elem = c6.text_input("輸入新五行", key="edit_elem_txt") if sel_elem == "➕ 手動輸入" else sel_elem
-            
-            curr_shape = str(row.get('形狀', '')).strip()
-            shape_opts = get_dynamic_options('形狀', DEFAULT_SHAPES)
-            if curr_shape and curr_shape not in shape_opts: shape_opts.append(curr_shape)
-            try: shape_idx = shape_opts.index(curr_shape)
-            except: shape_idx = 0
-            sel_shape = c7.selectbox("形狀", shape_opts, index=shape_idx, key="edit_shape_sel")
-            final_shape = c7.text_input("輸入新形狀", key="edit_shape_txt") if sel_shape == "➕ 手動輸入" else sel_shape
-
-            if st.button("💾 儲存修正", type="primary"):
-                nm = str(nm).strip()
-                st.session_state['inventory'].at[idx, '名稱'] = nm
-                st.session_state['inventory'].at[idx, '庫存(顆)'] = qt
-                st.session_state['inventory'].at[idx, '成本單價'] = round(final_unit_cost_save, 2) # v9.12 修正
-                st.session_state['inventory'].at[idx, '寬度mm'] = w_mm
-                st.session_state['inventory'].at[idx, '長度mm'] = l_mm
-                st.session_state['inventory'].at[idx, '五行'] = final_elem 
-                st.session_state['inventory'].at[idx, '形狀'] = final_shape
-                
-                save_inventory_to_gsheet(st.session_state['inventory'])
-                new_spec = f"{w_mm}x{l_mm}mm" if l_mm > 0 else f"{w_mm}mm"
-                log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'ADJUST', '動作': '盤點修正', 
-                       '倉庫': row['倉庫'], '批號': row['批號'], '編號': row['編號'], '分類': row['分類'], '名稱': nm, 
-                       '規格': new_spec, '廠商': row['進貨廠商'], '數量變動': 0, 
-                       '成本備註': log_note}
-                st.session_state['history'] = pd.concat([st.session_state['history'], pd.DataFrame([log])], ignore_index=True)
-                save_history_to_gsheet(st.session_state['history'])
-                st.success(f"已修正! 單價為: ${final_unit_cost_save:.2f}"); st.rerun()
+                final_unit_cost = total_cost_init / qty_init if qty_init > 0 else 0
+
+                # v9.12 修正：建檔資料格式
+                new_r = {
+                    '編號': f"ST{int(time.time())}", '批號': batch, '倉庫': wh, '分類': cat, '名稱': name, 
+                    '寬度mm': w_mm, '長度mm': l_mm, '形狀': shape, '五行': elem, 
+                    '進貨廠商': sup, 
+                    '庫存(顆)': int(qty_init), 
+                    '進貨數量(顆)': int(qty_init), # 強制轉整數
+                    '進貨日期': str(date.today()),
+                    '成本單價': round(final_unit_cost, 2) # 強制四捨五入
+                }
 
-    st.divider()
+                log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'NEW', '動作': '新商品', 
+                       '倉庫': wh, '批號': batch, '編號': new_r['編號'], '分類': cat, '名稱': name, 
+                       '規格': format_size(new_r), '廠商': sup, '數量變動': qty_init, 
+                       '成本備註': f"總${total_cost_init:.2f} (單${final_unit_cost:.2f})"}
+
+                if commit_changes(new_rows=[new_r], logs=[log], what="新商品"):
+                    st.success(f"已建檔！單價: ${final_unit_cost:.2f}"); st.rerun()
+
+@page_fragment("領用")
+def withdraw_tab(): # 領用 (單品)
+    idx = pick_product("out_sel", "選擇商品", in_stock=True) if not st.session_state['inventory'].empty else None
+    if idx is not None:
+        row = st.session_state['inventory'].loc[idx]
+
+        with st.form("out_form"):
+            qty_o = st.number_input("出庫數量", 0, int(float(row['庫存(顆)'])))
+            reason = st.selectbox("原因", ["商品", "自用", "損壞", "樣品", "調倉庫", "其它"])
+            note_o = st.text_input("備註 (選填)", placeholder="例如：調撥至B倉、樣品寄給客戶...")
+
+            if st.form_submit_button("出庫"):
+                inv = edit_inventory()
+                log = apply_withdraw(inv, idx, qty_o, reason, note_o, datetime.now().strftime("%Y-%m-%d %H:%M"))
+                if not commit_changes(inv, logs=[log], what="出庫"): st.stop()
+                st.rerun()
+
+@page_fragment("修改")
+def edit_tab(): # 修改
+    idx = pick_product("edit_sel", "修正商品") if not st.session_state['inventory'].empty else None
+    if idx is not None:
+        row = st.session_state['inventory'].loc[idx]
+
+        c1, c2 = st.columns(2)
+        nm = c1.text_input("名稱", row['名稱'])
+        qt = c2.number_input("庫存", value=int(float(row['庫存(顆)'])))
+
+        c3, c4 = st.columns(2)
+        w_mm = c3.number_input("寬度 (mm)", value=float(row.get('寬度mm', 0)))
+        l_mm = c4.number_input("長度 (mm)", value=float(row.get('長度mm', 0)))
+
+        st.divider()
+        edit_mode = st.radio("修改模式", ["🔢 僅修改數量/資料 (單價不變)", "🔄 重新計算單價 (依總價值)"], horizontal=True)
+
+        curr_unit_cost = float(row.get('成本單價', 0))
+        final_unit_cost_save = curr_unit_cost 
+        log_note = "僅修改數量/資料(成本不變)"
+
+        if edit_mode == "🔄 重新計算單價 (依總價值)":
+            default_total_cost = curr_unit_cost * int(float(row.get('庫存(顆)', 0)))
+            total_val = st.number_input("💰 庫存總價值 (總價)", value=default_total_cost, step=1.0)
+            new_unit_cost_calc = total_val / qt if qt > 0 else 0
+            st.caption(f"換算新單價: ${new_unit_cost_calc:.2f} /顆")
+            final_unit_cost_save = new_unit_cost_calc
+            log_note = f"改總價重新計算(總${total_val:.2f})"
+        else:
+            st.info(f"維持目前成本單價: ${curr_unit_cost:.2f} /顆")
+
+        st.divider()
+        c6, c7 = st.columns(2)
+        curr_elem = str(row.get('五行', '')).strip()
+        elem_opts = get_dynamic_options('五行', DEFAULT_ELEMENTS)
+        if curr_elem and curr_elem not in elem_opts: elem_opts.append(curr_elem)
+        try: elem_idx = elem_opts.index(curr_elem)
+        except: elem_idx = 0
+        sel_elem = c6.selectbox("五行", elem_opts, index=elem_idx, key="edit_elem_sel")
+        final_elem = c6.text_input("輸入新五行", key="edit_elem_txt") if sel_elem == "➕ 手動輸入" else sel_elem
+
+        curr_shape = str(row.get('形狀', '')).strip()
+        shape_opts = get_dynamic_options('形狀', DEFAULT_SHAPES)
+        if curr_shape and curr_shape not in shape_opts: shape_opts.append(curr_shape)
+        try: shape_idx = shape_opts.index(curr_shape)
+        except: shape_idx = 0
+        sel_shape = c7.selectbox("形狀", shape_opts, index=shape_idx, key="edit_shape_sel")
+        final_shape = c7.text_input("輸入新形狀", key="edit_shape_txt") if sel_shape == "➕ 手動輸入" else sel_shape
+
+        if st.button("💾 儲存修正", type="primary"):
+            nm = str(nm).strip()
+            inv = edit_inventory()
+            # 五行/形狀是 category 欄，新值要先補類別
+            set_cells(inv, idx, {'名稱': nm, '庫存(顆)': qt,
+                                 '成本單價': round(final_unit_cost_save, 2), # v9.12 修正
+                                 '寬度mm': w_mm, '長度mm': l_mm, '五行': final_elem, '形狀': final_shape})
+
+            new_spec = f"{w_mm}x{l_mm}mm" if l_mm > 0 else f"{w_mm}mm"
+            log = {'紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), '單號': 'ADJUST', '動作': '盤點修正', 
+                   '倉庫': row['倉庫'], '批號': row['批號'], '編號': row['編號'], '分類': row['分類'], '名稱': nm, 
+                   '規格': new_spec, '廠商': row['進貨廠商'], '數量變動': 0, 
+                   '成本備註': log_note}
+            if not commit_changes(inv, logs=[log], what="盤點修正"): st.stop()
+            st.success(f"已修正! 單價為: ${final_unit_cost_save:.2f}"); st.rerun()
+
+    # 已歸檔的空批號 (唯讀)：成本單價與進貨資料都還在
+    with st.expander("📦 已歸檔批號"):
+        if st.checkbox("載入已歸檔批號", key="show_retired"):
+            try:
+                retired = get_store().retired_batches()
+            except Exception as e:
+                st.error(f"❌ 無法讀取已歸檔批號: {e}"); retired = pd.DataFrame(columns=COLUMNS + ['歸檔日期'])
+            q = st.text_input("搜尋名稱 / 編號 / 批號", key="retired_q").strip()
+            if q:
+                hit = (retired['名稱'].str.contains(q, case=False, regex=False)
+                       | retired['編號'].astype(str).str.contains(q, case=False, regex=False)
+                       | retired['批號'].astype(str).str.contains(q, case=False, regex=False))
+                retired = retired[hit]
+            st.caption(f"共 {len(retired)} 筆")
+            shown = retired.assign(規格=format_sizes(retired))
+            cols = ['歸檔日期', '編號', '批號', '倉庫', '名稱', '規格', '進貨日期', '進貨廠商', '進貨數量(顆)']
+            if st.session_state['admin_mode']: cols.append('成本單價')
+            st.dataframe(shown[cols], use_container_width=True, hide_index=True)
+
+@page_fragment("批次匯入")
+def import_tab(): # 批次匯入 (整批進貨：合併、新批、新商品一次提交)
+    st.caption("欄位同庫存表，可另加「總成本」(單價 = 總成本 / 數量)。以 名稱+寬度+長度+形狀+五行 對回現有商品："
+               "批號空白或相同 → 合併；填新批號 → 新批；對不到 → 新商品")
+    st.download_button("📄 下載範本", template_csv(), file_name="import_template.csv", mime="text/csv")
+    up_key = st.session_state.setdefault('import_key', 0)
+    up = st.file_uploader("上傳 CSV / Excel", type=["csv", "xlsx"], key=f"import_file_{up_key}")
+    if up is not None:
+        # 新編號的前綴固定在這個檔案上，預覽與提交一致
+        prefix = st.session_state.setdefault(f"import_prefix_{up.file_id}", f"ST{int(time.time())}")
+        try:
+            plan = plan_import(st.session_state['inventory'], read_upload(up.name, up.getvalue()),
+                               datetime.now().strftime("%Y-%m-%d %H:%M"), str(date.today()), prefix)
+        except Exception as e:
+            st.error(f"❌ 無法讀取檔案: {e}"); st.stop()
+        for issue in plan['issues']: st.warning(issue)
+        merges, new_rows = plan['merges'], plan['new_rows']
+        st.markdown(f"#### ➕ 合併到現有批號 ({len(merges)} 筆)")
+        st.dataframe(merges.drop(columns=['_row']).style.format({'原單價': '{:.2f}', '新單價': '{:.2f}'}),
+                     hide_index=True, use_container_width=True)
+        st.markdown(f"#### ✨ 新批號 / 新商品 ({len(new_rows)} 筆)")
+        st.dataframe(new_rows.style.format({'成本單價': '{:.2f}'}), hide_index=True, use_container_width=True)
+
+        if plan['logs'] and st.button(f"✅ 確認匯入 ({len(plan['logs'])} 筆)", type="primary"):
+            inv = None
+            if not merges.empty:
+                inv = edit_inventory(); apply_merges(inv, merges)
+            # 合併的儲存格、新增列與紀錄同一筆提交
+            if not commit_changes(inv, new_rows=new_rows.to_dict('records'), logs=plan['logs'],
+                                  what=f"批次匯入 {up.name}"): st.stop()
+            st.session_state['import_key'] = up_key + 1 # 換掉上傳元件，避免重複匯入
+            st.success(f"已匯入 {len(merges)} 筆合併、{len(new_rows)} 筆新增"); st.rerun()
+
+@page_fragment("庫存總表")
+def inventory_table(): # 目前庫存總表 (搜尋與翻頁只重跑這一塊)
     st.subheader("📊 目前庫存總表")
-    search_term = st.text_input("🔍 搜尋 (名稱/編號)", "", placeholder="輸入關鍵字...")
-    df_display = st.session_state['inventory'].copy()
-    if search_term:
-        mask = df_display.astype(str).apply(lambda x: x.str.contains(search_term, case=False)).any(axis=1)
-        df_display = df_display[mask]
+    c_search, c_page = st.columns([4, 1])
+    search_term = c_search.text_input("🔍 搜尋 (名稱/編號)", "", placeholder="輸入關鍵字，可加條件如 五行:水 寬度>8")
+    inv = st.session_state['inventory']
+    hits = get_search_index().search(search_term) if search_term.strip() else inv.index
+    # 只把目前這一頁送到畫面
+    _, n_pages = page_of(hits, 1, TABLE_PAGE_SIZE)
+    page_no = c_page.number_input("頁數", 1, n_pages, 1) if n_pages > 1 else 1
+    page_idx, _ = page_of(hits, page_no, TABLE_PAGE_SIZE)
+    st.caption(f"共 {len(hits)} 筆 · 第 {page_no}/{n_pages} 頁")
+    df_display = inv.loc[page_idx].copy()
     if not st.session_state['admin_mode'] and '成本單價' in df_display.columns:
         df_display = df_display.drop(columns=['成本單價', '進貨廠商'])
     
@@ -460,45 +602,122 @@ if page == "📦 庫存與進貨":
     else:
         st.dataframe(df_display, use_container_width=True)
 
-# ------------------------------------------
-# 頁面 B: 紀錄查詢
-# ------------------------------------------
-elif page == "📜 紀錄查詢":
-    df_h = st.session_state['history'].copy()
+@page_fragment("紀錄查詢")
+def history_view(): # 紀錄查詢
+    # 紀錄只在第一次進這頁時從雲端載入，查詢與分頁都在本地資料庫完成
+    try:
+        with st.spinner('連線雲端紀錄 (History)...'): store.ensure_loaded(HISTORY)
+    except Exception as e:
+        st.error(f"❌ 無法讀取歷史紀錄: {e}")
+
+    f1, f2, f3 = st.columns(3)
+    d_range = f1.date_input("日期區間", value=(), format="YYYY-MM-DD")
+    q_order = f2.text_input("單號")
+    q_sku = f3.text_input("編號")
+    f4, f5, f6 = st.columns(3)
+    q_action = f4.text_input("動作", placeholder="例如：出庫、補貨、設計單")
+    wh_opts = sorted(set(DEFAULT_WAREHOUSES) | _column_values('倉庫'))
+    q_wh = f5.selectbox("倉庫", ["全部"] + wh_opts)
+    h_page = f6.number_input("頁數", min_value=1, value=1)
+
+    d_start = d_range[0] if len(d_range) > 0 else None
+    d_end = d_range[1] if len(d_range) > 1 else d_start
+    with profiler.span("紀錄查詢"):
+        df_h, total = store.query_history(d_start, d_end, q_order.strip(), q_sku.strip(), q_action.strip(),
+                                          "" if q_wh == "全部" else q_wh, h_page, HISTORY_PAGE_SIZE)
+    n_pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    st.caption(f"共 {total} 筆 · 第 {h_page}/{n_pages} 頁 (最新在前)")
     if not st.session_state['admin_mode'] and '成本備註' in df_h.columns:
         df_h = df_h.drop(columns=['成本備註'])
-    if not df_h.empty: df_h = df_h.iloc[::-1]
     st.dataframe(df_h, use_container_width=True)
 
-# ------------------------------------------
-# 頁面 C: 領料與設計單
-# ------------------------------------------
-elif page == "🧮 領料與設計單":
+# --- 設計單清單：數量框的鍵 ---
+def _cart_key(item):
+    return f"qty_edit_{item['編號']}_{item['批號']}"
+
+# 刪除/清空用按鈕回呼：在區塊重跑之前先改好清單，不用再叫一次重跑
+def _remove_from_cart(qty_key):
+    st.session_state['current_design'] = [i for i in st.session_state['current_design'] if _cart_key(i) != qty_key]
+    st.session_state.pop(qty_key, None)
+
+def _clear_cart():
+    for item in st.session_state['current_design']: st.session_state.pop(_cart_key(item), None)
+    st.session_state['current_design'] = []
+
+@page_fragment("領料清單")
+def design_cart(): # 領料清單 (改數量、刪除只重跑清單)
+    if not st.session_state['current_design']: return
+    st.subheader("🛒 領料清單")
+    h1, h2, h3, h4 = st.columns([4, 2, 2, 1])
+    h1.caption("商品名稱 / 規格"); h2.caption("數量"); h3.caption("批號"); h4.caption("刪除")
+
+    for item in st.session_state['current_design']:
+        with st.container():
+            c1, c2, c3, c4 = st.columns([4, 2, 2, 1])
+            cost_info = ""
+            if st.session_state['admin_mode'] and '成本小計' in item:
+                unit_cost = item['成本小計'] / item['數量'] if item['數量'] > 0 else 0
+                cost_info = f" | 💰${unit_cost:.2f}/顆"
+
+            spec_info = f"({item.get('規格', '')})" if item.get('規格', '') else ""
+            c1.markdown(f"**{item['名稱']}** <small>{spec_info}</small> {cost_info}\n<small style='color:gray'>{item['編號']}</small>", unsafe_allow_html=True)
+
+            # 數量框以商品+批號為鍵 (刪掉前面的品項時不會套到別列)；改數量只重跑清單
+            qty_key = _cart_key(item)
+            st.session_state.setdefault(qty_key, int(item['數量']))
+            new_qty = c2.number_input("qty", min_value=1, label_visibility="collapsed", key=qty_key)
+            if new_qty != item['數量']:
+                if '成本小計' in item: item['成本小計'] = item['成本小計'] / item['數量'] * new_qty
+                item['數量'] = new_qty
+            c3.text(item['批號'])
+            c4.button("🗑️", key=f"del_{qty_key}", on_click=_remove_from_cart, args=(qty_key,))
+
+    st.divider()
+    # 清單一次對回庫存，預估成本與領出共用同一份結果
+    with profiler.span("設計單對回庫存"):
+        resolved = resolve_cart(st.session_state['inventory'], st.session_state['current_design'])
+    if st.session_state['admin_mode']:
+        st.info(f"💰 本單預估總成本: ${cart_cost(resolved):,.2f}")
+
+    c_confirm, c_clear = st.columns([4, 1])
+    if c_confirm.button("✅ 確認領出 (寫入雲端)", type="primary", use_container_width=True):
+        final_oid = st.session_state['order_id_input'].strip() 
+        if not final_oid: final_oid = f"DES-{date.today().strftime('%Y%m%d')}"
+
+        inv = edit_inventory()
+        with profiler.span("設計單扣庫存"):
+            new_logs = apply_checkout(inv, resolved, final_oid, st.session_state['order_note_input'],
+                                      datetime.now().strftime("%Y-%m-%d %H:%M"))
+        # 扣庫存與領出紀錄同一筆提交，不會只寫進一半
+        if not commit_changes(inv, logs=new_logs, what=f"設計單 {final_oid}"): st.stop()
+
+        _clear_cart()
+        st.session_state['order_id_input'] = f"DES-{date.today().strftime('%Y%m%d')}-{int(time.time())%1000}"
+        st.success(f"訂單 {final_oid} 完成！"); time.sleep(1); st.rerun()
+
+    c_clear.button("🗑️ 清空", type="secondary", on_click=_clear_cart)
+
+@page_fragment("選料")
+def design_picker(): # 單號與選料 (加入時連同裡面的清單一起重跑)
     st.subheader("🧮 領料與設計單")
     c_oid, c_note = st.columns([1, 2])
     st.session_state['order_id_input'] = c_oid.text_input("自訂單號", st.session_state['order_id_input'])
     st.session_state['order_note_input'] = c_note.text_input("備註 (選填)", st.session_state['order_note_input'])
-    
-    if not st.session_state['inventory'].empty:
-        inv_sorted = st.session_state['inventory'].copy()
-        inv_sorted['名稱'] = inv_sorted['名稱'].astype(str).str.strip()
-        inv_sorted = inv_sorted.sort_values(by=['名稱', '寬度mm', '五行'])
-        inv_sorted['label'] = inv_sorted.apply(make_inventory_label, axis=1)
-        
-        sel = st.selectbox("選擇材料", inv_sorted['label'].tolist(), key="d_sel")
-        idx = inv_sorted[inv_sorted['label'] == sel].index[0]
-        
+
+    idx = pick_product("d_sel", "選擇材料", in_stock=True) if not st.session_state['inventory'].empty else None
+    if idx is not None:
         row = st.session_state['inventory'].loc[idx]
         cur_s = int(float(row['庫存(顆)']))
-        
+
         c1, c2 = st.columns([1,2])
         qty = c1.number_input("加入數量", min_value=1, max_value=max(1, cur_s), value=1)
-        
+
         if c1.button("⬇️ 加入清單"):
             found = False
             for item in st.session_state['current_design']:
                 if item['編號'] == row['編號'] and item['批號'] == row['批號']:
                     item['數量'] += qty
+                    st.session_state[_cart_key(item)] = item['數量']
                     if '成本單價' in st.session_state['inventory'].columns:
                         item['成本小計'] = float(row['成本單價']) * item['數量']
                     found = True
@@ -517,103 +736,103 @@ elif page == "🧮 領料與設計單":
                 if '成本單價' in st.session_state['inventory'].columns:
                     new_item['成本小計'] = float(row['成本單價']) * qty
                 st.session_state['current_design'].append(new_item)
-            st.rerun()
 
     st.markdown("---")
-    if st.session_state['current_design']:
-        st.subheader("🛒 領料清單")
-        h1, h2, h3, h4 = st.columns([4, 2, 2, 1])
-        h1.caption("商品名稱 / 規格"); h2.caption("數量"); h3.caption("批號"); h4.caption("刪除")
-        delete_index = -1
-        
-        for i, item in enumerate(st.session_state['current_design']):
-            with st.container():
-                c1, c2, c3, c4 = st.columns([4, 2, 2, 1])
-                cost_info = ""
-                if st.session_state['admin_mode'] and '成本小計' in item:
-                    unit_cost = item['成本小計'] / item['數量'] if item['數量'] > 0 else 0
-                    cost_info = f" | 💰${unit_cost:.2f}/顆"
-                
-                spec_info = f"({item.get('規格', '')})" if item.get('規格', '') else ""
-                c1.markdown(f"**{item['名稱']}** <small>{spec_info}</small> {cost_info}\n<small style='color:gray'>{item['編號']}</small>", unsafe_allow_html=True)
-                
-                new_qty = c2.number_input("qty", min_value=1, value=int(item['數量']), label_visibility="collapsed", key=f"qty_edit_{i}")
-                if new_qty != item['數量']:
-                    item['數量'] = new_qty
-                    st.rerun()
-                c3.text(item['批號'])
-                if c4.button("🗑️", key=f"del_{i}"): delete_index = i
-
-        if delete_index != -1:
-            del st.session_state['current_design'][delete_index]
-            st.rerun()
+    design_cart()
 
-        st.divider()
-        if st.session_state['admin_mode']:
-            total_cost_calc = 0
-            for item in st.session_state['current_design']:
-                mask = (st.session_state['inventory']['編號'] == item['編號']) & \
-                       (st.session_state['inventory']['批號'] == item['批號'])
-                if mask.any():
-                    u_cost = float(st.session_state['inventory'].loc[mask, '成本單價'].values[0])
-                    total_cost_calc += u_cost * item['數量']
-            st.info(f"💰 本單預估總成本: ${total_cost_calc:,.2f}")
-
-        c_confirm, c_clear = st.columns([4, 1])
-        if c_confirm.button("✅ 確認領出 (寫入雲端)", type="primary", use_container_width=True):
-            final_oid = st.session_state['order_id_input'].strip() 
-            if not final_oid: final_oid = f"DES-{date.today().strftime('%Y%m%d')}"
-            
-            for x in st.session_state['current_design']:
-                 mask = (st.session_state['inventory']['編號'] == x['編號']) & \
-                        (st.session_state['inventory']['批號'] == x['批號'])
-                 
-                 wh = x.get('倉庫', '')
-                 cat = x.get('分類', '')
-                 spec = x.get('規格', '')
-                 sup = x.get('廠商', '')
-
-                 if mask.any() and (not wh or not cat or not spec or not sup):
-                     row = st.session_state['inventory'].loc[mask].iloc[0]
-                     if not wh: wh = row.get('倉庫', '')
-                     if not cat: cat = row.get('分類', '')
-                     if not spec: spec = format_size(row)
-                     if not sup: sup = row.get('進貨廠商', '')
-
-                 if mask.any():
-                     t_idx = st.session_state['inventory'][mask].index[0]
-                     
-                     u_cost = float(st.session_state['inventory'].loc[mask, '成本單價'].values[0])
-                     total_item_cost = u_cost * x['數量']
-                     cost_log_str = f"成本${total_item_cost:.2f} (單${u_cost:.2f})"
-                     
-                     user_note = st.session_state['order_note_input'].strip() if st.session_state['order_note_input'] else ""
-                     final_note = f"{user_note} | {cost_log_str}" if user_note else cost_log_str
-
-                     st.session_state['inventory'].at[t_idx, '庫存(顆)'] -= x['數量']
-                     
-                     log = {
-                         '紀錄時間': datetime.now().strftime("%Y-%m-%d %H:%M"), 
-                         '單號': final_oid, 
-                         '動作': '設計單領出', 
-                         '名稱': x['名稱'], 
-                         '數量變動': -x['數量'],
-                         '倉庫': wh,
-                         '批號': x['批號'],
-                         '編號': x['編號'],
-                         '分類': cat,
-                         '規格': spec,
-                         '廠商': sup,
-                         '成本備註': final_note 
-                     }
-                     st.session_state['history'] = pd.concat([st.session_state['history'], pd.DataFrame([log])], ignore_index=True)
-            
-            save_inventory_to_gsheet(st.session_state['inventory'])
-            save_history_to_gsheet(st.session_state['history'])
-            
-            st.session_state['current_design'] = []
-            st.session_state['order_id_input'] = f"DES-{date.today().strftime('%Y%m%d')}-{int(time.time())%1000}"
-            st.success(f"訂單 {final_oid} 完成！"); time.sleep(1); st.rerun()
-        
-        if c_clear.button("🗑️ 清空", type="secondary"): 
-            st.session_state['current_design'] = []; st.rerun()
+# ------------------------------------------
+# 頁面 A: 庫存管理
+# ------------------------------------------
+if page == "📦 庫存與進貨":
+    tab1, tab2, tab4, tab3, tab5 = st.tabs(["🔄 補貨", "✨ 建檔", "📤 領用", "🛠️ 修改", "📥 批次匯入"])
+    with tab1: restock_tab()
+    with tab2: new_item_tab()
+    with tab4: withdraw_tab()
+    with tab3: edit_tab()
+    with tab5: import_tab()
+    st.divider()
+    inventory_table()
+
+# ------------------------------------------
+# 頁面 B: 紀錄查詢
+# ------------------------------------------
+elif page == "📜 紀錄查詢":
+    history_view()
+
+# ------------------------------------------
+# 頁面 C: 領料與設計單
+# ------------------------------------------
+elif page == "🧮 領料與設計單":
+    design_picker()
+
+# ------------------------------------------
+# 頁面 D: 營運分析 (僅管理員)
+# ------------------------------------------
+elif page == "📈 營運分析":
+    st.subheader("📈 營運分析")
+    try:
+        # 分析最長看一年：已封存的月份一起讀入
+        with st.spinner('連線雲端紀錄 (History)...'), profiler.span("載入紀錄快照"):
+            df_hist = store.history_since(date.today() - timedelta(days=365), frozen=frozen_history())
+    except Exception as e:
+        st.error(f"❌ 無法讀取歷史紀錄: {e}"); st.stop()
+    inv = st.session_state['inventory']
+    with profiler.span("分析累計"): stats = get_analytics().refresh(df_hist, inv)
+
+    c1, c2 = st.columns(2)
+    days = c1.selectbox("期間", [30, 90, 180, 365], format_func=lambda d: f"近 {d} 天")
+    cost_col = {"FIFO": "FIFO成本", "加權平均": "加權平均成本"}[c2.radio("領用成本算法", ["FIFO", "加權平均"], horizontal=True)]
+
+    with profiler.span("週轉與領用成本"):
+        by_sku = stats.turnover(inv, days)
+        orders = stats.order_costs(days)
+    m1, m2, m3 = st.columns(3)
+    m1.metric("期間用量 (顆)", f"{int(by_sku['用量'].sum()):,}")
+    m2.metric("設計單領用成本", f"${orders[cost_col].sum():,.2f}")
+    m3.metric("設計單數", f"{len(orders):,}")
+
+    st.markdown("#### 🏬 各倉庫")
+    st.dataframe(stats.turnover(inv, days, by='倉庫'), use_container_width=True)
+
+    st.markdown("#### 💎 各商品 (依用量排序)")
+    names = inv.assign(編號=inv['編號'].astype(str)).drop_duplicates('編號').set_index('編號')['名稱']
+    by_sku.insert(0, '名稱', names.reindex(by_sku.index).fillna(''))
+    _, n_pages = page_of(by_sku.index, 1, TABLE_PAGE_SIZE)
+    sku_page = st.number_input("頁數", 1, n_pages, 1, key="an_sku_page") if n_pages > 1 else 1
+    page_idx, _ = page_of(by_sku.index, sku_page, TABLE_PAGE_SIZE)
+    st.dataframe(by_sku.loc[page_idx], use_container_width=True)
+
+    st.markdown("#### 🧾 設計單成本 (最新在前)")
+    st.dataframe(orders[['時間', '品項', '數量', cost_col, '記錄成本']].head(HISTORY_PAGE_SIZE)
+                 .style.format({cost_col: '{:.2f}', '記錄成本': '{:.2f}'}), use_container_width=True)
+
+    st.markdown("#### ⚠️ 低庫存與補貨建議")
+    r1, r2, r3 = st.columns(3)
+    group_by = r1.radio("彙總方式", ["編號", "品項"], horizontal=True, help="品項 = 名稱 + 規格，同款不同編號合併計算")
+    lead_days = r2.number_input("進貨前置天數", 1, 120, 7)
+    cover_days = r3.number_input("補貨後可用天數", 1, 365, 30)
+    with profiler.span("補貨建議"): plan = stats.reorder_plan(inv, by=group_by, lead_days=lead_days, cover_days=cover_days)
+    low = plan[plan['低庫存']].drop(columns=['低庫存'])
+    st.caption(f"{len(low)} 項已低於再訂購點 (日均用量以近 90 天指數平滑計算)")
+    st.dataframe(low.head(TABLE_PAGE_SIZE), use_container_width=True)
+    export = purchase_suggestions(plan)
+    st.download_button(f"📥 下載採購建議 ({len(export)} 項)", export.to_csv(index=False).encode('utf-8-sig'),
+                       file_name=f"purchase_{date.today().strftime('%Y%m%d')}.csv", mime="text/csv")
+
+    st.markdown("#### 📅 指定日期庫存 (月底盤點)")
+    as_of = st.date_input("日期 (當天結束時)", date.today().replace(day=1) - timedelta(days=1), key="stock_as_of")
+    try:
+        with profiler.span("指定日期庫存"): past = stock_report(store.stock_at(as_of), inv)
+    except Exception as e:
+        st.warning(f"⚠️ 無法推算 {as_of} 的庫存: {e}"); st.stop()
+    st.caption("由最接近的庫存快照加減之間的紀錄推算 (盤點修正沒有記數量變動，跨過修正時以快照為準)")
+    v1, v2 = st.columns(2)
+    v1.metric("庫存總值", f"${past['庫存金額'].sum():,.2f}")
+    v2.metric("有庫存的批號", f"{len(past):,}")
+    st.dataframe(past.head(TABLE_PAGE_SIZE).style.format({'成本單價': '{:.2f}', '庫存金額': '{:.2f}'}),
+                 hide_index=True, use_container_width=True)
+    st.download_button(f"📥 下載 {as_of} 庫存 ({len(past)} 項)", past.to_csv(index=False).encode('utf-8-sig'),
+                       file_name=f"stock_{as_of.strftime('%Y%m%d')}.csv", mime="text/csv")
+
+# 頁面跑完才結束這次重跑 (中途 st.stop / st.rerun 的，下次重跑開始時補結束)
+profiler.end_run()
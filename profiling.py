@@ -0,0 +1,160 @@
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 效能紀錄 (不依賴 Streamlit)
+# 雲端呼叫：次數、送出/收到位元組、延遲、實際發出的 HTTP 請求數 (= 消耗的 API 配額)
+# 運算區塊：耗時
+# 每次重跑用 begin_run 開始；目前的重跑放在 contextvar (交給執行緒池時一起複製)，背景同步不屬於任何重跑
+# ==========================================
+
+QUOTA_PER_MINUTE = 60 # Sheets API 每位使用者每分鐘的讀取/寫入上限 (各自計算)
+WINDOW = 200 # 每個項目保留最近幾次做百分位數
+MAX_EVENTS = 20000 # 尚未匯出的事件最多保留筆數
+
+class Profiler:
+    def __init__(self, window=WINDOW):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.current = contextvars.ContextVar('profiler_run', default=None)
+        self.window = window
+        self.samples = {} # (類型, 名稱) → 最近的耗時
+        self.runs = deque(maxlen=window)
+        self.open_runs = {} # session → 尚未結束的重跑
+        self.requests = deque() # 最近一分鐘的 HTTP 請求 (時間, 讀/寫)，算配額用
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.seq = self.dumped = 0
+
+    # --- 重跑：上一次沒走到 end_run (st.stop / st.rerun) 的，以最後一筆紀錄的時間結束 ---
+    def begin_run(self, session, label=''):
+        with self.lock:
+            if session in self.open_runs: self._close(self.open_runs.pop(session))
+            run = {'session': session, 'label': label, 'start': time.time(), 'last': time.time(), 'calls': 0,
+                   'reads': 0, 'writes': 0, 'bytes_out': 0, 'bytes_in': 0, 'sheets_seconds': 0.0, 'compute': {}}
+            self.open_runs[session] = run
+        self.current.set(run)
+
+    def name_run(self, label):
+        run = self.current.get()
+        if run is not None: run['label'] = label
+
+    def end_run(self):
+        run = self.current.get()
+        if run is None: return None
+        run['last'] = time.time()
+        with self.lock:
+            if self.open_runs.get(run['session']) is run: self._close(self.open_runs.pop(run['session']))
+        self.current.set(None)
+        return run
+
+    def _close(self, run):
+        run['seconds'] = run['last'] - run['start']
+        self.runs.append(run)
+        self._event('run', run['label'], run['seconds'], calls=run['calls'], reads=run['reads'],
+                    writes=run['writes'], bytes_out=run['bytes_out'], bytes_in=run['bytes_in'])
+
+    def _event(self, kind, name, seconds, **fields):
+        self.seq += 1
+        self.events.append({'seq': self.seq, 'time': time.time(), 'kind': kind, 'name': name,
+                            'seconds': round(seconds, 6), **fields})
+
+    def _record(self, kind, name, seconds, **fields):
+        run = self.current.get()
+        with self.lock:
+            self.samples.setdefault((kind, name), deque(maxlen=self.window)).append(seconds)
+            self._event(kind, name, seconds, run=run and run['start'], **fields)
+            if run is None: return
+            run['last'] = time.time()
+            if kind == 'compute':
+                run['compute'][name] = run['compute'].get(name, 0.0) + seconds
+            else:
+                run['sheets_seconds'] += seconds
+                for key in ['calls', 'reads', 'writes', 'bytes_out', 'bytes_in']: run[key] += fields.get(key, 0)
+
+    # --- 運算區塊 ---
+    @contextmanager
+    def span(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record('compute', name, time.perf_counter() - t)
+
+    # --- 雲端呼叫：位元組與請求數由 HTTP hook 累計到目前這個呼叫上 ---
+    def sheets_call(self, name, fn):
+        outer = getattr(self.local, 'call', None)
+        call = self.local.call = {'reads': 0, 'writes': 0, 'bytes_out': 0, 'bytes_in': 0}
+        t, error = time.perf_counter(), None
+        try:
+            return fn()
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.local.call = outer
+            self._record('sheets', name, time.perf_counter() - t, calls=1, error=error, **call)
+
+    # 掛在 requests.Session 上：每個回應記一次請求 (GET 算讀取，其餘算寫入)
+    def watch_session(self, session):
+        if self._on_response not in session.hooks['response']: session.hooks['response'].append(self._on_response)
+
+    def _on_response(self, response, *args, **kwargs):
+        kind = 'reads' if response.request.method == 'GET' else 'writes'
+        body = response.request.body or b''
+        now = time.time()
+        with self.lock:
+            self.requests.append((now, kind))
+            while self.requests and self.requests[0][0] < now - 60: self.requests.popleft()
+        call = getattr(self.local, 'call', None)
+        if call is None:
+            # 不經過 sheets_call 的請求 (例如開啟試算表) 也要算進配額
+            self._record('sheets', '其他', response.elapsed.total_seconds(), **{kind: 1})
+            return
+        call[kind] += 1
+        call['bytes_out'] += len(body)
+        call['bytes_in'] += len(response.content or b'')
+
+    # ------------------------------------------
+    # 報表
+    # ------------------------------------------
+
+    # 各項目最近 window 次的耗時百分位數 (毫秒)
+    def percentiles(self):
+        with self.lock:
+            items = [(kind, name, np.array(values)) for (kind, name), values in self.samples.items()]
+        rows = [{'類型': '雲端' if kind == 'sheets' else '運算', '項目': name, '次數': len(v),
+                 'p50 ms': np.percentile(v, 50) * 1000, 'p90 ms': np.percentile(v, 90) * 1000,
+                 'p99 ms': np.percentile(v, 99) * 1000} for kind, name, v in items]
+        return pd.DataFrame(rows, columns=['類型', '項目', '次數', 'p50 ms', 'p90 ms', 'p99 ms']).round(1)
+
+    # 最近幾次重跑 (新的在前)
+    def recent_runs(self, session=None, limit=20):
+        with self.lock:
+            runs = [r for r in self.runs if session is None or r['session'] == session][-limit:][::-1]
+        return pd.DataFrame([{'時間': time.strftime('%H:%M:%S', time.localtime(r['start'])), '頁面': r['label'],
+                              '總耗時 ms': r['seconds'] * 1000, '雲端 ms': r['sheets_seconds'] * 1000,
+                              '呼叫': r['calls'], '讀取請求': r['reads'], '寫入請求': r['writes'],
+                              '送出 KB': r['bytes_out'] / 1024, '收到 KB': r['bytes_in'] / 1024} for r in runs]).round(1)
+
+    # 最近一分鐘用掉的配額 (所有 session 與背景同步合計)
+    def quota_last_minute(self):
+        now = time.time()
+        with self.lock:
+            recent = [kind for t, kind in self.requests if t >= now - 60]
+        return {'reads': recent.count('reads'), 'writes': recent.count('writes')}
+
+    # --- 匯出：上次匯出之後的事件追加到 JSONL 檔，回傳筆數 ---
+    def dump(self, path):
+        with self.lock:
+            events = [e for e in self.events if e['seq'] > self.dumped]
+            if events: self.dumped = events[-1]['seq']
+        with open(path, 'a', encoding='utf-8') as f:
+            for e in events: f.write(json.dumps(e, ensure_ascii=False) + '\n')
+        return len(events)
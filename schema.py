@@ -0,0 +1,189 @@
+import pandas as pd
+import numpy as np
+
+# ==========================================
+# 資料表欄位與清理 (不依賴 Streamlit，供 app 與儲存層共用)
+# ==========================================
+
+# 庫存表欄位 (順序必須與 Google Sheet 完全一致)
+COLUMNS = [
+    '編號', '批號', '倉庫', '分類', '名稱',
+    '寬度mm', '長度mm', '形狀', '五行',
+    '進貨數量(顆)', '進貨日期', '進貨廠商',
+    '庫存(顆)', '成本單價'
+]
+
+# 歷史紀錄欄位
+HISTORY_COLUMNS = [
+    '紀錄時間', '單號', '動作', '倉庫', '批號', '編號', '分類', '名稱', '規格',
+    '廠商', '數量變動', '成本備註'
+]
+
+# 庫存列的唯一鍵
+KEY_COLUMNS = ['編號', '批號']
+
+# 已歸檔批號欄位 (庫存表欄位 + 歸檔日期)
+INVENTORY_ARCHIVE_COLUMNS = COLUMNS + ['歸檔日期']
+
+# 庫存快照欄位 (封存時留下的某一刻庫存，只記有庫存的批號)
+SNAPSHOT_COLUMNS = ['快照時間', '編號', '批號', '倉庫', '庫存(顆)', '成本單價']
+
+NUMERIC_COLUMNS = ['寬度mm', '長度mm', '進貨數量(顆)', '庫存(顆)', '成本單價']
+
+# 記憶體中的欄位型別：重複值多的文字欄用 category，數量用 int32，尺寸與成本用 float64，時間用 datetime64
+INVENTORY_CATEGORIES = ['倉庫', '分類', '形狀', '五行', '進貨廠商']
+INVENTORY_INTS = ['進貨數量(顆)', '庫存(顆)']
+INVENTORY_FLOATS = ['寬度mm', '長度mm', '成本單價']
+HISTORY_CATEGORIES = ['動作', '倉庫', '分類', '廠商']
+HISTORY_INTS = ['數量變動']
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# --- 數字欄：已經是數字的直接用，只有轉不過的字串 (千分位、前後空白) 才逐筆清理 ---
+# 轉不過的為 NaN
+def to_numbers(s):
+    if s.dtype.kind in 'biuf': return s
+    v = pd.to_numeric(s, errors='coerce')
+    retry = v.isna()
+    if retry.any():
+        v = v.astype('float64')
+        v[retry] = pd.to_numeric(s[retry].astype(str).str.replace(',', '').str.strip(), errors='coerce')
+    return v
+
+def parse_numbers(s):
+    return to_numbers(s).fillna(0)
+
+# --- 清理庫存表 (欄位補齊、名稱去空白、數字去千分位) ---
+def clean_inventory(df):
+    if df.empty: return pd.DataFrame(columns=COLUMNS)
+    df.columns = df.columns.astype(str).str.strip().str.replace('\ufeff', '')
+
+    if 'label' in df.columns: df = df.drop(columns=['label'])
+    if '批號' not in df.columns: df['批號'] = '初始存貨'
+    if '倉庫' not in df.columns: df.insert(1, '倉庫', 'Imeng')
+    for col in COLUMNS:
+        if col not in df.columns: df[col] = ""
+
+    df = df[COLUMNS].copy().fillna("")
+    # 雲端以原始值讀取時，文字欄也可能拿到數字 (例如純數字的批號)
+    for col in COLUMNS:
+        if col not in NUMERIC_COLUMNS: df[col] = df[col].astype(str)
+    # 讀取時清理名稱空白
+    df['名稱'] = df['名稱'].str.strip()
+
+    for col in NUMERIC_COLUMNS:
+        df[col] = parse_numbers(df[col])
+
+    return df
+
+# --- 清理歷史紀錄 (欄位補齊) ---
+def clean_history(df):
+    if df.empty: return pd.DataFrame(columns=HISTORY_COLUMNS)
+    for col in HISTORY_COLUMNS:
+        if col not in df.columns: df[col] = ""
+    return df[HISTORY_COLUMNS].copy()
+
+# --- 轉成寫入雲端的字串 (nan 轉 0 或空字串，整數不帶 .0) ---
+def to_sheet_strings(df, columns=COLUMNS):
+    out = df[columns].astype(str).replace({'nan': '', 'None': '', '<NA>': ''})
+    for col in NUMERIC_COLUMNS:
+        if col not in columns: continue
+        v = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(float)
+        out[col] = np.where(v % 1 == 0, v.round().astype('int64').astype(str), v.astype(str))
+    return out
+
+# ==========================================
+# 型別化：雲端/本地都是字串，載入記憶體時轉成精簡的欄位型別
+# 已經是目標型別的欄位不重算，所以每次異動後都可以再呼叫一次
+# ==========================================
+
+# --- 時間字串 → datetime64 (先用固定格式，對不上的再逐筆猜) ---
+def parse_times(s):
+    if pd.api.types.is_datetime64_any_dtype(s): return s
+    text = s.fillna('').astype(str).str.strip()
+    t = pd.to_datetime(text, format=TIME_FORMAT, errors='coerce')
+    retry = t.isna() & (text != '')
+    if retry.any(): t[retry] = pd.to_datetime(text[retry], format='mixed', errors='coerce')
+    return t
+
+def _typed(df, columns, categories, ints, floats=(), times=()):
+    out = df.reindex(columns=columns)
+    for col in columns:
+        s = out[col]
+        if col in categories:
+            if not isinstance(s.dtype, pd.CategoricalDtype): out[col] = s.fillna('').astype(str).astype('category')
+        elif col in ints:
+            if s.dtype != 'int32': out[col] = parse_numbers(s).round().astype('int32')
+        elif col in floats:
+            if s.dtype != 'float64': out[col] = parse_numbers(s).astype('float64')
+        elif col in times:
+            out[col] = parse_times(s)
+        elif s.isna().any():
+            out[col] = s.fillna('')
+    return out
+
+def type_inventory(df):
+    return _typed(df, COLUMNS, INVENTORY_CATEGORIES, INVENTORY_INTS, INVENTORY_FLOATS)
+
+def type_history(df):
+    return _typed(df, HISTORY_COLUMNS, HISTORY_CATEGORIES, HISTORY_INTS, times=['紀錄時間'])
+
+# --- 串接時先統一 category 的類別，避免 pd.concat 退回 object ---
+def _concat(frames, typer, categories, ignore_index=True):
+    frames = [typer(f) for f in frames]
+    for col in categories:
+        cats = pd.api.types.union_categoricals([f[col] for f in frames], ignore_order=True).categories
+        frames = [f.assign(**{col: f[col].cat.set_categories(cats)}) for f in frames]
+    return pd.concat(frames, ignore_index=ignore_index)
+
+# 庫存保留各列的 index (雲端列號)
+def concat_inventory(frames):
+    return _concat(frames, type_inventory, INVENTORY_CATEGORIES, ignore_index=False)
+
+def concat_history(frames):
+    return _concat(frames, type_history, HISTORY_CATEGORIES)
+
+# --- 修改單一列 (category 欄遇到新的值先補類別，數量欄維持 int32) ---
+def set_cells(df, idx, values):
+    for col, v in values.items():
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype) and v not in s.cat.categories:
+            df[col] = s.cat.add_categories([v])
+        elif s.dtype == 'int32':
+            v = int(round(float(v)))
+        df.at[idx, col] = v
+
+# ==========================================
+# 載入檢查：回傳問題描述 (只提示，不擋載入)
+# raw 為雲端讀到、尚未轉型的字串表
+# ==========================================
+
+def _bad_numbers(raw, col):
+    v = to_numbers(raw[col])
+    missing = v.isna()
+    return int((raw.loc[missing, col].astype(str).str.strip() != '').sum())
+
+def validate_inventory(raw):
+    issues = []
+    if raw.empty: return issues
+    for col in NUMERIC_COLUMNS:
+        if col in raw.columns and (n := _bad_numbers(raw, col)): issues.append(f"{col}: {n} 筆不是數字，以 0 計")
+    for col in INVENTORY_INTS:
+        if col not in raw.columns: continue
+        v = to_numbers(raw[col])
+        if (n := int((v % 1 > 0).sum())): issues.append(f"{col}: {n} 筆有小數，已四捨五入")
+        if (n := int((v < 0).sum())): issues.append(f"{col}: {n} 筆為負數")
+    if '編號' in raw.columns:
+        if (n := int((raw['編號'].astype(str).str.strip() == '').sum())): issues.append(f"編號: {n} 筆空白")
+        keys = [c for c in KEY_COLUMNS if c in raw.columns]
+        if (n := int(raw.duplicated(subset=keys).sum())): issues.append(f"(編號, 批號) 重複 {n} 筆")
+    return issues
+
+def validate_history(raw):
+    issues = []
+    if raw.empty: return issues
+    if '紀錄時間' in raw.columns:
+        text = raw['紀錄時間'].astype(str).str.strip()
+        if (n := int((parse_times(text).isna() & (text != '')).sum())): issues.append(f"紀錄時間: {n} 筆無法解析")
+    if '數量變動' in raw.columns and (n := _bad_numbers(raw, '數量變動')):
+        issues.append(f"數量變動: {n} 筆不是數字，以 0 計")
+    return issues
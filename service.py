@@ -0,0 +1,232 @@
+import argparse
+import json
+import sys
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+from inventory_ops import resolve_cart, apply_checkout, apply_restock, new_batch_row, apply_withdraw
+from schema import COLUMNS, KEY_COLUMNS
+from sheets import SHEET_ID, KEY_FILE, SheetConnection, key_file_credentials
+from storage import INVENTORY, LocalStore, StaleDataError, SyncWorker
+
+# ==========================================
+# 服務層 (不依賴 Streamlit)：給 POS、網店訂單與批次腳本用
+# 一批動作先全部套在同一份庫存副本上，全部檢查通過才用 LocalStore.commit 提交一次
+# (雲端是同一個 batch_update)；任何一筆不合法時整批都不寫入
+# 動作格式 (JSON)：
+#   {"type": "restock",   "編號": "ST1", "批號": "初始存貨", "數量": 10, "總成本": 150}
+#   {"type": "new_batch", "編號": "ST1", "新批號": "20250101-A", "數量": 10, "總成本": 150}
+#       (複製同編號的 "批號" 那一列，省略時取最後一批)
+#   {"type": "withdraw",  "編號": "ST1", "批號": "初始存貨", "數量": 2, "原因": "損壞", "備註": ""}
+#   {"type": "order",     "單號": "POS-1001", "備註": "", "items": [{"編號": "ST1", "批號": "初始存貨", "數量": 3}]}
+# 同一批裡新建的批號要等下一批才能補貨或領出
+# ==========================================
+
+# 部署：python service.py serve (或 python service.py run 動作.json)，與 Streamlit 程式同時執行
+# 兩個程序各有自己的 outbox，都寫同一份試算表：寫入前檢查版本 (版本變了就以雲端最新資料重新套用)，
+# 寫入後讀回版本儲存格的識別碼，被別人蓋過時把這次的庫存增減補回去
+# 仍有的風險：檢查版本與寫入之間沒有鎖，若對方「檢查→寫入」的空檔完整包住這邊的「寫入→讀回」，
+# 兩邊都讀回自己的識別碼，同一格的數量可能遺失；名稱、價格等非數量欄位同時修改時以後寫的為準
+# 要完全避免就只開一個寫入程序 (例如 POS 也透過 Streamlit 那台機器的服務送出)
+SERVICE_DB = "if_service.db" # 與 Streamlit 程式分開的本地資料庫 (兩個程序不共用 outbox)
+
+# --- 整批驗證失敗：issues 為每筆的問題 ---
+class BatchError(ValueError):
+    def __init__(self, issues):
+        super().__init__('；'.join(issues))
+        self.issues = issues
+
+def _qty(op):
+    try:
+        qty = int(op['數量'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("數量必須是整數")
+    if qty <= 0: raise ValueError("數量必須大於 0")
+    return qty
+
+def _cost(op):
+    try:
+        return float(op.get('總成本', 0) or 0)
+    except (TypeError, ValueError):
+        raise ValueError("總成本必須是數字")
+
+def _key(op):
+    if not str(op.get('編號', '')).strip(): raise ValueError("缺少編號")
+    return str(op['編號']).strip(), str(op.get('批號', '')).strip()
+
+# --- 目前庫存 (keys 為 (編號, 批號) 清單，省略時全部) ---
+def stock_levels(inventory, keys=None, skus=None):
+    df = inventory[['編號', '批號', '倉庫', '名稱', '庫存(顆)']].astype(str)
+    if keys is not None: df = df[pd.MultiIndex.from_frame(df[KEY_COLUMNS]).isin(list(keys))]
+    if skus: df = df[df['編號'].isin(list(skus))]
+    return [{'編號': r[0], '批號': r[1], '倉庫': r[2], '名稱': r[3], '庫存': int(r[4])}
+            for r in df.itertuples(index=False)]
+
+class InventoryService:
+    def __init__(self, store):
+        self.store = store
+        # 同一程序內一次處理一批 (讀快照到提交之間不讓別批插進來)
+        self.lock = threading.Lock()
+
+    def stock(self, skus=None):
+        _, inv = self.store.snapshot(INVENTORY)
+        return stock_levels(inv, skus=skus)
+
+    # --- 套用一批動作 ---
+    # push=True 時當場推送 (一批一個 batch_update)，回傳雲端結果；False 時留給 SyncWorker 在背景送出
+    # 回傳 {'ticket', 'status' (done / pending / retrying / rejected), 'error', 'logs', 'stock': 動到的批號的庫存}
+    def run_batch(self, ops, push=True, now=None):
+        now = now or datetime.now()
+        timestamp, today = now.strftime("%Y-%m-%d %H:%M"), now.date().isoformat()
+        if not isinstance(ops, list) or not ops: raise BatchError(["沒有任何動作"])
+        with self.lock:
+            version, base = self.store.snapshot(INVENTORY)
+            inv = base.copy()
+            new_rows, logs, touched, issues = [], [], [], []
+            for i, op in enumerate(ops, 1):
+                try:
+                    if not isinstance(op, dict): raise ValueError("格式錯誤")
+                    touched += self._apply_one(inv, op, timestamp, today, new_rows, logs)
+                except ValueError as e:
+                    issues.append(f"第 {i} 筆: {e}")
+            if issues: raise BatchError(issues)
+            changed = not inv.equals(base)
+            _, ticket = self.store.commit(inv if changed else None, base if changed else None,
+                                          pd.DataFrame(new_rows)[COLUMNS] if new_rows else None, logs, version)
+        if push and ticket: self.store.push()
+        status, _, error = self.store.write_status([ticket]).get(ticket, ('done', 0, None))
+        _, inv = self.store.snapshot(INVENTORY)
+        return {'ticket': ticket, 'status': status, 'error': error, 'logs': len(logs),
+                'stock': stock_levels(inv, keys=touched)}
+
+    # --- 單筆動作：直接修改 inv，新列與紀錄接到 new_rows / logs；回傳動到的 (編號, 批號) ---
+    def _apply_one(self, inv, op, timestamp, today, new_rows, logs):
+        kind = op.get('type')
+        if kind == 'order':
+            items = op.get('items')
+            if not isinstance(items, list) or not items: raise ValueError("設計單沒有品項")
+            cart = [dict(zip(KEY_COLUMNS, _key(it)), 數量=_qty(it)) for it in items]
+            resolved = resolve_cart(inv, cart)
+            missing = resolved[resolved['_row'].isna()]
+            if len(missing): raise ValueError("找不到 " + ", ".join(missing['編號'] + '/' + missing['批號']))
+            rows = resolved['_row'].astype(inv.index.dtype).values
+            resolved['名稱'] = inv.loc[rows, '名稱'].astype(str).values
+            need = resolved['數量'].groupby(rows).sum()
+            short = need[inv.loc[need.index, '庫存(顆)'].values < need.values]
+            if len(short): raise ValueError("庫存不足 " + ", ".join(inv.loc[short.index, '編號'].astype(str)
+                                                               + '/' + inv.loc[short.index, '批號'].astype(str)))
+            order_id = str(op.get('單號') or f"DES-{timestamp[:10].replace('-', '')}")
+            logs += apply_checkout(inv, resolved, order_id, str(op.get('備註', '')), timestamp)
+            return list(zip(resolved['編號'], resolved['批號']))
+
+        if kind not in ('restock', 'new_batch', 'withdraw'): raise ValueError(f"不支援的動作 {kind}")
+        sku, batch = _key(op)
+        qty = _qty(op)
+        if kind == 'new_batch':
+            same = inv.index[inv['編號'].astype(str) == sku]
+            if batch: same = same[inv.loc[same, '批號'].astype(str) == batch]
+            if same.empty: raise ValueError(f"找不到 {sku}/{batch}" if batch else f"找不到編號 {sku}")
+            new_batch = str(op.get('新批號') or '').strip()
+            if not new_batch: raise ValueError("缺少新批號")
+            taken = set(inv.loc[inv['編號'].astype(str) == sku, '批號'].astype(str))
+            taken |= {r['批號'] for r in new_rows if r['編號'] == sku}
+            if new_batch in taken: raise ValueError(f"{sku}/{new_batch} 已存在")
+            new_row, log = new_batch_row(inv, same[-1], new_batch, qty, _cost(op), timestamp, today)
+            new_rows.append(new_row); logs.append(log)
+            return [(sku, new_batch)]
+
+        found = inv.index[(inv['編號'].astype(str) == sku) & (inv['批號'].astype(str) == batch)]
+        if found.empty: raise ValueError(f"找不到 {sku}/{batch}")
+        idx = found[0]
+        if kind == 'restock':
+            logs.append(apply_restock(inv, idx, qty, _cost(op), timestamp))
+        else:
+            left = int(inv.at[idx, '庫存(顆)'])
+            if left < qty: raise ValueError(f"{sku}/{batch} 庫存不足 (剩 {left})")
+            logs.append(apply_withdraw(inv, idx, qty, str(op.get('原因') or '商品'), str(op.get('備註', '')), timestamp))
+        return [(sku, batch)]
+
+# ==========================================
+# HTTP：POST /batch (動作清單) → 結果；GET /stock?sku=ST1&sku=ST2 → 庫存
+# 200 已寫入 (雲端沒送成功時 status 為 retrying，由 SyncWorker 重試)、400 整批不合法、409 雲端版本衝突被退回或本地資料對不上
+# ==========================================
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/stock': return self._send(404, {'error': 'not found'})
+            self._send(200, {'stock': service.stock(parse_qs(url.query).get('sku'))})
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/batch': return self._send(404, {'error': 'not found'})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'null')
+                result = service.run_batch(batch_ops(body))
+            except BatchError as e:
+                return self._send(400, {'error': str(e), 'issues': e.issues})
+            except StaleDataError as e:
+                return self._send(409, {'error': str(e)})
+            except ValueError as e:
+                return self._send(400, {'error': f"JSON 格式錯誤: {e}"})
+            self._send(409 if result['status'] == 'rejected' else 200, result)
+    return Handler
+
+# --- 請求本文可以是動作清單，或 {"ops": [...]} ---
+def batch_ops(body):
+    return body.get('ops') if isinstance(body, dict) else body
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="庫存服務 (批次補貨 / 出庫 / 設計單)")
+    parser.add_argument('--db', default=SERVICE_DB)
+    parser.add_argument('--key-file', default=KEY_FILE)
+    parser.add_argument('--sheet-id', default=SHEET_ID)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('apply', help="套用一批動作 (JSON 檔，- 為標準輸入)")
+    p.add_argument('file')
+    p = sub.add_parser('stock', help="列出庫存")
+    p.add_argument('sku', nargs='*')
+    p = sub.add_parser('serve', help="啟動本機 HTTP 服務")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8502)
+    args = parser.parse_args(argv)
+
+    connection = SheetConnection(lambda: key_file_credentials(args.key_file), args.sheet_id)
+    store = LocalStore(args.db, connection.adapter())
+    service = InventoryService(store)
+    # CLI 先推送上次沒送出的寫入，再拉雲端最新內容
+    store.push()
+    store.pull([INVENTORY])
+    if args.command == 'serve':
+        SyncWorker(store).start()
+        print(f"listening on http://{args.host}:{args.port}", file=sys.stderr)
+        ThreadingHTTPServer((args.host, args.port), make_handler(service)).serve_forever()
+        return 0
+    if args.command == 'stock':
+        result = {'stock': service.stock(args.sku or None)}
+    else:
+        with (sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')) as f:
+            ops = batch_ops(json.load(f))
+        try:
+            result = service.run_batch(ops)
+        except BatchError as e:
+            result = {'error': str(e), 'issues': e.issues}
+        except StaleDataError as e:
+            result = {'error': str(e), 'status': 'rejected'}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 1 if 'issues' in result or result.get('status') == 'rejected' else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
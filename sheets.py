@@ -0,0 +1,74 @@
+import threading
+
+import gspread
+import requests
+from google.auth.exceptions import RefreshError
+from oauth2client.service_account import ServiceAccountCredentials
+
+from storage import INVENTORY, HISTORY, META, GSheetAdapter, sheet_name, table_columns
+
+# ==========================================
+# Google Sheets 連線設定與工作表開啟 (不依賴 Streamlit，Streamlit 程式與服務層共用)
+# 整個程序共用一組連線 (憑證、HTTP session、試算表與工作表物件)
+# token 過期時由 AuthorizedSession 自動更新，不必每次重新 authorize；認證或網路錯誤時整組丟掉重建
+# ==========================================
+
+SHEET_ID = "1gf-pn034w0oZx8jWDUJvmIyHX_O7eHbiBb9diVSBX0Q"
+KEY_FILE = "google_key.json"
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+def key_file_credentials(key_file=KEY_FILE):
+    return ServiceAccountCredentials.from_json_keyfile_name(key_file, SCOPE)
+
+def is_connection_error(e):
+    if isinstance(e, (RefreshError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)): return True
+    return isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 401
+
+# --- 資料表對應的工作表 (庫存為第一個工作表)；不存在時建立 (庫存與歷史紀錄除外) ---
+def open_table(spreadsheet, table):
+    name = sheet_name(table)
+    try:
+        return spreadsheet.sheet1 if name is None else spreadsheet.worksheet(name)
+    except gspread.exceptions.WorksheetNotFound:
+        if table in (INVENTORY, HISTORY): raise
+        cols = 3 if table == META else len(table_columns(table))
+        return spreadsheet.add_worksheet(title=name, rows=2, cols=cols)
+
+class SheetConnection:
+    # credentials()：回傳憑證；on_client(client)：建立新連線時呼叫 (例如掛上效能紀錄)
+    def __init__(self, credentials=key_file_credentials, sheet_id=SHEET_ID, on_client=None):
+        self.credentials, self.sheet_id, self.on_client = credentials, sheet_id, on_client
+        self.lock = threading.Lock()
+        self._spreadsheet, self._sheets = None, {}
+
+    def reset(self):
+        with self.lock:
+            self._spreadsheet, self._sheets = None, {}
+
+    def spreadsheet(self):
+        with self.lock:
+            if self._spreadsheet is None:
+                client = gspread.authorize(self.credentials())
+                if self.on_client: self.on_client(client)
+                self._spreadsheet = client.open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    def open_worksheet(self, table):
+        ws = self._sheets.get(table)
+        if ws is None:
+            ws = open_table(self.spreadsheet(), table)
+            with self.lock: self._sheets[table] = ws
+        return ws
+
+    # --- 呼叫雲端：認證或網路錯誤時重建連線；retry 只給可重複執行的操作 ---
+    def call(self, fn, retry=True):
+        try:
+            return fn()
+        except Exception as e:
+            if not is_connection_error(e): raise
+            self.reset()
+            if not retry: raise
+            return fn()
+
+    def adapter(self, profiler=None):
+        return GSheetAdapter(self.open_worksheet, call=self.call, profiler=profiler)
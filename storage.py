@@ -0,0 +1,1094 @@
+import contextvars
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import gspread
+import requests
+
+from archive import SNAPSHOT_TIME_FORMAT, month_of, months_between, archivable_count, snapshot_rows, rebuild_stock
+from schema import (COLUMNS, HISTORY_COLUMNS, NUMERIC_COLUMNS, INVENTORY_INTS, SNAPSHOT_COLUMNS, INVENTORY_ARCHIVE_COLUMNS, clean_inventory, clean_history,
+                    to_sheet_strings, type_inventory, type_history, concat_inventory, concat_history, validate_inventory,
+                    validate_history)
+
+# ==========================================
+# 本地 SQLite 儲存層 + 背景同步 Google Sheets
+# 讀寫都先落在本地資料庫，變更排進 outbox 由背景執行緒推送到雲端
+# ==========================================
+
+INVENTORY, HISTORY, SNAPSHOTS = 'inventory', 'history', 'snapshots'
+INVENTORY_ARCHIVE = 'inventory_archive' # 已歸檔的空批號
+TABLE_COLUMNS = {INVENTORY: COLUMNS, HISTORY: HISTORY_COLUMNS, SNAPSHOTS: SNAPSHOT_COLUMNS,
+                 INVENTORY_ARCHIVE: INVENTORY_ARCHIVE_COLUMNS}
+ARCHIVE_PREFIX = 'archive:' # 封存表：archive:YYYY-MM，一個月一張，欄位同歷史紀錄
+
+def archive_table(month):
+    return ARCHIVE_PREFIX + month
+
+def table_columns(table):
+    return HISTORY_COLUMNS if table.startswith(ARCHIVE_PREFIX) else TABLE_COLUMNS[table]
+PUSH_BATCH = 200 # 每次推送最多合併的 outbox 筆數
+
+# ------------------------------------------
+# 1. 雲端轉接器：GSheetAdapter 接 Google Sheets，MemorySheetAdapter 給離線測試用
+#    介面：read / meta / revision / commit / rewrite，資料都是「字串列」
+#    commit 的 changes：{'append': 新庫存列, 'update': [[列, 欄, 值]], 'base': 每格的 [編號, 批號, 原本的值], 'history': 新紀錄列,
+#                        'archive': {月份: 紀錄列}, 'trim_history': 刪掉歷史紀錄最前面幾列, 'snapshot': 快照列,
+#                        'retire_rows': 要刪掉的庫存列號, 'retired': 追加到歸檔表的列}
+# ------------------------------------------
+
+META = 'meta' # 放版本儲存格的工作表：A1:B1 版本 (C1 為最後一次寫入的識別碼)，A2:B2 已封存的月份 (逗號分隔)
+
+# 各資料表對應的工作表 (庫存為第一個工作表)；Meta 只放版本儲存格，第一次用到時建立
+# 封存表一個月一張 (History 2025-01)，快照、封存表與已歸檔批號也是第一次寫入時建立
+SHEET_NAMES = {INVENTORY: None, HISTORY: "History", META: "Meta", SNAPSHOTS: "Snapshots",
+               INVENTORY_ARCHIVE: "Archived Batches"}
+
+def sheet_name(table):
+    return f"History {table[len(ARCHIVE_PREFIX):]}" if table.startswith(ARCHIVE_PREFIX) else SHEET_NAMES[table]
+
+class StaleRevisionError(Exception):
+    # 雲端版本已經不是本地同步時的版本 (其他程序先寫入了)，這次提交不送出
+    def __init__(self, expected, current):
+        super().__init__(f"雲端資料已被其他人更新 (版本 {expected} → {current})")
+        self.expected, self.current = expected, current
+
+class ConcurrentWriteError(Exception):
+    # 提交已經寫入，但寫完讀回的識別碼不是自己的：其他程序幾乎同時以同一個版本寫入 (檢查版本與寫入之間沒有鎖)，
+    # 兩邊改到的同一格可能互相覆蓋；revision 為讀回的雲端版本
+    def __init__(self, revision):
+        super().__init__(f"其他程序同時寫入雲端 (版本 {revision})")
+        self.revision = revision
+
+class StaleDataError(Exception):
+    # session 手上的庫存對不上本地資料 (批號已被歸檔或改掉、雲端欄位順序不同)：不寫入，重新載入後再操作
+    pass
+
+def _row_data(values):
+    return {'values': [{'userEnteredValue': {'stringValue': str(v)}} for v in values]}
+
+def _parse_meta(rows):
+    cell = lambda r: rows[r][1] if len(rows) > r and len(rows[r]) > 1 else ''
+    return int(cell(0) or 0), sorted(m for m in str(cell(1)).split(',') if m)
+
+# 每張表要追加的列 (封存的月份依序排在後面)
+# --- 列號 → 連續區段 [(起, 迄)]，由下往上 ---
+def _row_ranges(rows):
+    ranges = []
+    for r in sorted(set(rows), reverse=True):
+        if ranges and ranges[-1][0] == r + 1: ranges[-1][0] = r
+        else: ranges.append([r, r])
+    return [tuple(x) for x in ranges]
+
+def _appends(changes):
+    return ([(INVENTORY, changes.get('append')), (HISTORY, changes.get('history')), (SNAPSHOTS, changes.get('snapshot')),
+             (INVENTORY_ARCHIVE, changes.get('retired'))]
+            + [(archive_table(m), rows) for m, rows in sorted((changes.get('archive') or {}).items())])
+
+class GSheetAdapter:
+    # open_worksheet(table) 回傳 gspread 工作表 (META 不存在時要負責建立)；call(fn, retry) 負責重試與重建連線
+    # profiler (profiling.Profiler) 有給時記錄每個呼叫的耗時與流量
+    def __init__(self, open_worksheet, call=None, profiler=None):
+        self.open_worksheet = open_worksheet
+        self.call = call or (lambda fn, retry=True: fn())
+        self.profiler = profiler
+        self._has_header = set()
+
+    def _call(self, name, fn, retry=True):
+        if self.profiler is None: return self.call(fn, retry=retry)
+        return self.profiler.sheets_call(name, lambda: self.call(fn, retry=retry))
+
+    # 以原始值讀取：數字直接是 int/float，不必再去千分位；日期時間仍給顯示用的字串
+    def read(self, table):
+        try:
+            return self._call('get_values', lambda: self.open_worksheet(table).get_values(
+                value_render_option=gspread.utils.ValueRenderOption.unformatted,
+                date_time_render_option=gspread.utils.DateTimeOption.formatted_string))
+        except gspread.exceptions.WorksheetNotFound:
+            return []
+
+    def revision(self):
+        return self.meta()[0]
+
+    # (版本, 已封存的月份)，一次讀回
+    def meta(self):
+        return _parse_meta(self._call('get_values', lambda: self.open_worksheet(META).get_values(
+            range_name='A:B', value_render_option=gspread.utils.ValueRenderOption.unformatted)))
+
+    # --- 一次提交：兩張表的變動 + 版本 +1 合成一個 spreadsheet.batch_update ---
+    # expected_revision 與雲端不同時丟出 StaleRevisionError；None 表示本地還不知道版本，不檢查
+    def commit(self, changes, expected_revision):
+        current, months = self.meta()
+        if expected_revision is not None and current != expected_revision:
+            raise StaleRevisionError(expected_revision, current)
+        requests = []
+        # 先追加再改儲存格：同一批裡的修改可能落在剛追加的列上
+        for table, rows in _appends(changes):
+            if not rows: continue
+            ws = self.call(lambda: self.open_worksheet(table))
+            # 空白的工作表先補上標題列 (每個程序只檢查一次)
+            if table not in self._has_header:
+                if not self._call('row_values', lambda: ws.row_values(1)): rows = [table_columns(table)] + rows
+                self._has_header.add(table)
+            requests.append({'appendCells': {'sheetId': ws.id, 'rows': [_row_data(r) for r in rows],
+                                             'fields': 'userEnteredValue'}})
+        if changes.get('update'):
+            sheet_id = self.call(lambda: self.open_worksheet(INVENTORY)).id
+            requests += [{'updateCells': {'start': {'sheetId': sheet_id, 'rowIndex': r - 1, 'columnIndex': c - 1},
+                                          'rows': [_row_data([v])], 'fields': 'userEnteredValue'}}
+                         for r, c, v in changes['update']]
+        # 歸檔：庫存列由下往上刪 (連續的列一起刪)，前面的列號才不會跑掉
+        if changes.get('retire_rows'):
+            inventory_id = self.call(lambda: self.open_worksheet(INVENTORY)).id
+            requests += [{'deleteDimension': {'range': {'sheetId': inventory_id, 'dimension': 'ROWS',
+                                                        'startIndex': start - 1, 'endIndex': end}}}
+                         for start, end in _row_ranges(changes['retire_rows'])]
+        # 封存：歷史紀錄最前面幾列 (標題列之後) 刪掉
+        if changes.get('trim_history'):
+            history_id = self.call(lambda: self.open_worksheet(HISTORY)).id
+            requests.append({'deleteDimension': {'range': {'sheetId': history_id, 'dimension': 'ROWS', 'startIndex': 1,
+                                                           'endIndex': 1 + changes['trim_history']}}})
+        meta = self.call(lambda: self.open_worksheet(META))
+        token = uuid.uuid4().hex
+        meta_rows = [{'values': [{'userEnteredValue': {'stringValue': '版本'}},
+                                 {'userEnteredValue': {'numberValue': current + 1}},
+                                 {'userEnteredValue': {'stringValue': token}}]}]
+        if changes.get('archive'):
+            all_months = ','.join(sorted(set(months) | set(changes['archive'])))
+            meta_rows.append({'values': [{'userEnteredValue': {'stringValue': '封存月份'}},
+                                         {'userEnteredValue': {'stringValue': all_months}}]})
+        requests.append({'updateCells': {'start': {'sheetId': meta.id, 'rowIndex': 0, 'columnIndex': 0},
+                                         'rows': meta_rows, 'fields': 'userEnteredValue'}})
+        self._call('batch_update', lambda: meta.spreadsheet.batch_update({'requests': requests}), retry=False)
+        # 讀回版本儲存格：識別碼不是這次的，表示別人在「讀版本 → 寫入」之間也寫了 (多一次讀取換來偵測)
+        written = self._call('get_values', lambda: meta.get_values(
+            range_name='A1:C1', value_render_option=gspread.utils.ValueRenderOption.unformatted))
+        row = (written or [[]])[0] + ['', '', '']
+        if str(row[2]) != token: raise ConcurrentWriteError(max(int(row[1] or 0), current + 1))
+        return current + 1
+
+    # --- 整頁重寫 (維護用)：一樣先檢查版本，寫完版本 +1；回傳新版本 ---
+    def rewrite(self, table, rows, expected_revision):
+        current, _ = self.meta()
+        if expected_revision is not None and current != expected_revision:
+            raise StaleRevisionError(expected_revision, current)
+        self._call('clear', lambda: self.open_worksheet(table).clear())
+        self._call('update', lambda: self.open_worksheet(table).update(range_name='A1', values=rows))
+        self._has_header.add(table)
+        self._call('update', lambda: self.open_worksheet(META).update(
+            range_name='A1', values=[['版本', current + 1, uuid.uuid4().hex]]), retry=False)
+        return current + 1
+
+class MemorySheetAdapter:
+    def __init__(self, tables=None, revision=0):
+        self.tables = {t: [list(r) for r in rows] for t, rows in (tables or {}).items()}
+        self.revision_value = revision
+        self.months = []
+
+    def read(self, table):
+        return [list(r) for r in self.tables.get(table, [])]
+
+    def revision(self):
+        return self.revision_value
+
+    def meta(self):
+        return self.revision_value, list(self.months)
+
+    def commit(self, changes, expected_revision):
+        if expected_revision is not None and self.revision_value != expected_revision:
+            raise StaleRevisionError(expected_revision, self.revision_value)
+        for table, rows in _appends(changes):
+            if not rows: continue
+            sheet = self.tables.setdefault(table, [])
+            if not sheet: sheet.append(list(table_columns(table)))
+            sheet.extend([str(v) for v in r] for r in rows)
+        sheet = self.tables.setdefault(INVENTORY, [])
+        for r, c, v in changes.get('update', []):
+            while len(sheet) < r: sheet.append([])
+            row = sheet[r - 1]
+            while len(row) < c: row.append('')
+            row[c - 1] = v
+        for r in sorted(changes.get('retire_rows', []), reverse=True): del sheet[r - 1]
+        if changes.get('trim_history'): del self.tables[HISTORY][1:1 + changes['trim_history']]
+        self.months = sorted(set(self.months) | set(changes.get('archive') or {}))
+        self.revision_value += 1
+        return self.revision_value
+
+    def rewrite(self, table, rows, expected_revision):
+        if expected_revision is not None and self.revision_value != expected_revision:
+            raise StaleRevisionError(expected_revision, self.revision_value)
+        self.tables[table] = [list(r) for r in rows]
+        self.revision_value += 1
+        return self.revision_value
+
+# ------------------------------------------
+# 2. 差異計算：找出 session 修改過的儲存格
+# ------------------------------------------
+
+# 以列 (index，共用快照的 index 就是雲端列號) 對齊比對，同一個 (編號, 批號) 有好幾列也不影響
+# 回傳 [(列, 欄位序號(1 起算), 原本的字串值, 新的字串值)]；列有新增/刪除時回傳 None
+def diff_inventory_cells(old_df, new_df):
+    if not old_df.index.is_unique or not new_df.index.is_unique or set(old_df.index) != set(new_df.index): return None
+    old_s = to_sheet_strings(old_df).reindex(new_df.index)
+    new_s = to_sheet_strings(new_df)
+    rows, cols = (old_s.values != new_s.values).nonzero()
+    return [(new_s.index[r], int(c) + 1, old_s.iat[r, c], new_s.iat[r, c]) for r, c in zip(rows, cols)]
+
+def _local_value(col, v):
+    return float(v or 0) if col in NUMERIC_COLUMNS else v
+
+def _number(v):
+    try:
+        return float(str(v).replace(',', '').strip() or 0)
+    except ValueError:
+        return 0.0
+
+# 雲端讀回的值 (數字是 int/float) 與提交裡的字串比對：數字比數值，其餘比去掉空白的字串
+def _same_cell(a, b):
+    a, b = str(a).strip(), str(b).strip()
+    if a == b: return True
+    try:
+        return float(a.replace(',', '')) == float(b.replace(',', ''))
+    except ValueError:
+        return False
+
+# --- 雲端庫存表 (字串列，含標題列) 每個 (編號, 批號) 所在的列號，與出現不只一次的鍵 ---
+def _sheet_rows(sheet):
+    row_of, dupes = {}, set()
+    for r, row in enumerate(sheet[1:], 2):
+        if not any(str(v).strip() for v in row): continue
+        k = (str(row[0]).strip(), str(row[1]).strip())
+        if k in row_of: dupes.add(k)
+        row_of[k] = r
+    return row_of, dupes
+
+# 提交裡的一格 (原本的列號 r，那一列原本的鍵 key) 現在在哪一列：
+# 鍵只有一列就用那一列；鍵重複時原本的列還是這個鍵才用原本的列；對不到回傳 None
+def _rebase_row(sheet, row_of, dupes, r, key):
+    if key not in dupes: return row_of.get(key)
+    row = sheet[r - 1] if 1 < r <= len(sheet) else None
+    return r if row is not None and (str(row[0]).strip(), str(row[1]).strip()) == key else None
+
+# --- 合併多筆提交：追加依序串接，同一儲存格以最後的值為準 (原本的值取第一筆的) ---
+def merge_changes(changes):
+    cells = {}
+    for ch in changes:
+        for (r, c, v), base in zip(ch.get('update', []), ch.get('base', [])):
+            cells[(r, c)] = (v, cells.pop((r, c), (None, base))[1])
+    archive = {}
+    for ch in changes:
+        for month, rows in (ch.get('archive') or {}).items(): archive.setdefault(month, []).extend(rows)
+    return {'append': [row for ch in changes for row in ch.get('append', [])],
+            'update': [[r, c, v] for (r, c), (v, _) in cells.items()],
+            'base': [base for _, base in cells.values()],
+            'history': [row for ch in changes for row in ch.get('history', [])],
+            'archive': archive, 'trim_history': sum(ch.get('trim_history', 0) for ch in changes),
+            'snapshot': [row for ch in changes for row in ch.get('snapshot', [])],
+            'retire_rows': [r for ch in changes for r in ch.get('retire_rows', [])],
+            'retired': [row for ch in changes for row in ch.get('retired', [])]}
+
+# --- 重試判斷：429 為配額用完，5xx 與網路錯誤為暫時性 ---
+def is_quota_error(e):
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status == 429 or 'RATE_LIMIT_EXCEEDED' in str(e) or 'Quota exceeded' in str(e)
+
+def is_transient_error(e):
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return (is_quota_error(e) or status in (500, 502, 503, 504)
+            or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)))
+
+# --- 指數退避 + 隨機抖動 (配額錯誤用較長的起始時間，Sheets 配額以分鐘計) ---
+def backoff_delay(attempt, quota=False, base=1.0, cap=64.0):
+    ceiling = min(cap, (base * 5 if quota else base) * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+# ------------------------------------------
+# 3. 本地資料庫
+# ------------------------------------------
+
+class LocalStore:
+    # snapshot_ttl：共用快照距離上次拉取超過這個秒數，就請背景同步提早拉一次
+    # full_pull_interval：雲端版本沒變時，表格距離上次整張讀取超過這個秒數才重讀 (抓直接在試算表上的手動修改)
+    def __init__(self, path, adapter, snapshot_ttl=300, full_pull_interval=1800):
+        self.adapter = adapter
+        self.snapshot_ttl = snapshot_ttl
+        self.full_pull_interval = full_pull_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.push_lock = threading.Lock()
+        # 多張表同時從雲端讀取
+        self.read_pool = ThreadPoolExecutor(max_workers=len(TABLE_COLUMNS), thread_name_prefix='sheets-read')
+        # 每張表的資料版本，session 比對版本決定是否重新讀取
+        self.versions = {INVENTORY: 0, HISTORY: 0, SNAPSHOTS: 0, INVENTORY_ARCHIVE: 0}
+        self.last_error = None
+        self.last_exception = None
+        # 最近一次從雲端載入時檢查到的資料問題 {表: [描述]}
+        self.issues = {}
+        # 每張表上次從雲端整張讀入的內容雜湊與時間 (程序內；清掉就表示下次拉取一定重讀)
+        self._fingerprints = {}
+        self._read_at = {}
+        # 共用快照 {表: (版本, DataFrame)}，所有 session 讀同一份，不可直接修改
+        self._snapshots = {}
+        # 含封存月份的歷史紀錄 (營運分析用) {名稱: ((紀錄版本, 月份), DataFrame)}
+        self._history_frames = {}
+        self.pull_requested = False
+        self._snapshot_month = None # 已確認有快照的月份 (定期快照)
+        self._layout_ok = True
+        # 被雲端版本檢查退回的寫入 {追蹤編號: 原因}
+        self.rejected = {}
+        self._init_db()
+        # 本地資料對應的雲端版本 (None：還沒拉取過，第一次提交不檢查)
+        with self.lock:
+            rev = self._get_meta('remote_revision')
+            # 雲端已封存的月份 (Meta!B2)
+            self.archived_months = json.loads(self._get_meta('archived_months', '[]'))
+        self.revision = int(rev) if rev is not None else None
+
+    def _init_db(self):
+        inv_cols = ', '.join(f'"{c}" {"REAL" if c in NUMERIC_COLUMNS else "TEXT"}' for c in COLUMNS)
+        hist_cols = ', '.join(f'"{c}" TEXT' for c in HISTORY_COLUMNS)
+        snap_cols = ', '.join(f'"{c}" {"REAL" if c in NUMERIC_COLUMNS else "TEXT"}' for c in SNAPSHOT_COLUMNS)
+        retired_cols = ', '.join(f'"{c}" TEXT' for c in INVENTORY_ARCHIVE_COLUMNS)
+        with self.lock, self.conn:
+            self.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS inventory (sheet_row INTEGER PRIMARY KEY, {inv_cols});
+                CREATE INDEX IF NOT EXISTS idx_inventory_key ON inventory ("編號", "批號");
+                CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, {hist_cols});
+                CREATE INDEX IF NOT EXISTS idx_history_time ON history ("紀錄時間");
+                CREATE TABLE IF NOT EXISTS history_archive (id INTEGER PRIMARY KEY AUTOINCREMENT, "月份" TEXT, {hist_cols});
+                CREATE INDEX IF NOT EXISTS idx_archive_month ON history_archive ("月份", "紀錄時間");
+                CREATE TABLE IF NOT EXISTS snapshots ({snap_cols});
+                CREATE INDEX IF NOT EXISTS idx_snapshot_time ON snapshots ("快照時間");
+                CREATE TABLE IF NOT EXISTS inventory_archive (id INTEGER PRIMARY KEY AUTOINCREMENT, {retired_cols});
+                CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT, op TEXT, payload TEXT,
+                                                   attempts INTEGER DEFAULT 0, last_error TEXT);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    # 回傳 outbox id，當作寫入的追蹤編號
+    def _enqueue(self, table, op, payload):
+        return self.conn.execute('INSERT INTO outbox (tbl, op, payload) VALUES (?, ?, ?)',
+                                 (table, op, json.dumps(payload, ensure_ascii=False))).lastrowid
+
+    def _changed(self, table):
+        self.versions[table] += 1
+        self.wake.set()
+        return self.versions[table]
+
+    # 提交的 tbl 欄是它動到的表 (以逗號分隔)
+    def pending_count(self, table=None):
+        with self.lock:
+            if table is None: return self.conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+            return self.conn.execute('SELECT COUNT(*) FROM outbox WHERE instr(tbl, ?) > 0', (table,)).fetchone()[0]
+
+    def _set_revision(self, revision):
+        self.revision = revision
+        with self.lock, self.conn:
+            self._set_meta('remote_revision', revision)
+
+    def _set_archived(self, months):
+        self.archived_months = sorted(set(months))
+        self._set_meta('archived_months', json.dumps(self.archived_months))
+
+    # --- 寫入狀態：{追蹤編號: ('done' | 'pending' | 'retrying' | 'rejected', 重試次數, 錯誤訊息)} ---
+    def write_status(self, tickets):
+        tickets = [t for t in tickets if t]
+        if not tickets: return {}
+        with self.lock:
+            marks = ', '.join(['?'] * len(tickets))
+            rows = {r[0]: r[1:] for r in self.conn.execute(
+                f'SELECT id, attempts, last_error FROM outbox WHERE id IN ({marks})', tickets)}
+        status = {}
+        for t in tickets:
+            if t in self.rejected: status[t] = ('rejected', 0, self.rejected[t])
+            elif t not in rows: status[t] = ('done', 0, None)
+            else: status[t] = ('retrying' if rows[t][0] else 'pending', rows[t][0], rows[t][1])
+        return status
+
+    # --- 讀取 (各表第一次用到時才從雲端拉取) ---
+    def is_loaded(self, table):
+        with self.lock:
+            return self._get_meta(f'pulled_at:{table}') is not None
+
+    def ensure_loaded(self, *tables):
+        missing = [t for t in (tables or (INVENTORY,)) if not self.is_loaded(t)]
+        if not missing: return
+        # 本地有未推送的變更時先推送，拉取才不會被略過
+        if any(self.pending_count(t) for t in missing): self.push()
+        self.pull(missing)
+
+    def _select(self, table, order):
+        cols = ', '.join(f'"{c}"' for c in TABLE_COLUMNS[table])
+        with self.lock:
+            return pd.read_sql_query(f'SELECT {cols} FROM {table} ORDER BY {order}', self.conn)
+
+    # 庫存的 index 是雲端列號：修改過的列靠它對回雲端，不必靠 (編號, 批號) 找列
+    def load_inventory(self):
+        self.ensure_loaded(INVENTORY)
+        cols = ', '.join(f'"{c}"' for c in COLUMNS)
+        with self.lock:
+            df = pd.read_sql_query(f'SELECT sheet_row, {cols} FROM inventory ORDER BY sheet_row', self.conn,
+                                   index_col='sheet_row')
+        return type_inventory(df.rename_axis(None))
+
+    def load_history(self):
+        self.ensure_loaded(HISTORY)
+        return type_history(self._select(HISTORY, 'id'))
+
+    # --- 共用快照：版本沒變就回傳同一個 DataFrame (呼叫端要修改前必須先 copy) ---
+    def snapshot(self, table=INVENTORY):
+        self.ensure_loaded(table)
+        with self.lock:
+            cached = self._snapshots.get(table)
+            if cached is None or cached[0] != self.versions[table]:
+                df = self.load_inventory() if table == INVENTORY else self.load_history()
+                cached = self._snapshots[table] = (self.versions[table], df)
+            pulled = float(self._get_meta(f'pulled_at:{table}', 0))
+        if time.time() - pulled > self.snapshot_ttl: self.request_pull()
+        return cached
+
+    def request_pull(self):
+        self.pull_requested = True; self.wake.set()
+
+    # 寫入後更新快照：寫入者手上的資料就是最新版時直接拿來用，否則丟掉讓下次重讀
+    def _patch_snapshot(self, table, base_version, build):
+        cached = self._snapshots.pop(table, None)
+        if cached is not None and base_version is not None and cached[0] == base_version:
+            self._snapshots[table] = (self.versions[table], build(cached[1]))
+
+    # --- 紀錄查詢：條件與分頁都在資料庫裡做，最新的在前 ---
+    # start/end 為 date (含當天)；其餘文字條件為「包含」，倉庫為完全相同
+    # 日期範圍碰到已封存的月份時連封存表一起查 (該月第一次用到時從雲端讀入)
+    def query_history(self, start=None, end=None, order_id='', sku='', action='', warehouse='',
+                      page=1, page_size=100):
+        cols = ', '.join(f'"{c}"' for c in HISTORY_COLUMNS)
+        months = [m for m in self.archived_months
+                  if start and m >= start.strftime('%Y-%m') and (not end or m <= end.strftime('%Y-%m'))]
+        self.load_archive(months)
+        source, src_params = f'(SELECT 1 AS part, id, {cols} FROM history)', []
+        if months:
+            marks = ', '.join(['?'] * len(months))
+            source = (f'(SELECT 0 AS part, id, {cols} FROM history_archive WHERE "月份" IN ({marks}) '
+                      f'UNION ALL SELECT 1, id, {cols} FROM history)')
+            src_params = months
+        where, params = [], []
+        if start: where.append('"紀錄時間" >= ?'); params.append(start.isoformat())
+        if end: where.append('"紀錄時間" < ?'); params.append((end + timedelta(days=1)).isoformat())
+        for col, value in [('單號', order_id), ('編號', sku), ('動作', action)]:
+            if value: where.append(f'instr("{col}", ?) > 0'); params.append(value)
+        if warehouse: where.append('"倉庫" = ?'); params.append(warehouse)
+        clause = f'WHERE {" AND ".join(where)}' if where else ''
+        params = src_params + params
+        with self.lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM {source} {clause}', params).fetchone()[0]
+            df = pd.read_sql_query(f'SELECT {cols} FROM {source} {clause} ORDER BY part DESC, id DESC LIMIT ? OFFSET ?',
+                                   self.conn, params=params + [page_size, (max(1, page) - 1) * page_size])
+        return type_history(df), total
+
+    # ------------------------------------------
+    # 封存：已結束的月份搬到各月的封存表，歷史紀錄表只留最近的部分
+    # ------------------------------------------
+
+    # --- 封存表的本地副本：已封存的月份第一次用到時從雲端讀入 (封存後內容不再變動) ---
+    def load_archive(self, months):
+        with self.lock:
+            missing = [m for m in months if m in self.archived_months and self._get_meta(f'archive_loaded:{m}') is None]
+        if not missing: return
+        futures = {m: self.read_pool.submit(contextvars.copy_context().run, self.adapter.read, archive_table(m))
+                   for m in missing}
+        raw = {m: f.result() for m, f in futures.items()}
+        with self.lock, self.conn:
+            for m, rows in raw.items():
+                self.conn.execute('DELETE FROM history_archive WHERE "月份" = ?', (m,))
+                if len(rows) > 1:
+                    width = len(rows[0])
+                    df = clean_history(pd.DataFrame([r + [''] * (width - len(r)) for r in rows[1:]], columns=rows[0]))
+                    self._insert_archive(m, df.astype(str).values.tolist())
+                self._set_meta(f'archive_loaded:{m}', time.time())
+
+    def _insert_archive(self, month, rows):
+        cols = ', '.join(['"月份"'] + [f'"{c}"' for c in HISTORY_COLUMNS])
+        marks = ', '.join(['?'] * (len(HISTORY_COLUMNS) + 1))
+        self.conn.executemany(f'INSERT INTO history_archive ({cols}) VALUES ({marks})', [[month] + r for r in rows])
+
+    # 被退回時本地的封存與快照可能多了雲端沒有的列：全部丟掉，用到時重讀
+    def _drop_archive_cache(self):
+        self.conn.execute('DELETE FROM history_archive')
+        self.conn.execute('DELETE FROM snapshots')
+        self.conn.execute('DELETE FROM inventory_archive')
+        self.conn.execute("DELETE FROM meta WHERE key LIKE 'archive_loaded:%' OR key IN (?, ?)",
+                          (f'{SNAPSHOTS}_revision', f'{INVENTORY_ARCHIVE}_revision'))
+        self._history_frames.clear()
+
+    # --- 封存 keep_from ('YYYY-MM') 之前的紀錄，同時留一份目前庫存的快照 ---
+    # 只搬最前面連續的舊紀錄 (雲端是刪掉歷史紀錄表最上面幾列)
+    # 雲端在同一個 batch_update 裡追加各月封存表、刪掉歷史紀錄開頭、追加快照；回傳 (封存筆數, 追蹤編號)
+    def archive_history(self, keep_from):
+        self.ensure_loaded(INVENTORY, HISTORY)
+        with self.lock:
+            times = pd.read_sql_query('SELECT "紀錄時間" FROM history ORDER BY id', self.conn)['紀錄時間']
+        # 同一個月之前封存過一部分時先讀入，本地副本才完整
+        self.load_archive(sorted(set(month_of(times.iloc[:archivable_count(times, keep_from)]))))
+        cols = ', '.join(f'"{c}"' for c in HISTORY_COLUMNS)
+        with self.lock:
+            hist = pd.read_sql_query(f'SELECT id, {cols} FROM history ORDER BY id', self.conn)
+            n = archivable_count(hist['紀錄時間'], keep_from)
+            if n == 0: return 0, None
+            old = hist.iloc[:n]
+            records = old[HISTORY_COLUMNS].fillna('').astype(str)
+            archive = {m: g.values.tolist() for m, g in records.groupby(month_of(old['紀錄時間']).values)}
+            snapshot = snapshot_rows(self._select(INVENTORY, 'sheet_row'), datetime.now().strftime(SNAPSHOT_TIME_FORMAT))
+            with self.conn:
+                for m, rows in archive.items(): self._insert_archive(m, rows)
+                self.conn.execute('DELETE FROM history WHERE id <= ?', (int(old['id'].iloc[-1]),))
+                self._insert_snapshot(snapshot)
+                ticket = self._enqueue(f'{HISTORY},{SNAPSHOTS},archive', 'commit',
+                                       {'archive': archive, 'trim_history': n, 'snapshot': snapshot})
+                # 新封存的月份本地已經是完整的
+                for m in archive:
+                    if m not in self.archived_months: self._set_meta(f'archive_loaded:{m}', time.time())
+                self._set_archived(self.archived_months + list(archive))
+            self._snapshots.pop(HISTORY, None)
+            self._changed(HISTORY); self._changed(SNAPSHOTS)
+        return n, ticket
+
+    # --- 只追加的附屬表 (快照、已歸檔批號) 的本地副本：雲端版本變了才重讀 (還有待推送的列時用本地的) ---
+    def _refresh_side_table(self, table):
+        with self.lock:
+            fresh = self._get_meta(f'{table}_revision') == str(self.revision) or self.pending_count(table)
+        if fresh: return
+        rows = self.adapter.read(table)
+        columns = TABLE_COLUMNS[table]
+        cols = ', '.join(f'"{c}"' for c in columns)
+        with self.lock, self.conn:
+            self.conn.execute(f'DELETE FROM {table}')
+            if len(rows) > 1:
+                width = len(columns)
+                self.conn.executemany(f'INSERT INTO {table} ({cols}) VALUES ({", ".join(["?"] * width)})',
+                                      [(r + [''] * width)[:width] for r in rows[1:]])
+            self._set_meta(f'{table}_revision', self.revision)
+
+    def _insert_snapshot(self, rows):
+        cols = ', '.join(f'"{c}"' for c in SNAPSHOT_COLUMNS)
+        self.conn.executemany(f'INSERT INTO snapshots ({cols}) VALUES ({", ".join(["?"] * len(SNAPSHOT_COLUMNS))})', rows)
+
+    # --- 定期快照：每個月第一次同步時留一份目前庫存 (約等於上個月底)，指定日期庫存從最接近的快照推算 ---
+    # 本月已經有快照時不做事；回傳追蹤編號，沒有拍時為 None
+    def snapshot_if_due(self, now=None):
+        now = now or datetime.now()
+        month = now.strftime('%Y-%m')
+        if self._snapshot_month == month or not self.is_loaded(INVENTORY): return None
+        times = self.snapshot_times()
+        if times and times[-1][:7] >= month:
+            self._snapshot_month = month
+            return None
+        with self.lock:
+            snapshot = snapshot_rows(self._select(INVENTORY, 'sheet_row'), now.strftime(SNAPSHOT_TIME_FORMAT))
+            with self.conn:
+                self._insert_snapshot(snapshot)
+                ticket = self._enqueue(SNAPSHOTS, 'commit', {'snapshot': snapshot})
+            self._snapshot_month = month
+            self._changed(SNAPSHOTS)
+        return ticket
+
+    # --- 庫存快照的時間清單 ---
+    def snapshot_times(self):
+        self._refresh_side_table(SNAPSHOTS)
+        with self.lock:
+            return [r[0] for r in self.conn.execute('SELECT DISTINCT "快照時間" FROM snapshots ORDER BY 1')]
+
+    # ------------------------------------------
+    # 空批號歸檔：庫存為 0 的舊批號搬到歸檔表，庫存表只留還會用到的列
+    # 歸檔表保留整列 (含成本單價)，歷史紀錄不動，成本紀錄不會遺失
+    # ------------------------------------------
+
+    # --- 可歸檔的批號：庫存為 0 且進貨日期早於 before (date)；進貨日期空白或看不懂的不動 ---
+    # 回傳的 index 為雲端列號
+    def retirable_batches(self, before):
+        self.ensure_loaded(INVENTORY)
+        cols = ', '.join(f'"{c}"' for c in COLUMNS)
+        with self.lock:
+            inv = pd.read_sql_query(f'SELECT sheet_row, {cols} FROM inventory ORDER BY sheet_row', self.conn,
+                                    index_col='sheet_row')
+        received = pd.to_datetime(inv['進貨日期'].astype(str).str.strip(), format='mixed', errors='coerce')
+        return inv[(inv['庫存(顆)'] == 0) & (received < pd.Timestamp(before))]
+
+    # 雲端在同一個 batch_update 裡追加歸檔表、刪掉庫存表的這些列；本地列號跟著往上補
+    # 回傳 (歸檔筆數, 追蹤編號)
+    def archive_batches(self, before, archived_on):
+        with self.lock:
+            old = self.retirable_batches(before)
+            if old.empty: return 0, None
+            retired = to_sheet_strings(old).assign(歸檔日期=archived_on)[INVENTORY_ARCHIVE_COLUMNS].values.tolist()
+            retire_rows = old.index.astype(int).tolist()
+            with self.conn:
+                self.conn.executemany('DELETE FROM inventory WHERE sheet_row = ?', [(r,) for r in retire_rows])
+                # 列號重排 (往上補掉刪除的列)：先改成負數再翻回來，避免和還沒移動的列撞號
+                rows = [r[0] for r in self.conn.execute('SELECT sheet_row FROM inventory ORDER BY sheet_row')]
+                shift = np.searchsorted(retire_rows, rows)
+                moved = [(-(r - int(k)), r) for r, k in zip(rows, shift) if k]
+                self.conn.executemany('UPDATE inventory SET sheet_row = ? WHERE sheet_row = ?', moved)
+                self.conn.execute('UPDATE inventory SET sheet_row = -sheet_row WHERE sheet_row < 0')
+                cols = ', '.join(f'"{c}"' for c in INVENTORY_ARCHIVE_COLUMNS)
+                self.conn.executemany(f'INSERT INTO inventory_archive ({cols}) VALUES '
+                                      f'({", ".join(["?"] * len(INVENTORY_ARCHIVE_COLUMNS))})', retired)
+                ticket = self._enqueue(f'{INVENTORY},{INVENTORY_ARCHIVE}', 'compact',
+                                       {'retire_rows': retire_rows, 'retired': retired})
+            self._snapshots.pop(INVENTORY, None)
+            self._changed(INVENTORY); self._changed(INVENTORY_ARCHIVE)
+        return len(retired), ticket
+
+    # --- 已歸檔的批號 (新的在前) ---
+    def retired_batches(self):
+        self._refresh_side_table(INVENTORY_ARCHIVE)
+        cols = ', '.join(f'"{c}"' for c in INVENTORY_ARCHIVE_COLUMNS)
+        with self.lock:
+            df = pd.read_sql_query(f'SELECT {cols} FROM inventory_archive ORDER BY id DESC', self.conn)
+        return clean_inventory(df.drop(columns='歸檔日期')).assign(歸檔日期=df['歸檔日期'].values)
+
+    # --- 單一封存月份的紀錄 (欄式快照匯出用) ---
+    def archived_history(self, month):
+        self.load_archive([month])
+        cols = ', '.join(f'"{c}"' for c in HISTORY_COLUMNS)
+        with self.lock:
+            df = pd.read_sql_query(f'SELECT {cols} FROM history_archive WHERE "月份" = ? ORDER BY id',
+                                   self.conn, params=[month])
+        return type_history(df)
+
+    # --- lo <= 紀錄時間 < hi 的數量變動 (含封存的月份) ---
+    def _changes_between(self, lo, hi):
+        months = [m for m in months_between(lo[:7], hi[:7]) if m in self.archived_months]
+        self.load_archive(months)
+        cols = '"紀錄時間", "編號", "批號", "數量變動"'
+        marks = ', '.join(['?'] * len(months)) or "''"
+        with self.lock:
+            return pd.read_sql_query(
+                f'SELECT {cols} FROM history_archive WHERE "月份" IN ({marks}) AND "紀錄時間" >= ? AND "紀錄時間" < ? '
+                f'UNION ALL SELECT {cols} FROM history WHERE "紀錄時間" >= ? AND "紀錄時間" < ?',
+                self.conn, params=months + [lo, hi, lo, hi])
+
+    # --- 某一天結束時的庫存：從時間最接近的快照 (目前庫存也算一份) 往後加或往前扣回紀錄 ---
+    # 回傳 (編號, 批號, 倉庫, 庫存(顆), 成本單價)，成本為快照當時的成本
+    def stock_at(self, day):
+        self.ensure_loaded(INVENTORY, HISTORY)
+        target = (day + timedelta(days=1)).isoformat() # 當天 24:00
+        now = datetime.now().strftime(SNAPSHOT_TIME_FORMAT)
+        best = min(self.snapshot_times() + [now], key=lambda t: abs(pd.Timestamp(t) - pd.Timestamp(target)))
+        base_cols = SNAPSHOT_COLUMNS[1:]
+        with self.lock:
+            if best == now:
+                base = self._select(INVENTORY, 'sheet_row')[base_cols]
+            else:
+                cols = ', '.join(f'"{c}"' for c in base_cols)
+                base = pd.read_sql_query(f'SELECT {cols} FROM snapshots WHERE "快照時間" = ?', self.conn, params=[best])
+        forward = best <= target
+        changes = self._changes_between(*((best, target) if forward else (target, best)))
+        return rebuild_stock(base, changes, forward)
+
+    # --- 營運分析用：day 之後的紀錄 (已封存的月份 + 目前的歷史紀錄)，依版本快取 ---
+    # frozen(months)：可選，回傳 {月份: DataFrame}；有的月份不必從雲端讀封存表
+    def history_since(self, day, frozen=None):
+        version, hot = self.snapshot(HISTORY)
+        months = [m for m in self.archived_months if m >= day.strftime('%Y-%m')]
+        if not months: return hot
+        key = (version, tuple(months))
+        cached = self._history_frames.get('since')
+        if cached is not None and cached[0] == key: return cached[1]
+        parts = frozen(months) if frozen else {}
+        rest = [m for m in months if m not in parts]
+        self.load_archive(rest)
+        cols = ', '.join(f'"{c}"' for c in ['月份'] + HISTORY_COLUMNS)
+        marks = ', '.join(['?'] * len(rest)) or "''"
+        with self.lock:
+            old = pd.read_sql_query(f'SELECT {cols} FROM history_archive WHERE "月份" IN ({marks}) ORDER BY "月份", id',
+                                    self.conn, params=rest)
+        parts = {**parts, **{m: g[HISTORY_COLUMNS] for m, g in old.groupby('月份')}}
+        df = concat_history([parts[m] for m in months if m in parts] + [hot])
+        self._history_frames['since'] = (key, df)
+        return df
+
+    # --- 寫入 (先寫本地，再排入 outbox) ---
+    def _insert_inventory(self, df, first_row):
+        cols = ', '.join(['sheet_row'] + [f'"{c}"' for c in COLUMNS])
+        marks = ', '.join(['?'] * (len(COLUMNS) + 1))
+        strings = to_sheet_strings(df)
+        records = [[first_row + i] + [_local_value(c, v) for c, v in zip(COLUMNS, vals)]
+                   for i, vals in enumerate(strings.values.tolist())]
+        self.conn.executemany(f'INSERT INTO inventory ({cols}) VALUES ({marks})', records)
+        return strings.values.tolist()
+
+    def _replace_inventory(self, df):
+        self.conn.execute('DELETE FROM inventory')
+        return self._insert_inventory(df, 2)
+
+    # --- 提交：一次動作的庫存修改、新增列與歷史紀錄排成同一筆寫入，雲端一個請求全部生效或全部不生效 ---
+    # df/base：session 修改後與上次同步時的庫存，只送出兩者之間的變動，不覆蓋別人的修改
+    # new_rows：要追加的新庫存列；logs：歷史紀錄 dict 清單
+    # base_version：呼叫端讀到的快照版本，用來決定能否直接更新共用快照
+    # 回傳 (庫存資料版本, 追蹤編號)，沒有任何變動時追蹤編號為 None
+    # session 的庫存對不上本地資料時丟出 StaleDataError (什麼都不寫)；整頁重寫只由 rewrite_remote 手動執行
+    def commit(self, df=None, base=None, new_rows=None, logs=None, base_version=None):
+        cells = None
+        if df is not None and base is not None:
+            if not self._layout_ok:
+                self.request_pull()
+                raise StaleDataError("雲端庫存表的欄位與程式不一致，請管理員先執行「重寫庫存表」")
+            cells = diff_inventory_cells(base, df)
+            if cells is None: raise StaleDataError("庫存的列有增減，無法只送出修改的儲存格，請重新載入後再試")
+        new_rows = new_rows if new_rows is not None and len(new_rows) else None
+        history = [[str(log.get(col, "")) for col in HISTORY_COLUMNS] for log in (logs or [])]
+        with self.lock:
+            if new_rows is not None:
+                # 新增的列不可與現有的列或彼此重複 (編號, 批號)
+                keys = list(zip(new_rows['編號'].astype(str), new_rows['批號'].astype(str)))
+                taken = [k for i, k in enumerate(keys) if k in keys[:i] or self.conn.execute(
+                    'SELECT 1 FROM inventory WHERE "編號" = ? AND "批號" = ? LIMIT 1', k).fetchone()]
+                if taken:
+                    self.request_pull()
+                    raise StaleDataError(f"{', '.join('/'.join(k) for k in taken)} 已存在，請換一個批號")
+            if cells:
+                key_of = {r: (str(base.at[r, '編號']), str(base.at[r, '批號'])) for r in {r for r, _, _, _ in cells}}
+                row_of = self._resolve_rows(key_of)
+                missing = sorted(key_of[r] for r in key_of if r not in row_of)
+                if missing:
+                    self.request_pull()
+                    raise StaleDataError(f"{', '.join('/'.join(k) for k in missing)} 已被其他人歸檔或修改，請重新載入後再試")
+            changes, ticket = {}, None
+            with self.conn:
+                if cells:
+                    for r, c, _, v in cells:
+                        col = COLUMNS[c - 1]
+                        self.conn.execute(f'UPDATE inventory SET "{col}" = ? WHERE sheet_row = ?',
+                                          (_local_value(col, v), row_of[r]))
+                    changes['update'] = [(row_of[r], c, v) for r, c, _, v in cells]
+                    # 每格修改的 (編號, 批號, 原本的值)：雲端版本變了時靠它重新對列、判斷有沒有衝突
+                    changes['base'] = [(*key_of[r], old) for r, _, old, _ in cells]
+                if new_rows is not None:
+                    last = self.conn.execute('SELECT COALESCE(MAX(sheet_row), 1) FROM inventory').fetchone()[0]
+                    changes['append'] = self._insert_inventory(new_rows, last + 1)
+                    new_rows = new_rows.set_axis(range(last + 1, last + 1 + len(new_rows)))
+                if history:
+                    cols = ', '.join(f'"{c}"' for c in HISTORY_COLUMNS)
+                    marks = ', '.join(['?'] * len(HISTORY_COLUMNS))
+                    self.conn.executemany(f'INSERT INTO history ({cols}) VALUES ({marks})', history)
+                    changes['history'] = history
+                if changes:
+                    tables = [t for t, keys in [(INVENTORY, ('update', 'append')), (HISTORY, ('history',))]
+                              if any(k in changes for k in keys)]
+                    ticket = self._enqueue(','.join(tables), 'commit', changes)
+            if 'update' in changes or 'append' in changes:
+                inv_base = base_version
+                self._changed(INVENTORY)
+                if df is not None and new_rows is not None:
+                    build = lambda snap: concat_inventory([df, new_rows])
+                elif df is not None:
+                    build = lambda snap: type_inventory(df)
+                else:
+                    build = lambda snap: concat_inventory([snap, new_rows])
+                self._patch_snapshot(INVENTORY, inv_base, build)
+            if history:
+                hist_base = self.versions[HISTORY]
+                self._changed(HISTORY)
+                # 紀錄只會追加，快照直接接上新的列
+                self._patch_snapshot(HISTORY, hist_base, lambda snap: concat_history(
+                    [snap, pd.DataFrame(history, columns=HISTORY_COLUMNS)]))
+        return self.versions[INVENTORY], ticket
+
+    # session 的列 → 本地 (雲端) 列號 {列: 列號}：那一列還是同一個 (編號, 批號) 就用原本的列號，
+    # 列號變了 (其他人歸檔或刪列) 時改用 (編號, 批號) 找，找不到或有好幾列就不列入
+    def _resolve_rows(self, key_of):
+        row_of = {}
+        for r, key in key_of.items():
+            found = self.conn.execute('SELECT "編號", "批號" FROM inventory WHERE sheet_row = ?', (int(r),)).fetchone()
+            if found and (str(found[0]), str(found[1])) == key:
+                row_of[r] = int(r); continue
+            found = self.conn.execute('SELECT sheet_row FROM inventory WHERE "編號" = ? AND "批號" = ? LIMIT 2', key).fetchall()
+            if len(found) == 1: row_of[r] = found[0][0]
+        return row_of
+
+    def append_inventory(self, df, base_version=None):
+        return self.commit(new_rows=df, base_version=base_version)
+
+    def save_inventory(self, df, base, base_version=None):
+        return self.commit(df=df, base=base, base_version=base_version)
+
+    def append_history(self, logs):
+        _, ticket = self.commit(logs=logs)
+        return self.versions[HISTORY], ticket
+
+    # --- 維護：用本地內容整頁重寫雲端 (推送時一樣檢查版本，雲端已被別人改過就退回) ---
+    # 庫存表重寫後列號從 2 開始連續編排，本地先照新的列號重排，之後的提交才會對到正確的列
+    def rewrite_remote(self, table):
+        with self.lock, self.conn:
+            if table == INVENTORY:
+                values = self._replace_inventory(self._select(INVENTORY, 'sheet_row'))
+                self._layout_ok = True
+            else:
+                values = self._select(HISTORY, 'id').fillna("").astype(str).values.tolist()
+            ticket = self._enqueue(table, 'rewrite', [TABLE_COLUMNS[table]] + values)
+        self.wake.set()
+        return ticket
+
+    # --- 推送：合併排隊中的寫入 (可能來自多個 session) 後送出 ---
+    # 依序取最前面一段提交合併成一個 batch_update，同一儲存格以最後的值為準；整頁重寫單獨送出
+    # 歸檔 (compact) 會讓後面的庫存列號改變，只能當一段的最後一筆
+    # 失敗時停下 (保持先後順序)，由 SyncWorker 退避後重試
+    # 雲端版本對不上時 (另一個程序先寫入了)，重新讀取雲端庫存後把排隊中的提交重新套上去 (見 _rebase_pending)
+    def push(self):
+        with self.push_lock:
+            return self._push()
+
+    def _push(self):
+        while True:
+            with self.lock:
+                items = self.conn.execute('SELECT id, tbl, op, payload FROM outbox ORDER BY id LIMIT ?',
+                                          (PUSH_BATCH,)).fetchall()
+            if not items:
+                self.last_error = self.last_exception = None
+                return True
+            run = [items[0]]
+            if items[0][2] != 'rewrite':
+                for it in items[1:]:
+                    if it[2] == 'rewrite' or run[-1][2] == 'compact': break
+                    run.append(it)
+            ids = [it[0] for it in run]
+            try:
+                if items[0][2] == 'rewrite':
+                    self._set_revision(self.adapter.rewrite(items[0][1], json.loads(items[0][3]), self.revision))
+                else:
+                    changes = merge_changes([json.loads(p) for _, _, _, p in run])
+                    self._set_revision(self.adapter.commit(changes, self.revision))
+            except StaleRevisionError as e:
+                if not self._rebase_pending(str(e)): return False
+                continue
+            except ConcurrentWriteError as e:
+                # 已經寫入：移出 outbox，再把被對方覆蓋掉的數量補回去
+                with self.lock, self.conn:
+                    self.conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+                self._set_revision(e.revision)
+                self._repair_overwritten(changes, str(e))
+                continue
+            except Exception as e:
+                self.last_error, self.last_exception = str(e), e
+                with self.lock, self.conn:
+                    self.conn.executemany('UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                                          [(str(e), i) for i in ids])
+                return False
+            with self.lock, self.conn:
+                self.conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+
+    # --- 同時寫入後的補救：這次改的數量欄 (庫存、進貨數量) 在雲端已經不是這次寫的值，表示被對方以舊值為基礎覆蓋，
+    #     把這次的增減 (新值 - 原本的值) 加回雲端現值，排成一筆新的提交；其他欄位以雲端現值為準
+    #     對方寫的剛好和這次相同的值時無法分辨 (見 service.py 的部署說明)
+    def _repair_overwritten(self, changes, reason):
+        try:
+            sheet = [list(r) + [''] * (len(COLUMNS) - len(r)) for r in self.adapter.read(INVENTORY)]
+        except Exception as e:
+            self.last_error, self.last_exception = f"{reason}：{e}", e
+            self.request_pull()
+            return
+        row_of, dupes = _sheet_rows(sheet)
+        update, base = [], []
+        for (r, c, v), (k0, k1, old) in zip(changes.get('update', []), changes.get('base', [])):
+            row = _rebase_row(sheet, row_of, dupes, r, (k0, k1)) if COLUMNS[c - 1] in INVENTORY_INTS else None
+            if row is None or _same_cell(sheet[row - 1][c - 1], v): continue
+            current = sheet[row - 1][c - 1]
+            update.append([row, c, str(int(round(_number(current) + _number(v) - _number(old))))])
+            base.append([k0, k1, current])
+        with self.lock:
+            self._fingerprints.pop(INVENTORY, None)
+            if update:
+                with self.conn: self._enqueue(INVENTORY, 'commit', {'update': update, 'base': base})
+        self.request_pull()
+
+    # --- 雲端版本變了：以最新的雲端庫存重新套用排隊中的提交 ---
+    # 只改儲存格 / 追加庫存列 / 追加紀錄的提交，依 (編號, 批號) 重新找列號；
+    # 改到的儲存格在雲端仍是原本的值 (或已經是同樣的新值) 才保留，否則整筆退回
+    # 追加的批號雲端已經有了、歸檔、封存與整頁重寫都是建立在舊資料上，一律退回
+    # 讀不到雲端時回傳 False (outbox 不動，等下次重試)
+    def _rebase_pending(self, reason):
+        try:
+            revision, months = self.adapter.meta()
+            sheet = [list(r) for r in self.adapter.read(INVENTORY)]
+        except Exception as e:
+            self.last_error, self.last_exception = str(e), e
+            return False
+        layout_ok = bool(sheet) and [str(h).strip() for h in sheet[0]] == COLUMNS
+        width = len(COLUMNS)
+        sheet = [r + [''] * (width - len(r)) for r in sheet]
+        with self.lock:
+            items = self.conn.execute('SELECT id, tbl, op, payload FROM outbox ORDER BY id').fetchall()
+            row_of, dupes = _sheet_rows(sheet)
+            kept, rejected, dropped_history = [], {}, []
+            for i, tbl, op, payload in items:
+                ch = json.loads(payload)
+                if op == 'rewrite': conflict = "整頁重寫是用舊資料產生的"
+                else: conflict = self._rebase_conflict(ch, sheet if layout_ok else None, row_of, dupes)
+                if conflict is not None:
+                    rejected[i] = f"{conflict} ({reason})"
+                    if op != 'rewrite': dropped_history += ch.get('history', [])
+                    continue
+                update = [[_rebase_row(sheet, row_of, dupes, r, (k0, k1)), c, v]
+                          for (r, c, v), (k0, k1, _) in zip(ch.get('update', []), ch.get('base', []))]
+                for r, c, v in update: sheet[r - 1][c - 1] = v
+                if any(c <= 2 for _, c, _ in update): row_of, dupes = _sheet_rows(sheet)
+                if ch.get('append'):
+                    while len(sheet) > 1 and not any(str(v).strip() for v in sheet[-1]): sheet.pop()
+                    for row in ch['append']:
+                        sheet.append(list(row) + [''] * (width - len(row)))
+                        row_of[(str(row[0]).strip(), str(row[1]).strip())] = len(sheet)
+                if update: ch = dict(ch, update=update)
+                kept.append((json.dumps(ch, ensure_ascii=False), i))
+            with self.conn:
+                self.conn.executemany('UPDATE outbox SET payload = ? WHERE id = ?', kept)
+                self.conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in rejected])
+                self.rejected.update(rejected)
+                # 本地庫存換成「雲端 + 保留的提交」；被退回的紀錄從本地刪掉 (同內容的最後一筆)
+                if layout_ok: self._load_remote_inventory(sheet)
+                where = ' AND '.join(f'"{c}" = ?' for c in HISTORY_COLUMNS)
+                for row in dropped_history:
+                    self.conn.execute(f'DELETE FROM history WHERE id = (SELECT MAX(id) FROM history WHERE {where})', row)
+                self._set_archived(months)
+            self._set_revision(revision)
+            self._fingerprints.clear()
+            for t in (INVENTORY, HISTORY):
+                self.versions[t] += 1
+                self._snapshots.pop(t, None)
+            # 封存與快照的本地副本丟掉，用到時重讀
+            if rejected: self._drop_archive_cache()
+        self.request_pull()
+        return True
+
+    # 回傳衝突的描述；可以重新套用時回傳 None (sheet 為 None：雲端庫存表的欄位對不上，不能改庫存)
+    @staticmethod
+    def _rebase_conflict(ch, sheet, row_of, dupes):
+        if set(ch) - {'update', 'base', 'append', 'history'}: return "歸檔或封存是用舊資料產生的"
+        update, base = ch.get('update', []), ch.get('base', [])
+        if sheet is None and (update or ch.get('append')): return "雲端庫存表的欄位與程式不一致"
+        for (r, c, v), (k0, k1, old) in zip(update, base):
+            r = _rebase_row(sheet, row_of, dupes, r, (k0, k1))
+            if r is None: return f"{k0}/{k1} 已被其他人歸檔或修改"
+            current = sheet[r - 1][c - 1]
+            if not (_same_cell(current, old) or _same_cell(current, v)): return f"{k0}/{k1} 的{COLUMNS[c - 1]}已被其他人修改"
+        for row in ch.get('append', []):
+            if (str(row[0]).strip(), str(row[1]).strip()) in row_of: return f"{row[0]}/{row[1]} 已存在"
+        return None
+
+    # --- 拉取：用雲端內容取代本地 (本地還有未推送的變更時跳過) ---
+    # tables 省略時只拉已經載入過的表；多張表同時讀取
+    # 版本儲存格先讀：讀到的資料只會比版本新，不會讓舊資料配上新版本
+    # 版本沒變、這個程序讀過且還沒超過 full_pull_interval 的表不重讀，只算一次拉取 (每分鐘只花一次讀取配額)
+    def pull(self, tables=None):
+        tables = tables or [t for t in (INVENTORY, HISTORY) if self.is_loaded(t)]
+        revision, months = self.adapter.meta()
+        now = time.time()
+        with self.lock:
+            fresh = [t for t in tables if t in self._fingerprints and revision == self.revision
+                     and now - self._read_at.get(t, 0) < self.full_pull_interval]
+            with self.conn:
+                for t in fresh: self._set_meta(f'pulled_at:{t}', now)
+        # 帶著呼叫端的 context (效能紀錄要算在發起拉取的那次重跑上)
+        futures = {t: self.read_pool.submit(contextvars.copy_context().run, self.adapter.read, t)
+                   for t in tables if t not in fresh}
+        raw = {t: f.result() for t, f in futures.items()}
+        with self.lock:
+            for t, rows in raw.items():
+                if self.pending_count(t): continue
+                fingerprint = hash(str(rows))
+                with self.conn:
+                    if self._fingerprints.get(t) != fingerprint:
+                        if t == INVENTORY: self._load_remote_inventory(rows)
+                        else: self._load_remote_history(rows)
+                        self._fingerprints[t] = fingerprint
+                        self.versions[t] += 1
+                    self._read_at[t] = now
+                    self._set_meta(f'pulled_at:{t}', time.time())
+            # 還有待推送的提交時，它們是建立在原本的版本上，不能換
+            if not self.pending_count() and (self.revision is None or revision > self.revision):
+                self._set_revision(revision)
+                with self.conn: self._set_archived(months)
+        return True
+
+    def _load_remote_inventory(self, rows):
+        self.conn.execute('DELETE FROM inventory')
+        if not rows: return
+        header = rows[0]
+        self._layout_ok = [str(h).strip() for h in header] == COLUMNS
+        width = len(header)
+        df = pd.DataFrame([r + [''] * (width - len(r)) for r in rows[1:]], columns=header)
+        # 保留原本的列號，空白列不寫入本地
+        sheet_rows = pd.Series(range(2, len(df) + 2))
+        blank = (df.astype(str).apply(lambda s: s.str.strip()) == '').all(axis=1).values
+        df, sheet_rows = df[~blank].reset_index(drop=True), sheet_rows[~blank].tolist()
+        self.issues[INVENTORY] = validate_inventory(df)
+        df = clean_inventory(df)
+        cols = ', '.join(['sheet_row'] + [f'"{c}"' for c in COLUMNS])
+        marks = ', '.join(['?'] * (len(COLUMNS) + 1))
+        self.conn.executemany(f'INSERT INTO inventory ({cols}) VALUES ({marks})',
+                              [[r] + vals for r, vals in zip(sheet_rows, df[COLUMNS].values.tolist())])
+
+    def _load_remote_history(self, rows):
+        self.conn.execute('DELETE FROM history')
+        if len(rows) < 2: return
+        width = len(rows[0])
+        df = clean_history(pd.DataFrame([r + [''] * (width - len(r)) for r in rows[1:]], columns=rows[0]))
+        self.issues[HISTORY] = validate_history(df)
+        cols = ', '.join(f'"{c}"' for c in HISTORY_COLUMNS)
+        marks = ', '.join(['?'] * len(HISTORY_COLUMNS))
+        self.conn.executemany(f'INSERT INTO history ({cols}) VALUES ({marks})', df.astype(str).values.tolist())
+
+# ------------------------------------------
+# 4. 背景同步：有變更就推送，閒置時定期拉取雲端的修改，每月第一次同步時留一份庫存快照
+# ------------------------------------------
+
+class SyncWorker(threading.Thread):
+    # batch_delay：被喚醒後稍等一下，讓連續的寫入合併成同一批
+    def __init__(self, store, pull_interval=60, batch_delay=0.5):
+        super().__init__(daemon=True, name='sheets-sync')
+        self.store = store
+        self.pull_interval = pull_interval
+        self.batch_delay = batch_delay
+        self.failures = 0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set(); self.store.wake.set()
+
+    def run(self):
+        last_pull = time.time()
+        while not self.stopped.is_set():
+            self.store.wake.clear()
+            if self.store.pending_count(): self.stopped.wait(self.batch_delay)
+            if self.store.push():
+                self.failures = 0
+                if self.store.pull_requested or time.time() - last_pull >= self.pull_interval:
+                    self.store.pull_requested = False
+                    try:
+                        self.store.pull()
+                        self.store.snapshot_if_due()
+                    except Exception as e:
+                        self.store.last_error = str(e)
+                    last_pull = time.time()
+                self.store.wake.wait(self.pull_interval)
+            else:
+                e = self.store.last_exception
+                # 非暫時性錯誤也繼續重試 (不跳過，避免順序錯亂)，但直接用較長的間隔
+                attempt = self.failures if is_transient_error(e) else max(self.failures, 4)
+                self.failures += 1
+                # 退避期間不理會新的寫入喚醒，避免配額用完時一直打
+                self.stopped.wait(backoff_delay(attempt, quota=is_quota_error(e)))
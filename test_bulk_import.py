@@ -0,0 +1,19 @@
+import pandas as pd
+
+from bulk_import import plan_import
+from test_inventory_ops import inventory
+from test_storage import inv_row
+
+# ==========================================
+# 批次匯入：新列的 (編號, 批號) 不與現有或彼此重複
+# ==========================================
+
+def test_new_rows_get_distinct_batches():
+    inv = inventory(inv_row('ST1', '20250101-01', 5))
+    raw = pd.DataFrame({'名稱': ['新石', '新石', '別的'], '寬度mm': ['4', '4', '8'], '進貨數量(顆)': ['1', '2', '3'],
+                        '倉庫': ['A', 'B', ''], '編號': ['', '', 'ST1'], '批號': ['', '', '20250101-01']})
+    plan = plan_import(inv, raw, '2025-01-01 10:00', '2025-01-01', 'NEW')
+    rows = plan['new_rows']
+    assert list(zip(rows['編號'], rows['批號'])) == [('NEW000', '20250101-01'), ('NEW000', '20250101-02')]
+    assert plan['issues'] == ['ST1/20250101-01 已存在，已略過']
+    assert len(plan['logs']) == 2
@@ -0,0 +1,30 @@
+from datetime import datetime
+
+import pytest
+
+from columnar import export_snapshot, read_manifest
+from storage import INVENTORY, HISTORY, LocalStore
+from test_storage import make_adapter, log_row
+
+pytest.importorskip('pyarrow')
+
+# ==========================================
+# 欄式快照匯出
+# ==========================================
+
+# --- 本地還沒載入歷史紀錄：只匯出庫存，不替匯出載入紀錄表 ---
+def test_export_skips_unloaded_history(tmp_path):
+    adapter = make_adapter(history=[log_row('2024-01-02 10:00', 'ST1', 'A', -2)])
+    store = LocalStore(str(tmp_path / 'store.db'), adapter)
+    store.pull([INVENTORY])
+    root = str(tmp_path / 'columnar')
+    result = export_snapshot(store, root, now=datetime(2024, 1, 3))
+    assert not store.is_loaded(HISTORY)
+    assert result['months'] == 0 and read_manifest(root)['history'] == {}
+    # 載入後才匯出紀錄；之後再遇到沒載入的情況沿用上次的月份
+    store.pull([INVENTORY, HISTORY])
+    assert export_snapshot(store, root, now=datetime(2024, 1, 4))['written'] == 1
+    other = LocalStore(str(tmp_path / 'other.db'), adapter)
+    other.pull([INVENTORY])
+    export_snapshot(other, root, now=datetime(2024, 1, 5))
+    assert list(read_manifest(root)['history']) == ['2024-01'] and not other.is_loaded(HISTORY)
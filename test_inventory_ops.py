@@ -0,0 +1,35 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from inventory_ops import next_batch, new_batch_row, rename_duplicate_batches
+from schema import COLUMNS, KEY_COLUMNS, type_inventory
+from test_storage import inv_row
+
+# ==========================================
+# 庫存異動運算：新批號與重複批號
+# ==========================================
+
+def inventory(*rows):
+    return type_inventory(pd.DataFrame([dict(zip(COLUMNS, r)) for r in rows]).set_axis(range(2, len(rows) + 2)))
+
+def test_next_batch_skips_taken():
+    inv = inventory(inv_row('ST1', '20250101-A', 1), inv_row('ST1', '20250101-B', 1), inv_row('ST2', '20250101-C', 1))
+    assert next_batch(inv, 'ST1', date(2025, 1, 1)) == '20250101-C'
+    assert next_batch(inv, 'ST2', date(2025, 1, 1)) == '20250101-A'
+
+def test_new_batch_row_rejects_existing_batch():
+    inv = inventory(inv_row('ST1', 'A', 3))
+    with pytest.raises(ValueError):
+        new_batch_row(inv, 2, 'A', 1, 10, '2025-01-01 10:00', '2025-01-01')
+    row, log = new_batch_row(inv, 2, 'B', 2, 10, '2025-01-01 10:00', '2025-01-01')
+    assert (row['編號'], row['批號'], row['庫存(顆)'], row['成本單價']) == ('ST1', 'B', 2, 5.0)
+    assert log['數量變動'] == 2
+
+def test_rename_duplicate_batches():
+    inv = inventory(inv_row('ST1', 'A', 1), inv_row('ST1', 'A', 2), inv_row('ST1', 'A-2', 3), inv_row('ST1', 'A', 4))
+    logs = rename_duplicate_batches(inv, '2025-01-01 10:00')
+    assert inv['批號'].astype(str).tolist() == ['A', 'A-3', 'A-2', 'A-4']
+    assert not inv.duplicated(KEY_COLUMNS).any()
+    assert [log['成本備註'] for log in logs] == ['原批號 A', '原批號 A'] and logs[0]['數量變動'] == 0
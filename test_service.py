@@ -0,0 +1,41 @@
+import pytest
+
+from service import BatchError, InventoryService
+from storage import HISTORY
+from test_storage import make_adapter, make_store, remote_stock
+
+# ==========================================
+# 服務層：一批動作一次提交，任何一筆不合法時整批不寫入
+# ==========================================
+
+def withdraw(sku, qty):
+    return {'type': 'withdraw', '編號': sku, '批號': 'A', '數量': qty, '原因': '損壞'}
+
+def test_run_batch_commits_once(tmp_path):
+    adapter = make_adapter()
+    service = InventoryService(make_store(tmp_path, adapter))
+    result = service.run_batch([withdraw('ST1', 3), {'type': 'restock', '編號': 'ST2', '批號': 'A', '數量': 4}])
+    assert result['status'] == 'done' and result['logs'] == 2
+    assert adapter.revision_value == 1
+    assert remote_stock(adapter) == {('ST1', 'A'): 7, ('ST2', 'A'): 9}
+    assert len(adapter.tables[HISTORY]) == 3
+
+def test_run_batch_rejects_whole_batch(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    with pytest.raises(BatchError) as e:
+        InventoryService(store).run_batch([withdraw('ST1', 3), withdraw('ST2', 99), withdraw('ST9', 1)])
+    assert len(e.value.issues) == 2
+    assert adapter.revision_value == 0 and store.pending_count() == 0
+    assert remote_stock(adapter) == {('ST1', 'A'): 10, ('ST2', 'A'): 5}
+    assert store.load_inventory()['庫存(顆)'].tolist() == [10, 5]
+    assert store.load_history().empty
+
+def test_new_batch_rejects_existing_batch(tmp_path):
+    adapter = make_adapter()
+    service = InventoryService(make_store(tmp_path, adapter))
+    with pytest.raises(BatchError):
+        service.run_batch([{'type': 'new_batch', '編號': 'ST1', '新批號': 'A', '數量': 1}])
+    result = service.run_batch([{'type': 'new_batch', '編號': 'ST1', '新批號': 'B', '數量': 2}])
+    assert result['stock'] == [{'編號': 'ST1', '批號': 'B', '倉庫': 'Imeng', '名稱': '石ST1', '庫存': 2}]
+    assert remote_stock(adapter)[('ST1', 'B')] == 2
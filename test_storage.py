@@ -0,0 +1,257 @@
+import time
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+
+from schema import COLUMNS, HISTORY_COLUMNS, set_cells
+from storage import (INVENTORY, HISTORY, SNAPSHOTS, ConcurrentWriteError, LocalStore, MemorySheetAdapter, StaleDataError,
+                     SyncWorker)
+
+# ==========================================
+# 本地儲存層 (MemorySheetAdapter，不連雲端)
+# 執行：python -m pytest -q
+# ==========================================
+
+def inv_row(sku, batch, qty, cost=1.0):
+    row = dict.fromkeys(COLUMNS, '')
+    row.update({'編號': sku, '批號': batch, '倉庫': 'Imeng', '名稱': f'石{sku}', '庫存(顆)': str(qty), '成本單價': str(cost)})
+    return [row[c] for c in COLUMNS]
+
+def log_row(when, sku, batch, change):
+    row = dict.fromkeys(HISTORY_COLUMNS, '')
+    row.update({'紀錄時間': when, '動作': '出庫', '編號': sku, '批號': batch, '數量變動': str(change)})
+    return [row[c] for c in HISTORY_COLUMNS]
+
+def make_adapter(rows=None, history=()):
+    rows = rows or [inv_row('ST1', 'A', 10), inv_row('ST2', 'A', 5)]
+    return MemorySheetAdapter({INVENTORY: [COLUMNS] + rows, HISTORY: [HISTORY_COLUMNS] + list(history)})
+
+def make_store(tmp_path, adapter, name='store.db'):
+    store = LocalStore(str(tmp_path / name), adapter)
+    store.pull([INVENTORY, HISTORY])
+    return store
+
+def remote_stock(adapter):
+    return {(r[0], r[1]): int(float(r[12])) for r in adapter.tables[INVENTORY][1:]}
+
+# --- 從目前快照改一格庫存並提交 (不推送)，回傳追蹤編號 ---
+def set_stock(store, sku, qty, logs=None):
+    version, base = store.snapshot(INVENTORY)
+    df = base.copy()
+    df.loc[df['編號'] == sku, '庫存(顆)'] = qty
+    return store.commit(df, base, logs=logs, base_version=version)[1]
+
+# --- 兩個程序各自的 LocalStore：雲端版本變了，沒衝突的提交重新對列後送出 ---
+def test_stale_revision_rebases_other_rows(tmp_path):
+    adapter = make_adapter([inv_row('ST0', 'A', 1), inv_row('ST1', 'A', 10), inv_row('ST2', 'A', 5)])
+    app, other = make_store(tmp_path, adapter, 'app.db'), make_store(tmp_path, adapter, 'other.db')
+    set_stock(other, 'ST2', 3)
+    # 另一個程序先寫入 ST1，並刪掉了 ST0 那一列 (ST2 的列號往上移)
+    set_stock(app, 'ST1', 8)
+    assert app.push()
+    del adapter.tables[INVENTORY][1]
+    adapter.revision_value += 1
+    assert other.push()
+    assert not other.rejected
+    assert remote_stock(adapter) == {('ST1', 'A'): 8, ('ST2', 'A'): 3}
+    assert other.revision == adapter.revision_value
+    assert other.load_inventory()['庫存(顆)'].tolist() == [8, 3]
+
+# --- 同一格被別人改過：只退回這筆提交，紀錄也從本地刪掉 ---
+def test_stale_revision_rejects_conflicting_row(tmp_path):
+    adapter = make_adapter()
+    app, other = make_store(tmp_path, adapter, 'app.db'), make_store(tmp_path, adapter, 'other.db')
+    kept = set_stock(other, 'ST1', 9, [{'動作': '出庫', '編號': 'ST1'}])
+    lost = set_stock(other, 'ST2', 3, [{'動作': '出庫', '編號': 'ST2'}])
+    set_stock(app, 'ST2', 4)
+    assert app.push()
+    assert other.push()
+    status = other.write_status([kept, lost])
+    assert status[kept][0] == 'done' and status[lost][0] == 'rejected'
+    assert 'ST2/A' in status[lost][2]
+    assert remote_stock(adapter) == {('ST1', 'A'): 9, ('ST2', 'A'): 4}
+    assert other.load_history()['編號'].tolist() == ['ST1']
+
+# --- 版本對不上的整頁重寫一律退回 ---
+def test_stale_rewrite_is_rejected(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    ticket = store.rewrite_remote(INVENTORY)
+    adapter.revision_value += 1
+    assert store.push()
+    assert store.write_status([ticket])[ticket][0] == 'rejected'
+    ticket = store.rewrite_remote(INVENTORY)
+    assert store.push() and store.write_status([ticket])[ticket][0] == 'done'
+    assert adapter.revision_value == store.revision == 2
+
+# --- session 手上的批號已不在本地資料：StaleDataError，什麼都不寫 ---
+def test_commit_rejects_unresolved_key(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    version, base = store.snapshot(INVENTORY)
+    del adapter.tables[INVENTORY][2]
+    adapter.revision_value += 1
+    store.pull([INVENTORY])
+    df = base.copy()
+    df.loc[df['編號'] == 'ST2', '庫存(顆)'] = 1
+    with pytest.raises(StaleDataError):
+        store.commit(df, base, base_version=version)
+    assert store.pending_count() == 0
+    # 批號有增減的 session 也一樣
+    with pytest.raises(StaleDataError):
+        store.commit(df.iloc[:1], base, base_version=version)
+
+# --- 背景同步：排隊中的提交會被送出 ---
+def test_sync_worker_drains_outbox(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    worker = SyncWorker(store, batch_delay=0)
+    worker.start()
+    try:
+        ticket = set_stock(store, 'ST1', 6)
+        deadline = time.time() + 5
+        while store.pending_count() and time.time() < deadline: time.sleep(0.02)
+    finally:
+        worker.stop(); worker.join(5)
+    assert store.write_status([ticket])[ticket][0] == 'done'
+    assert remote_stock(adapter)[('ST1', 'A')] == 6
+
+# --- 指定日期庫存：目前庫存往前扣回之後的紀錄 (0、1、2 與多筆紀錄) ---
+@pytest.mark.parametrize('n', [0, 1, 2, 5])
+def test_stock_at(tmp_path, n):
+    moves = [('ST1', -2), ('ST2', 3), ('ST1', -1), ('ST3', 4), ('ST2', -1)][:n]
+    history = [log_row('2023-12-31 09:00', 'ST1', 'A', -7)]
+    history += [log_row(f'2024-01-0{i + 2} 10:00', sku, 'A', change) for i, (sku, change) in enumerate(moves)]
+    store = make_store(tmp_path, make_adapter(history=history))
+    stock = store.stock_at(date(2024, 1, 1)).set_index(['編號', '批號'])['庫存(顆)']
+    expected = pd.Series({'ST1': 10, 'ST2': 5, 'ST3': 0}, dtype=float)
+    for sku, change in moves: expected[sku] -= change
+    for sku in expected.index:
+        assert stock.get((sku, 'A'), 0) == expected[sku]
+
+# --- 儲存格差異以列對齊：同一個 (編號, 批號) 有兩列時，改哪一列就寫哪一列 ---
+def test_commit_with_duplicate_keys(tmp_path):
+    adapter = make_adapter([inv_row('ST1', 'A', 10), inv_row('ST1', 'A', 4), inv_row('ST2', 'A', 5)])
+    store = make_store(tmp_path, adapter)
+    version, base = store.snapshot(INVENTORY)
+    assert base.index.tolist() == [2, 3, 4]
+    df = base.copy()
+    df.loc[3, '庫存(顆)'] = 1
+    df.loc[4, '庫存(顆)'] = 2
+    store.commit(df, base, base_version=version)
+    assert store.push()
+    assert [r[12] for r in adapter.tables[INVENTORY][1:]] == ['10', '1', '2']
+    # 改批號也只是改一格
+    version, base = store.snapshot(INVENTORY)
+    df = base.copy()
+    set_cells(df, 3, {'批號': 'B'})
+    store.commit(df, base, base_version=version)
+    assert store.push()
+    assert [r[1] for r in adapter.tables[INVENTORY][1:]] == ['A', 'B', 'A']
+
+# --- 新增的列接在快照後面，index 是它的雲端列號 ---
+def test_appended_rows_keep_sheet_rows(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    version, base = store.snapshot(INVENTORY)
+    new_rows = pd.DataFrame([dict(zip(COLUMNS, inv_row('ST3', 'A', 7)))])
+    store.commit(new_rows=new_rows, base_version=version)
+    _, snap = store.snapshot(INVENTORY)
+    assert snap.index.tolist() == [2, 3, 4] and snap.at[4, '編號'] == 'ST3'
+    assert store.load_inventory().index.tolist() == [2, 3, 4]
+
+# --- 新增的列與現有的列或彼此重複 (編號, 批號)：StaleDataError，什麼都不寫 ---
+def test_commit_rejects_duplicate_new_rows(tmp_path):
+    store = make_store(tmp_path, make_adapter())
+    version, _ = store.snapshot(INVENTORY)
+    for rows in ([inv_row('ST1', 'A', 1)], [inv_row('ST3', 'A', 1), inv_row('ST3', 'A', 2)]):
+        with pytest.raises(StaleDataError):
+            store.commit(new_rows=pd.DataFrame([dict(zip(COLUMNS, r)) for r in rows]), base_version=version)
+    assert store.pending_count() == 0 and len(store.load_inventory()) == 2
+
+# --- 雲端有重複的 (編號, 批號)：版本變了時依原本的列重新套用 ---
+def test_stale_revision_rebases_duplicate_keys(tmp_path):
+    adapter = make_adapter([inv_row('ST1', 'A', 10), inv_row('ST1', 'A', 4), inv_row('ST2', 'A', 5)])
+    app, other = make_store(tmp_path, adapter, 'app.db'), make_store(tmp_path, adapter, 'other.db')
+    version, base = other.snapshot(INVENTORY)
+    df = base.copy()
+    df.loc[3, '庫存(顆)'] = 1
+    other.commit(df, base, base_version=version)
+    set_stock(app, 'ST2', 2)
+    assert app.push() and other.push()
+    assert not other.rejected
+    assert [r[12] for r in adapter.tables[INVENTORY][1:]] == ['10', '1', '2']
+
+# --- 另一個程序在同一個版本上同時寫入，蓋掉了這次寫的庫存 ---
+class OverlappingAdapter(MemorySheetAdapter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.foreign = None
+
+    def commit(self, changes, expected_revision):
+        revision = super().commit(changes, expected_revision)
+        if self.foreign is None: return revision
+        row, col, value = self.foreign
+        self.foreign = None
+        self.tables[INVENTORY][row - 1][col - 1] = value
+        self.revision_value += 1
+        raise ConcurrentWriteError(self.revision_value)
+
+# 這次 10 → 7，對方以 10 為基礎寫成 8：補回這次的 -3，另一格沒被蓋掉就不動
+def test_concurrent_write_reapplies_overwritten_stock(tmp_path):
+    adapter = OverlappingAdapter(make_adapter().tables)
+    store = make_store(tmp_path, adapter)
+    version, base = store.snapshot(INVENTORY)
+    df = base.copy()
+    df.loc[2, '庫存(顆)'] = 7
+    df.loc[3, '庫存(顆)'] = 4
+    ticket = store.commit(df, base, base_version=version)[1]
+    adapter.foreign = (2, COLUMNS.index('庫存(顆)') + 1, '8')
+    assert store.push()
+    assert store.write_status([ticket])[ticket][0] == 'done'
+    assert remote_stock(adapter) == {('ST1', 'A'): 5, ('ST2', 'A'): 4}
+    assert store.revision == adapter.revision_value == 3
+    store.pull([INVENTORY])
+    assert store.load_inventory()['庫存(顆)'].tolist() == [5, 4]
+
+# --- 定期拉取：雲端版本沒變就不重讀表格，超過 full_pull_interval 才整張重讀 (抓試算表上的手動修改) ---
+def test_pull_skips_tables_when_revision_unchanged(tmp_path):
+    adapter = make_adapter()
+    store = make_store(tmp_path, adapter)
+    reads = []
+    adapter.read = lambda table, read=adapter.read: (reads.append(table), read(table))[1]
+    adapter.tables[INVENTORY][1][12] = '3' # 直接在試算表上改，版本不變
+    store.pull()
+    assert reads == [] and remote_stock(adapter)[('ST1', 'A')] == 3
+    assert store.load_inventory()['庫存(顆)'].tolist() == [10, 5]
+    # 別人寫入 (版本變了) 就重讀
+    adapter.revision_value += 1
+    store.pull()
+    assert sorted(reads) == [HISTORY, INVENTORY]
+    assert store.load_inventory()['庫存(顆)'].tolist() == [3, 5]
+    reads.clear()
+    store.pull()
+    assert reads == []
+    store.full_pull_interval = 0
+    store.pull()
+    assert sorted(reads) == [HISTORY, INVENTORY]
+
+# --- 定期快照：每月一份，指定日期庫存從最接近的快照推算 ---
+def test_monthly_snapshot_anchors_stock_at(tmp_path):
+    adapter = make_adapter(history=[log_row('2024-01-20 10:00', 'ST1', 'A', -2)])
+    store = make_store(tmp_path, adapter)
+    assert store.snapshot_if_due(datetime(2024, 2, 1, 0, 5)) is not None
+    assert store.snapshot_if_due(datetime(2024, 2, 20)) is None
+    assert store.push()
+    assert {r[0] for r in adapter.tables[SNAPSHOTS][1:]} == {'2024-02-01 00:05:00'}
+    # 之後庫存表被直接改過 (沒有紀錄)：一月底的庫存仍以快照為準
+    adapter.tables[INVENTORY][1][12] = '99'
+    adapter.revision_value += 1
+    store.pull()
+    stock = store.stock_at(date(2024, 1, 31)).set_index(['編號', '批號'])['庫存(顆)']
+    assert stock[('ST1', 'A')] == 10 and stock[('ST2', 'A')] == 5
+    assert store.stock_at(date(2024, 1, 19)).set_index(['編號', '批號']).at[('ST1', 'A'), '庫存(顆)'] == 12
+    # 新的程序也從雲端的快照表得知本月已經拍過
+    other = make_store(tmp_path, adapter, 'other.db')
+    assert other.snapshot_if_due(datetime(2024, 2, 25)) is None